@@ -1,8 +1,15 @@
+import asyncio
 import json
 import os
 from abc import ABC, abstractmethod
 from configparser import ConfigParser
-from typing import Any, List
+from functools import partial
+from typing import Any, Dict, List, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # define list of possible values for some arguments
 ANNOTATION_TYPES = ["property", "location", "tempex", "target"]
@@ -11,15 +18,41 @@ OPERATIONS = ["eq", "lt", "gt", "diff", "let", "get", "sort"]
 MATCHING_TYPES = ["overlap", "intersect"]
 TEMPEX_TYPES = ["range", "point"]
 TEMPEX_TARGETS = ["dataDate", "publishedDate"]
+# sets of the possible values, for the validation
+_ANNOTATION_TYPES = frozenset(ANNOTATION_TYPES)
+_VALUE_TYPES = frozenset(VALUE_TYPES)
+_OPERATIONS = frozenset(OPERATIONS)
+_MATCHING_TYPES = frozenset(MATCHING_TYPES)
+_TEMPEX_TYPES = frozenset(TEMPEX_TYPES)
+_TEMPEX_TARGETS = frozenset(TEMPEX_TARGETS)
+
+
+def dumps(data: Any, indent: bool = False) -> str:
+    """JSON text of data, encoded by orjson when installed"""
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        try:
+            return orjson.dumps(data, option=option | orjson.OPT_INDENT_2 if indent else option).decode("utf-8")
+        except TypeError:
+            # values orjson does not encode, the json module may (ex: with their own types)
+            pass
+    return json.dumps(data, indent=2 if indent else None, ensure_ascii=False)
+
+
+def loads(text: Any) -> Any:
+    """data of a JSON text (str or bytes)"""
+    return orjson.loads(text) if orjson is not None else json.loads(text)
 
 
 class Annotation:
     """class definition of one annotation.
     must include these fields """
+    __slots__ = ("text", "position", "annot_type")
+
     def __init__(self, text: str, position: List[int], annot_type: str):
         self.text = text
         self.position = position
-        if annot_type in ANNOTATION_TYPES:
+        if annot_type in _ANNOTATION_TYPES:
             self.annot_type = annot_type
         else:
             raise Exception("Unknown annotation type! "
@@ -28,39 +61,70 @@ class Annotation:
     def to_dict(self):
         return {"text": self.text, "position": self.position, "type": self.annot_type}
 
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Annotation":
+        """annotation of a to_dict() dict, of the class of its type
+        (the annotation classes override it)"""
+        if data["type"] not in ANNOTATION_CLASSES:
+            raise Exception("Unknown annotation type! "
+                            "Must be one of: ", ANNOTATION_TYPES)
+        return ANNOTATION_CLASSES[data["type"]].from_dict(data)
+
     def __repr__(self):
-        return json.dumps(self.to_dict(), indent=2)
+        return dumps(self.to_dict(), indent=True)
 
 
 class QueryAnnotationsDict:
-    """ class definition of all annotations for a query"""
-    def __init__(self, query: str, annotations: List[Annotation]):
+    """ class definition of all annotations for a query,
+    with the trace of its transformation when traced (see nl2query.tracing)"""
+    __slots__ = ("query", "annotations", "trace")
+
+    def __init__(self, query: str, annotations: List[Annotation], trace: Optional[Dict[str, Any]] = None):
         self.query = query
         self.annotations = annotations
+        self.trace = trace
 
     def to_dict(self):
-        return {"query": self.query,
+        data = {"query": self.query,
                 "annotations": [annot.to_dict() for annot in self.annotations]}
+        if self.trace is not None:
+            data["trace"] = self.trace
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "QueryAnnotationsDict":
+        """query annotations of a to_dict() dict"""
+        return cls(query=data["query"], annotations=[Annotation.from_dict(annot) for annot in data["annotations"]],
+                   trace=data.get("trace"))
+
+    def to_json(self, indent: bool = False) -> str:
+        return dumps(self.to_dict(), indent=indent)
+
+    @classmethod
+    def from_json(cls, text: Any) -> "QueryAnnotationsDict":
+        return cls.from_dict(loads(text))
 
     def __repr__(self):
-        return json.dumps(self.to_dict(), indent=2)
+        return dumps(self.to_dict(), indent=True)
 
 
 class PropertyAnnotation(Annotation):
     """ class definition for a property annotation
     must include Annotation superclass fields
     and additional ones defined here """
+    __slots__ = ("name", "value", "value_type", "operation")
+
     def __init__(self, text: str, position: List[int], name: str,
                  value: Any, value_type: str, operation: str):
         super().__init__(text, position, "property")
         self.name = name
         self.value = value
-        if value_type in VALUE_TYPES:
+        if value_type in _VALUE_TYPES:
             self.value_type = value_type
         else:
             raise Exception("Unknown value type for property annotation! "
                             "Must be one of: ", VALUE_TYPES)
-        if operation in OPERATIONS:
+        if operation in _OPERATIONS:
             self.operation = operation
         else:
             raise Exception("Unknown operation for property annotation! "
@@ -71,19 +135,23 @@ class PropertyAnnotation(Annotation):
                 "name": self.name, "value": self.value, "value_type": self.value_type,
                 "operation": self.operation}
 
-    def __repr__(self):
-        return json.dumps(self.to_dict(), indent=2)
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "PropertyAnnotation":
+        return cls(text=data["text"], position=data["position"], name=data["name"], value=data["value"],
+                   value_type=data["value_type"], operation=data["operation"])
 
 
 class LocationAnnotation(Annotation):
     """ class definition for a location annotation
         must include Annotation superclass fields
         and additional ones defined here """
+    __slots__ = ("name", "value", "matching_type")
+
     def __init__(self, text: str, position: List[int], name: str, value: Any, matching_type: str):
         super().__init__(text, position, "location")
         self.name = name
         self.value = value
-        if matching_type in MATCHING_TYPES:
+        if matching_type in _MATCHING_TYPES:
             self.matching_type = matching_type
         else:
             raise Exception("Unknown matching type for location annotation! "
@@ -93,22 +161,26 @@ class LocationAnnotation(Annotation):
         return {"text": self.text, "position": self.position, "type": self.annot_type,
                 "name": self.name, "value": self.value, "matchingType": self.matching_type}
 
-    def __repr__(self):
-        return json.dumps(self.to_dict(), indent=2)
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "LocationAnnotation":
+        return cls(text=data["text"], position=data["position"], name=data["name"], value=data["value"],
+                   matching_type=data["matchingType"])
 
 
 class TemporalAnnotation(Annotation):
     """ class definition for a temporal annotation
         must include Annotation superclass fields
         and additional ones defined here """
+    __slots__ = ("tempex_type", "target", "value")
+
     def __init__(self, text: str, position: List[int], tempex_type: str, target: str, value: Any):
         super().__init__(text, position, "tempex")
-        if tempex_type in TEMPEX_TYPES:
+        if tempex_type in _TEMPEX_TYPES:
             self.tempex_type = tempex_type
         else:
             raise Exception("Unknown tempex type for temporal annotation! "
                             "Must be one of: ", TEMPEX_TYPES)
-        if target in TEMPEX_TARGETS:
+        if target in _TEMPEX_TARGETS:
             self.target = target
         else:
             raise Exception("Unknown target for temporal annotation! "
@@ -122,14 +194,18 @@ class TemporalAnnotation(Annotation):
         return {"text": self.text, "position": self.position, "type": self.annot_type,
                 "tempex_type": self.tempex_type, "target": self.target, "value": self.value}
 
-    def __repr__(self):
-        return json.dumps(self.to_dict(), indent=2)
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "TemporalAnnotation":
+        return cls(text=data["text"], position=data["position"], tempex_type=data["tempex_type"],
+                   target=data["target"], value=data["value"])
 
 
 class TargetAnnotation(Annotation):
     """ class definition for a target annotation
         must include Annotation superclass fields
         and additional ones defined here """
+    __slots__ = ("name",)
+
     def __init__(self, text: str, position: List[int], name: List[str]):
         super().__init__(text, position, "target")
         self.name = name
@@ -138,8 +214,18 @@ class TargetAnnotation(Annotation):
         return {"text": self.text, "position": self.position,
                 "type": self.annot_type, "name": self.name}
 
-    def __repr__(self):
-        return json.dumps(self.to_dict(), indent=2)
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "TargetAnnotation":
+        return cls(text=data["text"], position=data["position"], name=data["name"])
+
+
+# annotation class by type
+ANNOTATION_CLASSES = {
+    "property": PropertyAnnotation,
+    "location": LocationAnnotation,
+    "tempex": TemporalAnnotation,
+    "target": TargetAnnotation,
+}
 
 
 class NL2QueryInterface(ABC):
@@ -157,6 +243,7 @@ class NL2QueryInterface(ABC):
         super().__init__(config_file)
         """
         self.config = None
+        self.config_file = config_file
         if config_file:
             # parse the config file
             if os.path.exists(config_file):
@@ -177,6 +264,27 @@ class NL2QueryInterface(ABC):
         """
         pass
 
+    def transform_nl2query_batch(self, nlqs: List[str], verbose: bool = False) -> List[QueryAnnotationsDict]:
+        """
+        Takes a list of natural language query strings and
+        transforms each into a structured query, in the same order.
+        The default implementation transforms them one at a time,
+        the implementing class can override it to batch its model calls.
+        """
+        if verbose:
+            return [self.transform_nl2query(nlq, verbose=verbose) for nlq in nlqs]
+        return [self.transform_nl2query(nlq) for nlq in nlqs]
+
+    async def atransform_nl2query(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        """
+        Asynchronous transform_nl2query, for an event loop serving concurrent queries.
+        The default implementation runs transform_nl2query in the default executor of the loop,
+        the implementing class can override it to await its I/O (HTTP services) instead.
+        """
+        transform = partial(self.transform_nl2query, nlq, verbose=verbose) if verbose \
+            else partial(self.transform_nl2query, nlq)
+        return await asyncio.get_running_loop().run_in_executor(None, transform)
+
     @abstractmethod
     def create_property_annotation(self, annotation: Any) -> PropertyAnnotation:
         """
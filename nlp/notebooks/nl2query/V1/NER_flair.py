@@ -1,9 +1,13 @@
 import json
+import os
+from typing import List
 
 import requests
 from flair.data import Sentence
 from flair.models import SequenceTagger
 
+from nl2query.artifacts import resolve, snapshots_enabled
+from nl2query.metrics import request_timer
 from nl2query.NL2QueryInterface import (
     LocationAnnotation,
     NL2QueryInterface,
@@ -12,6 +16,9 @@ from nl2query.NL2QueryInterface import (
     TargetAnnotation,
     TemporalAnnotation
 )
+from nl2query.quantization import quantization_layers, quantize_dynamic
+from nl2query.snapshots import load_or_snapshot
+from nl2query.tracing import span
 
 
 class NER_flair(NL2QueryInterface):
@@ -23,8 +30,21 @@ class NER_flair(NL2QueryInterface):
         default = "ner-large"
         # Passing a config containing the local path to the model, otherwise it will download the model
         self.model_file = self.config.get("model_file","ner-large", fallback=default) if self.config else default
-        # load the NER tagger
-        self.tagger = SequenceTagger.load(self.model_file)
+        # use the model prefetched in the artifact store if any
+        model_name = self.model_file
+        model_path = resolve(self.model_file)
+        if model_path:
+            self.model_file = os.path.join(model_path, "pytorch_model.bin")
+        # load the NER tagger, from its memory-mapped snapshot if enabled
+        if snapshots_enabled(self.config):
+            self.tagger = load_or_snapshot(f"flair/{model_name}", self.model_file,
+                                           lambda: SequenceTagger.load(self.model_file))
+        else:
+            self.tagger = SequenceTagger.load(self.model_file)
+        # int8 dynamic quantization of the linear layers (CPU)
+        self.quantized_layers = quantization_layers(self.config)
+        if self.quantized_layers:
+            quantize_dynamic(self.tagger, self.quantized_layers)
 
     def create_property_annotation(self, annotation) -> PropertyAnnotation:
         # take annotation given by the engine
@@ -38,7 +58,10 @@ class NER_flair(NL2QueryInterface):
         geojson = {"type": "Polygon", "coordinates":[[]]}
         name = ""
         # use geogratis - only for Canada
-        req = requests.get('http://geogratis.gc.ca/services/geolocation/en/locate?q=' + annotation.text)
+        with span("geogratis"), request_timer("geogratis") as timer:
+            req = requests.get('http://geogratis.gc.ca/services/geolocation/en/locate?q=' + annotation.text)
+            if req.status_code != 200:
+                timer.error()
         if req.status_code == 200:
             result = json.loads(req.text)
             # take the first best match
@@ -64,13 +87,24 @@ class NER_flair(NL2QueryInterface):
                                 name=[""])
 
     def transform_nl2query(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
-        # collect annotations in a list of typed dicts
-        annot_dicts = []
         # get annotations from my engine
         # make a sentence
         sentence = Sentence(nlq)
         # run NER over sentence
         self.tagger.predict(sentence)
+        return self.sentence_annotations(nlq, sentence, verbose)
+
+    def transform_nl2query_batch(self, nlqs: List[str], verbose: bool = False) -> List[QueryAnnotationsDict]:
+        """get annotations of several queries, tagged in a single batch"""
+        sentences = [Sentence(nlq) for nlq in nlqs]
+        if sentences:
+            self.tagger.predict(sentences, mini_batch_size=len(sentences))
+        return [self.sentence_annotations(nlq, sentence, verbose) for nlq, sentence in zip(nlqs, sentences)]
+
+    def sentence_annotations(self, nlq: str, sentence, verbose: bool = False) -> QueryAnnotationsDict:
+        """annotations of the entities of a tagged sentence"""
+        # collect annotations in a list of typed dicts
+        annot_dicts = []
         for entity in sentence.get_spans('ner'):
             # iterate over entities and print
             # check the type and create appropriate annotation type
@@ -1,12 +1,17 @@
 import json
+import os
 import re
-from typing import Optional
+import warnings
 from importlib.metadata import PackageNotFoundError, version as get_package_version
+from pathlib import Path
+from typing import List, Optional, Set
 
 import requests
 import spacy
-from spacy.cli.download import download as spacy_download, get_model_filename, get_latest_version
+from spacy.cli.download import download as spacy_download, get_latest_version, get_model_filename
 
+from nl2query.artifacts import resolve, snapshots_enabled
+from nl2query.metrics import request_timer
 from nl2query.NL2QueryInterface import (
     LocationAnnotation,
     NL2QueryInterface,
@@ -15,6 +20,53 @@ from nl2query.NL2QueryInterface import (
     TargetAnnotation,
     TemporalAnnotation
 )
+from nl2query.quantization import quantization_layers
+from nl2query.tracing import span
+
+# execution profiles: every component of the model, or only ner and the components it depends on
+PROFILES = ["full", "entities"]
+# factories of the embedding components that a "*" listener can listen to
+EMBEDDING_FACTORIES = ["transformer", "tok2vec"]
+
+
+def listened_components(model_config, name: str) -> Set[str]:
+    """names of the components whose output the component [name] listens to (ex: its transformer)"""
+    upstreams = set()
+
+    def walk(node):
+        if isinstance(node, dict):
+            if "Listener" in str(node.get("@architectures", "")) and "upstream" in node:
+                upstreams.add(node["upstream"])
+            for value in node.values():
+                walk(value)
+    walk(model_config["components"][name])
+    if "*" in upstreams:
+        upstreams.discard("*")
+        upstreams.update(component for component, settings in model_config["components"].items()
+                         if settings.get("factory") in EMBEDDING_FACTORIES)
+    return upstreams
+
+
+def excluded_components(model_config, keep: str = "ner") -> List[str]:
+    """components of a model pipeline that the component [keep] does not depend on"""
+    needed = set()
+    todo = [keep]
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo += listened_components(model_config, name)
+    return [name for name in model_config["nlp"]["pipeline"] if name not in needed]
+
+
+def model_config_path(model: str) -> Optional[Path]:
+    """config.cfg of a model directory or installed model package, None if not found"""
+    path = Path(model)
+    if not spacy.util.is_package(model):
+        return path / "config.cfg" if (path / "config.cfg").exists() else None
+    # the package directory contains the model data directory [model]-[version]
+    configs = sorted(spacy.util.get_package_path(model).glob("*/config.cfg"))
+    return configs[-1] if configs else None
 
 
 class NER_spacy(NL2QueryInterface):
@@ -24,21 +76,89 @@ class NER_spacy(NL2QueryInterface):
         super().__init__(config)
         # start my NL2query engine
         default = "en_core_web_trf"
-        # Getting model from a config file, otherwise use the default model
+        # Getting model from a config file, otherwise use the default model,
+        # the NL2QUERY_SPACY_MODEL environment variable selects another model per deployment
         self.model = self.config.get("components.ner", "source", fallback=default) if self.config else default
         self.model_version = (self.config.get("components.ner", "version") if self.config else None) or None
-        self.download_spacy_model(self.model, self.model_version)
-        self.spacy_engine = spacy.load(self.model)
+        if os.getenv("NL2QUERY_SPACY_MODEL"):
+            self.model, self.model_version = os.getenv("NL2QUERY_SPACY_MODEL"), None
+        # cheaper model used if this one cannot be loaded, only if configured
+        self.fallback = (self.config.get("components.ner", "fallback", fallback="") if self.config else "") or None
+        # model configured, self.model being the one actually loaded
+        self.requested_model = self.model
+        self.profile = self.config.get("profile", "name", fallback="full") if self.config else "full"
+        if self.profile not in PROFILES:
+            raise ValueError(f"Unknown spaCy profile [{self.profile}]! Must be one of: {PROFILES}")
+        try:
+            self.spacy_engine = self.load_model(self.model, self.model_version)
+        except (OSError, SystemExit, requests.RequestException) as exc:
+            if not self.fallback or self.fallback == self.model:
+                raise
+            warnings.warn(f"spaCy model {self.model} could not be loaded ({exc!r}), using the fallback "
+                          f"{self.fallback}: the annotations are of lower quality")
+            self.model, self.model_version = self.fallback, None
+            self.spacy_engine = self.load_model(self.model, self.model_version)
+        self.fallback_used = self.model != self.requested_model
+        if snapshots_enabled(self.config):
+            self.attach_snapshots()
+        # int8 dynamic quantization of the transformer layers (CPU)
+        self.quantized_layers = quantization_layers(self.config)
+        if self.quantized_layers:
+            from nl2query.quantization import quantize_dynamic
+            for _, module in self.torch_modules():
+                quantize_dynamic(module, self.quantized_layers)
 #        self.spacy_engine = Language.from_config(self.config)
 
+    def load_model(self, model: str, version: Optional[str]) -> spacy.language.Language:
+        """Load the model from the artifact store, the installed packages or after downloading it.
+        The entities profile does not load the components that ner does not depend on."""
+        # load the model data from the artifact store if prefetched, without any network call
+        self.model_path = resolve(model, version)
+        if not self.model_path:
+            self.download_spacy_model(model, version)
+        name = self.model_path or model
+        exclude = []
+        if self.profile == "entities":
+            config_path = model_config_path(name)
+            if config_path:
+                exclude = excluded_components(spacy.util.load_config(config_path))
+        self.excluded = exclude
+        return spacy.load(name, exclude=exclude)
+
+    def torch_modules(self):
+        """PyTorch modules wrapped by the pipeline components (the transformer),
+        as a list of (name, module)"""
+        import torch
+
+        modules = []
+        for pipe_name, pipe in self.spacy_engine.components:
+            if not hasattr(getattr(pipe, "model", None), "walk"):
+                continue
+            pipe_modules = [shim._model for node in pipe.model.walk() for shim in node.shims
+                            if isinstance(getattr(shim, "_model", None), torch.nn.Module)]
+            modules += [(f"{pipe_name}-{i}", module) for i, module in enumerate(pipe_modules)]
+        return modules
+
+    def attach_snapshots(self) -> None:
+        """Map the weights of the PyTorch models of the pipeline (the transformer) from their snapshot,
+        written on first load. spaCy still deserializes the weights when loading, but the kernels then
+        share the mapped pages instead of each keeping its own copy."""
+        from nl2query.snapshots import attach_snapshot, snapshot_path
+        # the files of the loaded model, whatever its requested version
+        source = self.model_path or str(spacy.util.get_package_path(self.model))
+        for module_name, module in self.torch_modules():
+            name = f"spacy/{self.model}/{module_name}"
+            if attach_snapshot(module, snapshot_path(name), source):
+                print(f"Mapped the weights of {name} from its snapshot")
+            else:
+                print(f"No snapshot of {name}: the files of {source} cannot be identified")
+
     @staticmethod
     def download_spacy_model(model: str, version: Optional[str], force: bool = False) -> None:
         """
         Downloads the requested model if it cannot be found, mismatches version, or is forced reinstall.
         """
         download = force
-        if not version:
-            version = get_latest_version(model)
         try:
             model_version = get_package_version(model)
             if not model_version:
@@ -46,6 +166,8 @@ class NER_spacy(NL2QueryInterface):
         except PackageNotFoundError:
             download = True
         if download:
+            if not version:
+                version = get_latest_version(model)
             model_fn = get_model_filename(model, version)
             spacy_download(model_fn)  # download + pip install
 
@@ -75,12 +197,18 @@ class NER_spacy(NL2QueryInterface):
         return PropertyAnnotation(text=annotation.text, position=[annotation.start_char, annotation.end_char],
                                   name="", value=val, value_type=val_type, operation=operation)
 
-    def create_location_annotation(self, annotation) -> LocationAnnotation:
+    def create_location_annotation(self, annotation, geocode: bool = True) -> LocationAnnotation:
         """get gejson of location"""
         geojson = {"type": "Polygon", "coordinates":[[]]}
         name = ""
+        if not geocode:
+            return LocationAnnotation(text=annotation.text, position=[annotation.start_char, annotation.end_char],
+                                      matching_type="overlap", name=name, value=geojson)
         # use geogratis - only for Canada
-        req = requests.get('http://geogratis.gc.ca/services/geolocation/en/locate?q=' + annotation.text)
+        with span("geogratis"), request_timer("geogratis") as timer:
+            req = requests.get('http://geogratis.gc.ca/services/geolocation/en/locate?q=' + annotation.text)
+            if req.status_code != 200:
+                timer.error()
         if req.status_code == 200:
             result = json.loads(req.text)
             # take the first best match
@@ -107,7 +235,14 @@ class NER_spacy(NL2QueryInterface):
 
     def transform_nl2query(self, nlq: str, verbose:bool=False) -> QueryAnnotationsDict:
         """get annotations from my engine"""
-        doc = self.spacy_engine(nlq)
+        return self.doc_annotations(self.spacy_engine(nlq), verbose)
+
+    def transform_nl2query_batch(self, nlqs: List[str], verbose: bool = False) -> List[QueryAnnotationsDict]:
+        """get annotations of several queries, processed as batches by the engine"""
+        return [self.doc_annotations(doc, verbose) for doc in self.spacy_engine.pipe(nlqs)]
+
+    def doc_annotations(self, doc, verbose: bool = False, geocode: bool = True) -> QueryAnnotationsDict:
+        """annotations of the entities of a processed query, geocode=False leaves the locations empty"""
         # collect annotations in a list of typed dicts
         annot_dicts = []
         for ent in doc.ents:
@@ -116,7 +251,7 @@ class NER_spacy(NL2QueryInterface):
                               "PERSON", "NORP", "ORG", "FAC"]:
                 annot_dicts.append(self.create_property_annotation(ent))
             elif ent.label_ in ["GPE", "LOC"]:
-                annot_dicts.append(self.create_location_annotation(ent))
+                annot_dicts.append(self.create_location_annotation(ent, geocode))
             elif ent.label_ in ["DATE", "TIME"]:
                 annot_dicts.append(self.create_temporal_annotation(ent))
             elif ent.label_ in []:
@@ -125,7 +260,7 @@ class NER_spacy(NL2QueryInterface):
                 print("SPACY:\n",ent.text, ent.start_char, ent.end_char, ent.label_)
                 # print(annot_dicts[-1])
         # return a query annotations typed dict as required
-        return QueryAnnotationsDict(query=nlq, annotations=annot_dicts)
+        return QueryAnnotationsDict(query=doc.text, annotations=annot_dicts)
 
 
 if __name__ == "__main__":
@@ -11,6 +11,7 @@ from nl2query.NL2QueryInterface import (
     TargetAnnotation,
     TemporalAnnotation
 )
+from nl2query.registry import synchronized
 
 
 class TER_heideltime(NL2QueryInterface):
@@ -35,6 +36,8 @@ class TER_heideltime(NL2QueryInterface):
                   "machine-specific treetagger from : https://www.cis.lmu.de/~schmid/tools/TreeTagger/")
 
 
+    # the query is written to the same temp file by every call
+    @synchronized
     def call_heideltime(self, nlq: str, verbose:bool=False):
         # write nlq string to temp file
         try:
@@ -1,6 +1,8 @@
-import json
 import os
+from typing import List
 
+from nl2query.cache import cached_call, cached_transform, cached_transform_batch, pipeline_cache
+from nl2query.fusion import AnnotationFusion
 from nl2query.NL2QueryInterface import (
     LocationAnnotation,
     NL2QueryInterface,
@@ -9,6 +11,10 @@ from nl2query.NL2QueryInterface import (
     TargetAnnotation,
     TemporalAnnotation
 )
+from nl2query.registry import shared
+from nl2query.runner import run_ceda_queries
+from nl2query.threads import apply_thread_budget
+from nl2query.tracing import pipeline_tracer, span, traced_transform, traced_transform_batch
 from nl2query.V1.NER_flair import NER_flair
 from nl2query.V1.NER_spacy import NER_spacy
 from nl2query.V1.TER_heideltime import TER_heideltime
@@ -20,28 +26,39 @@ class V1_pipeline(NL2QueryInterface):
 
     def __init__(self, config:str="v1_config.cfg"):
         super().__init__(os.path.join(os.path.dirname(os.path.realpath(__file__)),config))
+        # limit the torch, BLAS and tokenizers threads of the process
+        self.thread_budget = apply_thread_budget(self.config)
+        # cache of the results and NER annotations by query
+        self.result_cache, self.cache_fingerprint = pipeline_cache(self.config, self.config_file)
+        # traces of the queries (see nl2query.tracing)
+        self.tracer = pipeline_tracer(self.config)
 
         self.path = os.path.dirname(os.path.realpath(__file__))
         # Getting model from a config file, otherwise use the default model
         if self.config.get("spacy","config_file", fallback=None) :
-            self.spacy_instance = NER_spacy(self.config.get("spacy","config_file"))
+            self.spacy_instance = shared(NER_spacy, self.config.get("spacy","config_file"))
+            # the results depend on the spaCy model actually loaded (fallback or NL2QUERY_SPACY_MODEL)
+            self.cache_fingerprint += "/" + self.spacy_instance.model
         else:
             self.spacy_instance = None
             
         if self.config.get("flair","config_file", fallback=None) :
-            self.flair_instance = NER_flair(self.config.get("flair","config_file"))
+            self.flair_instance = shared(NER_flair, self.config.get("flair","config_file"))
         else:
             self.flair_instance = None
 
         if self.config.get("heideltime","config_file", fallback=None) :
-            self.heideltime_instance = TER_heideltime(self.config.get("heideltime","config_file"))
+            self.heideltime_instance = shared(TER_heideltime, self.config.get("heideltime","config_file"))
         else:
             self.heideltime_instance = None
             
         if self.config.get("varval","config_file", fallback=None) :
-            self.varval_instance = Vars_values_textsearch(self.config.get("varval","config_file"))
+            self.varval_instance = shared(Vars_values_textsearch, self.config.get("varval","config_file"))
         else:
             self.varval_instance = None
+
+        # merge of the spaCy and Flair annotations
+        self.fusion = AnnotationFusion.from_config(self.config, sources=["spacy", "flair"])
             
     def create_property_annotation(self, annotation) -> PropertyAnnotation:
         # take annotation given by the engine
@@ -66,29 +83,59 @@ class V1_pipeline(NL2QueryInterface):
                                 name=[])
          
         
+    def ner_annotate(self, instance, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        """annotations of a NER instance, cached by query (except the verbose calls)"""
+        with span(type(instance).__name__):
+            return cached_call(None if verbose else self.result_cache, type(instance).__name__,
+                               self.cache_fingerprint, lambda: instance.transform_nl2query(nlq, verbose), [nlq])
+
+    @traced_transform
+    @cached_transform
     def transform_nl2query(self, nlq:str, verbose:bool=False) -> QueryAnnotationsDict:
-        
-        combined_annotations = []
-        if self.spacy_instance:
-            spacy_query_annotation_dict = self.spacy_instance.transform_nl2query(nlq, verbose)
+        spacy_query_annotation_dict = self.ner_annotate(self.spacy_instance, nlq, verbose) \
+            if self.spacy_instance else None
+        flair_query_annotation_dict = self.ner_annotate(self.flair_instance, nlq, verbose) \
+            if self.flair_instance else None
+        return self.combine_annotations(nlq, spacy_query_annotation_dict, flair_query_annotation_dict, verbose)
+
+    @traced_transform_batch
+    @cached_transform_batch
+    def transform_nl2query_batch(self, nlqs: List[str], verbose: bool = False) -> List[QueryAnnotationsDict]:
+        """transform several queries, with the spaCy and Flair models run on all of them at once"""
+        with span("NER_spacy"):
+            spacy_results = self.spacy_instance.transform_nl2query_batch(nlqs, verbose) \
+                if self.spacy_instance else [None] * len(nlqs)
+        with span("NER_flair"):
+            flair_results = self.flair_instance.transform_nl2query_batch(nlqs, verbose) \
+                if self.flair_instance else [None] * len(nlqs)
+        return [self.combine_annotations(nlq, spacy_query_annotation_dict, flair_query_annotation_dict, verbose)
+                for nlq, spacy_query_annotation_dict, flair_query_annotation_dict
+                in zip(nlqs, spacy_results, flair_results)]
+
+    def combine_annotations(self, nlq: str, spacy_query_annotation_dict: QueryAnnotationsDict,
+                            flair_query_annotation_dict: QueryAnnotationsDict,
+                            verbose: bool = False) -> QueryAnnotationsDict:
+        """combine the spaCy and Flair annotations of a query with the HeidelTime and textsearch ones"""
+        spacy_annotations = None
+        if spacy_query_annotation_dict:
             # not adding temporal annotations
-            combined_annotations.extend([a for a in spacy_query_annotation_dict.annotations 
-                                         if not isinstance(a,TemporalAnnotation)])              
-       
-        if self.flair_instance:
-            flair_query_annotation_dict = self.flair_instance.transform_nl2query(nlq, verbose)
-            # add flair annotations that do not overlap
-            combined_annotations.extend([a for a in flair_query_annotation_dict.annotations 
-                                         if a.position not in 
-                                         [b.position for b in spacy_query_annotation_dict.annotations]])
+            spacy_annotations = [a for a in spacy_query_annotation_dict.annotations
+                                 if not isinstance(a, TemporalAnnotation)]
+        # add flair annotations that do not overlap the spacy ones, all of which are kept
+        combined_annotations = self.fusion.fuse({
+            "spacy": spacy_annotations,
+            "flair": flair_query_annotation_dict.annotations if flair_query_annotation_dict else None},
+            keep=["spacy"])
 
         if self.heideltime_instance:
-            heideltime_query_annotation_dict = self.heideltime_instance.transform_nl2query(nlq, verbose)
+            with span("TER_heideltime"):
+                heideltime_query_annotation_dict = self.heideltime_instance.transform_nl2query(nlq, verbose)
             heideltime_annotations = heideltime_query_annotation_dict.annotations.copy()
             combined_annotations.extend(heideltime_annotations)   
             
         if self.varval_instance:
-            varval_query_annotation_dict = self.varval_instance.transform_nl2query(nlq, verbose)
+            with span("Vars_values_textsearch"):
+                varval_query_annotation_dict = self.varval_instance.transform_nl2query(nlq, verbose)
             combined_annotations.extend(varval_query_annotation_dict.annotations)
 
         if len(combined_annotations) > 1:
@@ -98,23 +145,8 @@ class V1_pipeline(NL2QueryInterface):
 
     def run_ceda_queries(self, write_out:bool=False):
         """run V1 instance on ceda evaluation dataset"""
-        qfile = os.path.join(self.path, "../../nl2q_eval/ceda_gold_queries.json")
-        struct_results = []
-        with open(qfile, 'r', encoding="utf-8") as f:
-            qs = json.load(f)
-            if 'queries' in qs.keys():
-                qlist = qs['queries']
-                # iterate over queries
-                for q in qlist:
-                    print(q)
-                    res = self.transform_nl2query(q['query'])
-                    # print(res)
-                    struct_results.append(res.to_dict())
-            if write_out:
-                ofile = os.path.join(path, "v1_ceda_test_results.json")
-                with open(ofile, 'w', encoding="utf-8") as f:
-                    json.dump({'queries': struct_results}, f, indent=2)
-        return struct_results
+        ofile = os.path.join(self.path, "v1_ceda_test_results.json") if write_out else None
+        return run_ceda_queries(self.transform_nl2query_batch, ofile)
             
     
 if __name__ == "__main__":
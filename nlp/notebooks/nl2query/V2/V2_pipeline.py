@@ -1,18 +1,31 @@
-import time
-
+import asyncio
+import contextvars
 import datetime
 import json
 import os
 import re
-import sys
 import subprocess
-from typing import List, Optional
+import sys
+import time
+import weakref
+from functools import lru_cache, partial, wraps
+from typing import FrozenSet, List, Optional, Union
 
-import nltk
-import osmnx as ox
 import requests
 
+from nl2query.artifacts import resolve, snapshots_enabled
+from nl2query.cache import (
+    ResultCache,
+    acached_call,
+    acached_transform,
+    cached_call,
+    cached_transform,
+    code_fingerprint,
+    pipeline_cache
+)
+from nl2query.metrics import timed_request, timed_stage
 from nl2query.NL2QueryInterface import (
+    Annotation,
     LocationAnnotation,
     NL2QueryInterface,
     PropertyAnnotation,
@@ -20,21 +33,44 @@ from nl2query.NL2QueryInterface import (
     TargetAnnotation,
     TemporalAnnotation
 )
+from nl2query.registry import shared
+from nl2query.runner import run_ceda_queries
+from nl2query.threads import apply_thread_budget
+from nl2query.tracing import add_count, atraced_transform, in_context, pipeline_tracer, traced, traced_transform
+from nl2query.V2.ngram_filter import NgramFilter
+from nl2query.V2.query_tokens import QueryTokens
 from nl2query.V2.Vdb_simsearch import Vdb_simsearch, generate_ngrams
+from nl2query.V2.vector_index import INDEX_PARAMS
 from typedefs import JSON
 
-try:
-    nltk.data.find('corpora/stopwords')
-except LookupError:
-    nltk.download('stopwords')
-from nltk.corpus import stopwords
+
+@lru_cache(maxsize=None)
+def english_stopwords() -> FrozenSet[str]:
+    """nltk english stopwords, from the artifact store or downloaded on first use if missing"""
+    import nltk
+    nltk_data = resolve("stopwords")
+    if nltk_data and nltk_data not in nltk.data.path:
+        nltk.data.path.insert(0, nltk_data)
+    try:
+        nltk.data.find('corpora/stopwords')
+    except LookupError:
+        nltk.download('stopwords')
+    from nltk.corpus import stopwords
+    return frozenset(stopwords.words('english'))
 
 
-def find_spans(span: str, query: str):
+def find_spans(span: str, query: Union[str, QueryTokens]):
     """Find a span  in a query.
     Return the spans or a list of spans 
     in the case of split spans and 
-    their positions in the query."""
+    their positions in the query.
+    With query tokens, the span is found in the remaining tokens
+    (by string search in their query if its words are not tokens)."""
+    if isinstance(query, QueryTokens):
+        indices = query.match(span)
+        if indices is not None:
+            return query.positions(indices)
+        query = query.query
     # split span case
     if span not in query:
         pos = []
@@ -86,27 +122,138 @@ def remove_stopwords(text:str):
     """Given a string, remove 
     the stopwords with nltk.
     Return the filtered text"""
-    stop_words = set(stopwords.words('english'))
+    stop_words = english_stopwords()
     filtered_text = ' '.join([word for word in text.split() if word.lower() not in stop_words])
     return filtered_text
 
 
-def osmnx_geocode(vdb: Vdb_simsearch, query: str, threshold: float = 0.7, policy: str = 'length'):
-    """location geocoding service
-    that queries every 1 and 2-gram tokens
-    and returns a result above the threshold (default 0.7)
-    and highest score if policy=score
+def covered_texts(annotations: List[Annotation]) -> List[str]:
+    """texts of the temporal and location annotations,
+    whose n-grams are pruned from the vector searches"""
+    return [a.text for a in annotations
+            if isinstance(a, (TemporalAnnotation, LocationAnnotation)) and isinstance(a.text, str)]
+
+
+# search counters (and V3 stage wall times) of the last query annotated in the current context
+LAST_QUERY_STATS = contextvars.ContextVar("LAST_QUERY_STATS", default={})
+
+
+def reset_query_stats(method):
+    """Reset the stats of the last query before a transform method (or coroutine method), so that
+    the results found in the cache, which are not computed, do not report those of the previous query."""
+    if asyncio.iscoroutinefunction(method):
+        @wraps(method)
+        async def atransform(self, *args, **kwargs):
+            LAST_QUERY_STATS.set({})
+            return await method(self, *args, **kwargs)
+        return atransform
+
+    @wraps(method)
+    def transform(self, *args, **kwargs):
+        LAST_QUERY_STATS.set({})
+        return method(self, *args, **kwargs)
+    return transform
+
+
+def print_search_stats(search_stats: dict) -> None:
+    """print the n-gram search counters of a query"""
+    print("Vector searches avoided by exact match:", search_stats["exact_hits"],
+          "- vector searches run:", search_stats["vector_searches"])
+    pruned = {k[7:]: v for k, v in search_stats.items() if k.startswith("pruned_") and v}
+    if pruned:
+        print("Vector searches skipped by n-gram pruning:", pruned)
+
+
+@traced("nominatim")
+@timed_request("nominatim")
+def geocode_token(token: str):
+    """osmnx geocoding of a token, None if not found"""
+    import osmnx as ox
+    try:
+        return ox.geocode_to_gdf(token)
+    except requests.exceptions.RequestException:
+        # network errors are not cached as not found
+        raise
+    except Exception:
+        return None
+
+
+def nominatim_gdf(results: List[dict]):
+    """GeoDataFrame of the first (Multi)Polygon of Nominatim search results by importance,
+    as osmnx.geocode_to_gdf, None if there is none"""
+    import geopandas as gpd
+    polygons = [result for result in sorted(results, key=lambda result: result["importance"], reverse=True)
+                if result.get("geojson", {}).get("type") in ["Polygon", "MultiPolygon"]]
+    if not polygons:
+        return None
+    result = polygons[0]
+    bottom, top, left, right = result["boundingbox"]
+    properties = {"bbox_west": left, "bbox_south": bottom, "bbox_east": right, "bbox_north": top}
+    properties.update({attr: value for attr, value in result.items()
+                       if attr not in ["address", "boundingbox", "geojson", "icon", "licence"]})
+    gdf = gpd.GeoDataFrame.from_features([{"type": "Feature", "geometry": result["geojson"],
+                                           "properties": properties}])
+    cols = ["lat", "lon", "bbox_north", "bbox_south", "bbox_east", "bbox_west"]
+    gdf[cols] = gdf[cols].astype(float)
+    return gdf
+
+
+class RequestLimiter:
+    """ concurrent requests up to concurrency, started at least interval seconds apart """
+
+    def __init__(self, concurrency: int = 1, interval: float = 1.0):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.interval = interval
+        self.lock = asyncio.Lock()
+        self.last = None
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        try:
+            async with self.lock:
+                if self.last is not None:
+                    await asyncio.sleep(self.last + self.interval - time.monotonic())
+                self.last = time.monotonic()
+        except BaseException:
+            self.semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.semaphore.release()
+
+
+@traced("nominatim")
+@timed_request("nominatim")
+async def ageocode_token(client, token: str, limiter: RequestLimiter):
+    """asynchronous geocode_token, searching the osmnx Nominatim URL with an httpx client"""
+    import osmnx as ox
+    params = {"format": "json", "polygon_geojson": 1, "dedupe": 0, "limit": 50, "q": token}
+    headers = {"User-Agent": ox.settings.http_user_agent, "referer": ox.settings.http_referer,
+               "Accept-Language": ox.settings.http_accept_language}
+    async with limiter:
+        response = await client.get(ox.settings.nominatim_url.rstrip("/") + "/search", params=params,
+                                    headers=headers, timeout=ox.settings.requests_timeout)
+    response.raise_for_status()
+    return nominatim_gdf(response.json())
+
+
+def not_found(gdf) -> bool:
+    """geocoding not found, only cached for the day as the place may be added to OpenStreetMap"""
+    return gdf is None
+
+
+def select_geocoding(query_tokens: List[str], gdfs: list, threshold: float = 0.7, policy: str = 'length'):
+    """token and geocoding above the threshold
+    with the highest score if policy=score
     or highest length if policy=length (default)."""
-    query_tokens, _ = generate_ngrams(query, 2)
-    # query by 1-gram and 2-gram tokens
     importance = 0
     max_gdf = None
     max_token = None
     max_len = 0
-    for token in query_tokens:
+    for token, gdf in zip(query_tokens, gdfs):
         try:
-            gdf = ox.geocode_to_gdf(token)
-            if len(gdf) > 0 and gdf['class'].iloc[0]in ['boundary', 'city', 'country', 'place']:
+            if gdf is not None and len(gdf) > 0 and gdf['class'].iloc[0]in ['boundary', 'city', 'country', 'place']:
                 gdf_imp = gdf['importance'].iloc[0] 
                 if policy == "score" and gdf_imp > threshold and gdf_imp > importance:
                     importance = gdf['importance'][0]
@@ -121,10 +268,48 @@ def osmnx_geocode(vdb: Vdb_simsearch, query: str, threshold: float = 0.7, policy
     return (max_token, max_gdf)
 
 
+@traced("geocode")
+@timed_stage("geocode")
+def osmnx_geocode(vdb: Vdb_simsearch, query: str, threshold: float = 0.7, policy: str = 'length',
+                  cache: Optional[ResultCache] = None):
+    """location geocoding service
+    that queries every 1 and 2-gram tokens
+    and returns a result above the threshold (default 0.7)
+    and highest score if policy=score
+    or highest length if policy=length (default).
+    The geocoding of the tokens is kept in the cache if given."""
+    query_tokens, _ = generate_ngrams(query, 2)
+    # query by 1-gram and 2-gram tokens
+    gdfs = []
+    for token in query_tokens:
+        try:
+            gdfs.append(cached_call(cache, "osmnx_geocode", code_fingerprint(), lambda: geocode_token(token),
+                                    [token], dated=not_found))
+        except:
+            gdfs.append(None)
+    return select_geocoding(query_tokens, gdfs, threshold, policy)
+
+
+@traced("geocode")
+@timed_stage("geocode")
+async def aosmnx_geocode(client, limiter: RequestLimiter, query: str, threshold: float = 0.7,
+                         policy: str = 'length', cache: Optional[ResultCache] = None):
+    """asynchronous osmnx_geocode, the tokens are geocoded concurrently (as allowed by the limiter)"""
+    query_tokens, _ = generate_ngrams(query, 2)
+    gdfs = await asyncio.gather(*[acached_call(cache, "osmnx_geocode", code_fingerprint(),
+                                               partial(ageocode_token, client, token, limiter), [token],
+                                               dated=not_found)
+                                  for token in query_tokens], return_exceptions=True)
+    gdfs = [None if isinstance(gdf, Exception) else gdf for gdf in gdfs]
+    return select_geocoding(query_tokens, gdfs, threshold, policy)
+
+
 class V2_pipeline(NL2QueryInterface):
 
     def __init__(self, config: str = "v2_config.cfg"):
         super().__init__(os.path.join(os.path.dirname(os.path.realpath(__file__)),config))
+        # limit the torch, BLAS and tokenizers threads of the process
+        self.thread_budget = apply_thread_budget(self.config)
         # Getting vdb paths from config file
         if "prop_vdb" in self.config.sections():
             self.prop_vdb = self.config.get("prop_vdb","prop_vdb_path",fallback=None)
@@ -147,11 +332,71 @@ class V2_pipeline(NL2QueryInterface):
             self.duckling_url = "http://0.0.0.0:8000/parse"
         self.duckling_dims = ["time"]
 
+        # answer exact vocabulary matches without embedding search
+        self.exact_match = self.config.getboolean("vdb", "exact_match", fallback=True)
+        # vector index backend and its tuning parameters
+        self.vdb_backend = self.config.get("vdb", "backend", fallback="chroma")
+        self.vdb_mmap = self.config.getboolean("vdb", "mmap", fallback=True)
+        self.vdb_params = {param: self.config.get("vdb", param) for param in INDEX_PARAMS
+                           if self.config.get("vdb", param, fallback=None)}
+        # embed n-grams separately or pool them from one forward pass of the query
+        self.vdb_encoding = self.config.get("vdb", "encoding", fallback="ngram")
+        # load the encoder from its memory-mapped snapshot
+        self.vdb_snapshot = snapshots_enabled(self.config, "vdb", "snapshot")
+        # prune query n-grams before the vector searches
+        self.ngram_filter = None
+        if self.config.getboolean("ngram_filter", "enabled", fallback=False):
+            use_stopwords = self.config.getboolean("ngram_filter", "stopwords", fallback=True)
+            self.ngram_filter = NgramFilter(
+                stopwords=english_stopwords() if use_stopwords else None,
+                numeric=self.config.getboolean("ngram_filter", "numeric", fallback=True),
+                min_chars=self.config.getint("ngram_filter", "min_chars", fallback=2),
+                covered=self.config.getboolean("ngram_filter", "covered", fallback=True),
+                dedup=self.config.getboolean("ngram_filter", "dedup", fallback=True),
+            )
         # need either the vdb paths or the vocab paths to setup vdbs
-        self.vdbs = Vdb_simsearch(self.prop_vdb, self.prop_vocab, self.targ_vdb, self.targ_vocab)
+        # the same vdbs and encoder are shared by the V2 and V3 pipelines
+        self.vdbs = shared(Vdb_simsearch, self.prop_vdb, self.prop_vocab, self.targ_vdb, self.targ_vocab,
+                           exact_match=self.exact_match, backend=self.vdb_backend,
+                           mmap=self.vdb_mmap, index_params=self.vdb_params,
+                           encoding=self.vdb_encoding, ngram_filter=self.ngram_filter,
+                           snapshot=self.vdb_snapshot)
+        # cache of the results, Duckling answers, geocoding and vector searches
+        self.result_cache, self.cache_fingerprint = pipeline_cache(self.config, self.config_file)
+        self.vdbs.result_cache, self.vdbs.cache_fingerprint = self.result_cache, self.cache_fingerprint
+        # traces of the queries (see nl2query.tracing)
+        self.tracer = pipeline_tracer(self.config)
+        # asynchronous API: concurrent geocoding requests (the public Nominatim allows 1 request/s)
+        self.geocode_concurrency = self.config.getint("async", "geocode_concurrency", fallback=1)
+        # minimum seconds between the starts of two geocoding requests
+        self.geocode_interval = self.config.getfloat("async", "geocode_interval", fallback=1.0)
+        # httpx client and geocoding limiter by event loop
+        self.async_clients = weakref.WeakKeyDictionary()
         # check if Duckling is running correctly
-        self.duckling_parse("test - yesterday", dims=["time"])
+        self.duckling_request("test - yesterday", dims=["time"])
+
+    @property
+    def search_stats(self) -> dict:
+        """search counters of the last query annotated in the current context (thread)"""
+        return LAST_QUERY_STATS.get().get("search_stats", {})
 
+    def async_client(self):
+        """httpx client and geocoding limiter of the running event loop"""
+        # httpx is only needed by the asynchronous API
+        import httpx
+        loop = asyncio.get_running_loop()
+        if loop not in self.async_clients:
+            self.async_clients[loop] = (httpx.AsyncClient(),
+                                        RequestLimiter(self.geocode_concurrency, self.geocode_interval))
+        return self.async_clients[loop]
+
+    async def aclose(self) -> None:
+        """close the httpx client of the running event loop"""
+        client = self.async_clients.pop(asyncio.get_running_loop(), None)
+        if client:
+            await client[0].aclose()
+
+    @timed_stage("duckling_parse")
     def duckling_parse(
         self,
         query: str,
@@ -160,7 +405,29 @@ class V2_pipeline(NL2QueryInterface):
     ) -> Optional[JSON]:
         """Temporal Expression Detection using Duckling.
         Needs rasa/duckling Docker image running on duckling_url.
-        Return a response json or None."""
+        Return a response json or None.
+        The answers are cached for the day, being relative to the current date."""
+        return cached_call(self.result_cache, "duckling", self.cache_fingerprint,
+                           lambda: self.duckling_request(query, locale, dims),
+                           [query, self.duckling_locale or locale, dims], dated=True)
+
+    @timed_stage("duckling_parse")
+    async def aduckling_parse(
+        self,
+        query: str,
+        locale: Optional[str] = None,
+        dims: Optional[List[str]] = None,
+    ) -> Optional[JSON]:
+        """asynchronous duckling_parse, the Duckling started with stack is requested in the default executor"""
+        if self.duckling_run:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, in_context(self.duckling_parse), query, locale, dims)
+        return await acached_call(self.result_cache, "duckling", self.cache_fingerprint,
+                                  lambda: self.aduckling_request(query, locale, dims),
+                                  [query, self.duckling_locale or locale, dims], dated=True)
+
+    def duckling_data(self, query: str, locale: Optional[str] = None, dims: Optional[List[str]] = None) -> dict:
+        """form data of a Duckling request"""
         duckling_data = {
             "text": query,
             "locale": self.duckling_locale or locale,
@@ -169,6 +436,44 @@ class V2_pipeline(NL2QueryInterface):
             dims = self.duckling_dims
         if dims:
             duckling_data["dims"] = json.dumps(dims)
+        return duckling_data
+
+    @traced("duckling")
+    @timed_request("duckling")
+    async def aduckling_request(
+        self,
+        query: str,
+        locale: Optional[str] = None,
+        dims: Optional[List[str]] = None,
+    ) -> Optional[JSON]:
+        """request the Duckling service with the httpx client of the event loop"""
+        import httpx
+        client, _ = self.async_client()
+        duckling_data = self.duckling_data(query, locale, dims)
+        for _ in range(5):
+            try:
+                response = await client.post(self.duckling_url, data=duckling_data, timeout=1)
+            except httpx.TransportError:
+                add_count("retries")
+                await asyncio.sleep(0.25)
+                continue
+            if response.status_code == 200:
+                data = response.json()
+                return data[0] if len(data) > 0 else None
+            add_count("retries")
+            await asyncio.sleep(0.25)
+        raise Exception(f"Please make sure Duckling service is running on [{self.duckling_url}]!")
+
+    @traced("duckling")
+    @timed_request("duckling")
+    def duckling_request(
+        self,
+        query: str,
+        locale: Optional[str] = None,
+        dims: Optional[List[str]] = None,
+    ) -> Optional[JSON]:
+        """request the Duckling service (started with stack if duckling_path is set)"""
+        duckling_data = self.duckling_data(query, locale, dims)
         proc = None
         try:
             if self.duckling_run:
@@ -185,6 +490,7 @@ class V2_pipeline(NL2QueryInterface):
                 try:
                     response = requests.post(self.duckling_url, data=duckling_data, timeout=1)
                 except requests.exceptions.ConnectionError:
+                    add_count("retries")
                     time.sleep(0.25)
                     continue
                 if response.status_code == 200:
@@ -193,6 +499,8 @@ class V2_pipeline(NL2QueryInterface):
                         return data[0]
                     else:
                         return None  # empty response
+                add_count("retries")
+                time.sleep(0.25)
             else:
                 raise Exception(f"Please make sure Duckling service is running on [{self.duckling_url}]!")
         except Exception as exc:
@@ -243,35 +551,61 @@ class V2_pipeline(NL2QueryInterface):
                                 tempex_type="range", target="dataDate", value={'start':start,'end':end})
 
 
-    def temporal_annotate(self, newq:str, nlq:str, verbose:bool=False):
+    @traced("temporal_annotate")
+    @timed_stage("temporal_annotate")
+    def temporal_annotate(self, newq: Union[str, QueryTokens], nlq: str, verbose: bool = False):
+        """temporal annotations of the query left to annotate (their positions are in its query),
+        return them and the query tokens left"""
+        query_tokens = newq.copy() if isinstance(newq, QueryTokens) else QueryTokens(newq)
+        annotations = []
+        self.add_tempex(annotations, self.duckling_parse(query_tokens.text()), query_tokens, verbose)
+        # tweak for years non-detected
+        search_years = re.findall(r'\d{4}', query_tokens.text())
+        for year in search_years:
+            self.add_year_tempex(annotations, year, self.duckling_parse("in " + year), query_tokens, nlq, verbose)
+        return annotations, query_tokens
+
+    @traced("temporal_annotate")
+    @timed_stage("temporal_annotate")
+    async def atemporal_annotate(self, newq: Union[str, QueryTokens], nlq: str, verbose: bool = False):
+        """asynchronous temporal_annotate, the years are parsed concurrently"""
+        query_tokens = newq.copy() if isinstance(newq, QueryTokens) else QueryTokens(newq)
         annotations = []
-        duckling_annotation = self.duckling_parse(newq)
+        self.add_tempex(annotations, await self.aduckling_parse(query_tokens.text()), query_tokens, verbose)
+        search_years = re.findall(r'\d{4}', query_tokens.text())
+        year_annotations = await asyncio.gather(*[self.aduckling_parse("in " + year) for year in search_years])
+        for year, year_annotation in zip(search_years, year_annotations):
+            self.add_year_tempex(annotations, year, year_annotation, query_tokens, nlq, verbose)
+        return annotations, query_tokens
+
+    def add_tempex(self, annotations: List[Annotation], duckling_annotation: Optional[JSON],
+                   query_tokens: QueryTokens, verbose: bool = False) -> None:
+        """add the temporal annotation of a Duckling answer on the query tokens text, and consume its tokens"""
         if duckling_annotation:
-            tempex = self.create_temporal_annotation(duckling_annotation)
+            # Duckling positions are in the text of the tokens left
+            indices, pos = query_tokens.map_range(duckling_annotation['start'], duckling_annotation['end'])
+            tempex = self.create_temporal_annotation(dict(duckling_annotation, start=pos[0], end=pos[1]))
             annotations.append(tempex)
             # remove temporal annotation span from query
-            newq = newq[:tempex.position[0]] + newq[tempex.position[1]:]
-            newq = newq.replace("  ", " ")
+            query_tokens.consume(indices)
             if verbose:
                 print("TEMPEX - V2:\n", tempex)
-                print("New query:", newq)
-        # tweak for years non-detected
-        search_years = re.findall(r'\d{4}', newq)
-        for year in search_years:
-            year_annotation = self.duckling_parse("in " + year)
-            if year_annotation:
-                span, pos = find_spans(year, nlq)
-                tempex = self.create_temporal_annotation({'body':span, 
-                                                        'value':year_annotation['value'], 
-                                                        'start':pos[0], 'end':pos[1]})
-                annotations.append(tempex)
-                # remove temporal annotation span from query
-                newq = newq[:tempex.position[0]] + newq[tempex.position[1]:]
-                newq = newq.replace("  ", " ")
-                if verbose:
-                    print("TEMPEX - V2:\n", tempex)
-                    print("New query:", newq)
-        return annotations, newq 
+                print("New query:", query_tokens.text())
+
+    def add_year_tempex(self, annotations: List[Annotation], year: str, year_annotation: Optional[JSON],
+                        query_tokens: QueryTokens, nlq: str, verbose: bool = False) -> None:
+        """add the temporal annotation of a year not detected in the query, and consume its token"""
+        if year_annotation:
+            span, pos = find_spans(year, query_tokens if query_tokens.query == nlq else nlq)
+            tempex = self.create_temporal_annotation({'body':span, 
+                                                    'value':year_annotation['value'], 
+                                                    'start':pos[0], 'end':pos[1]})
+            annotations.append(tempex)
+            # remove temporal annotation span from query
+            query_tokens.consume_span(year)
+            if verbose:
+                print("TEMPEX - V2:\n", tempex)
+                print("New query:", query_tokens.text())
         
         
     def create_location_annotation(self, annotation) -> LocationAnnotation:
@@ -316,60 +650,93 @@ class V2_pipeline(NL2QueryInterface):
         return TargetAnnotation(text=spans,  position=poss, name=varnames)
         
 
+    @traced_transform
+    @reset_query_stats
+    @cached_transform
     def transform_nl2query(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
-        newq = nlq
+        # tokens of the query, consumed by the annotations
+        query_tokens = QueryTokens(nlq, english_stopwords())
         # collect annotations
         combined_annotations = []
 
         # temporal annotation
-        tempex, newq = self.temporal_annotate(newq, nlq, verbose)
+        tempex, query_tokens = self.temporal_annotate(query_tokens, nlq, verbose)
         combined_annotations+=(tempex)              
         
         # remove stopwords
-        newq = remove_stopwords(newq)
+        query_tokens.consume_stopwords()
         if verbose:
             print("Removing stopwords")
-            print("New query:", newq) 
+            print("New query:", query_tokens.text()) 
         
         # location annotation
-        loc_span, osmnx_annotation = osmnx_geocode(self.vdbs, newq)
+        loc_span, osmnx_annotation = osmnx_geocode(self.vdbs, query_tokens.text(), cache=self.result_cache)
+        return self.search_annotate(query_tokens, combined_annotations, loc_span, osmnx_annotation, verbose)
+
+    @atraced_transform
+    @reset_query_stats
+    @acached_transform
+    async def atransform_nl2query(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        """asynchronous transform_nl2query: Duckling and the geocoding are awaited with httpx,
+        the vector searches run in the default executor"""
+        tempex, query_tokens = await self.atemporal_annotate(QueryTokens(nlq, english_stopwords()), nlq, verbose)
+        query_tokens.consume_stopwords()
+        if verbose:
+            print("Removing stopwords")
+            print("New query:", query_tokens.text())
+        client, limiter = self.async_client()
+        loc_span, osmnx_annotation = await aosmnx_geocode(client, limiter, query_tokens.text(),
+                                                          cache=self.result_cache)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, in_context(self.search_annotate), query_tokens, tempex, loc_span, osmnx_annotation, verbose)
+
+    @traced("search_annotate")
+    @timed_stage("search_annotate")
+    def search_annotate(self, query_tokens: QueryTokens, combined_annotations: List[Annotation],
+                        loc_span: Optional[str], osmnx_annotation, verbose: bool = False) -> QueryAnnotationsDict:
+        """add the location of the geocoding and the target and property annotations
+        of the vector searches to the temporal ones, consuming the query tokens"""
+        nlq = query_tokens.query
+        combined_annotations = list(combined_annotations)
         if loc_span != None:
-            _, pos = find_spans(loc_span, nlq)
+            _, pos = find_spans(loc_span, query_tokens)
             loc = self.create_location_annotation([loc_span, pos, osmnx_annotation])
             combined_annotations.append(loc)
             # remove loc annotations from newq
-            _, newpos = find_spans(loc_span, newq)
-            newq = newq[:newpos[0]] + newq[newpos[1]:]
-            newq = newq.replace("   ", " ")
-            newq = newq.replace("  ", " ")
+            query_tokens.consume_span(loc_span)
             if verbose:
                 print("LOCATION - V2:\n", loc)
-                print("New query:", newq)
+                print("New query:", query_tokens.text())
         
         
-        # target annotation
-        targ_span, targ_results = self.vdbs.query_ngram_target(newq, threshold=0.7)
-        if len(targ_span) > 1 :
-            targ_spans, pos = find_spans(targ_span, nlq)
-            targ_annotation = self.create_target_annotation([targ_spans, pos, targ_results])
-            combined_annotations.append(targ_annotation)
-            # remove target annotations from newq
-            _, newpos = find_spans(targ_span, newq)
-            newq = newq[:newpos[0]] + newq[newpos[1]:]
-            newq = newq.replace("   ", " ")
-            newq = newq.replace("  ", " ")
-            if verbose:
-                print("TARGET - V2:\n", targ_annotation)
-                print("New query:", newq)
+        # counters of the searches of this query, apart from the concurrent ones
+        with self.vdbs.query_state() as state:
+            # target annotation
+            # n-grams inside temporal and location spans are not searched
+            covered = covered_texts(combined_annotations)
+            targ_span, targ_results = self.vdbs.query_ngram_target(query_tokens.text(), threshold=0.7, covered=covered)
+            if len(targ_span) > 1 :
+                targ_spans, pos = find_spans(targ_span, query_tokens)
+                targ_annotation = self.create_target_annotation([targ_spans, pos, targ_results])
+                combined_annotations.append(targ_annotation)
+                # remove target annotations from newq
+                query_tokens.consume_span(targ_span)
+                if verbose:
+                    print("TARGET - V2:\n", targ_annotation)
+                    print("New query:", query_tokens.text())
         
-        # property annotation
-        prop_span, prop_results = self.vdbs.query_ngram_prop(newq, threshold=0.7)
-        if len(prop_span) > 1:
-            prop_spans, pos = find_spans(prop_span, nlq)
-            prop_annotation = self.create_property_annotation([prop_spans, pos, prop_results])
-            combined_annotations.append(prop_annotation)
-            if verbose:
-                print("PROPERTY - V2:\n", prop_annotation)
+            # property annotation
+            prop_span, prop_results = self.vdbs.query_ngram_prop(query_tokens.text(), threshold=0.7, covered=covered)
+            if len(prop_span) > 1:
+                prop_spans, pos = find_spans(prop_span, query_tokens)
+                prop_annotation = self.create_property_annotation([prop_spans, pos, prop_results])
+                combined_annotations.append(prop_annotation)
+                if verbose:
+                    print("PROPERTY - V2:\n", prop_annotation)
+
+        LAST_QUERY_STATS.set({"search_stats": state.search_stats})
+        if verbose:
+            print_search_stats(state.search_stats)
         
         # sort and return
         if len(combined_annotations) >1:
@@ -380,24 +747,8 @@ class V2_pipeline(NL2QueryInterface):
 
     def run_ceda_queries(self, write_out:bool=False):
         """run V2 instance on ceda evaluation dataset"""
-        path = os.path.dirname(os.path.realpath(__file__))
-        qfile =  os.path.join(path, "../../nl2q_eval/ceda_gold_queries.json")
-        struct_results = []
-        with open(qfile, 'r', encoding="utf-8") as f:
-            qs = json.load(f)
-            if 'queries' in qs.keys():
-                qlist = qs['queries']
-                # iterate over queries
-                for q in qlist:
-                    print("\n"+q['query'])
-                    res = self.transform_nl2query(q['query'])
-                    # print(res)
-                    struct_results.append(res.to_dict())
-            if write_out:
-                ofile = path + "v2_ceda_test_results.json"
-                with open(ofile, 'w', encoding="utf-8") as f:
-                    json.dump({'queries': struct_results}, f, indent=2)
-        return struct_results
+        ofile = os.path.join(os.path.dirname(os.path.realpath(__file__)), "v2_ceda_test_results.json") if write_out else None
+        return run_ceda_queries(self.transform_nl2query_batch, ofile)
 
 
 if __name__ == "__main__":
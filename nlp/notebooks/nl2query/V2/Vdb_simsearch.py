@@ -1,9 +1,20 @@
-import os
+import contextvars
+import csv
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence
 
+import numpy as np
+import torch
 from langchain.document_loaders.csv_loader import CSVLoader
 from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.text_splitter import CharacterTextSplitter
-from langchain.vectorstores import Chroma
+
+from nl2query.artifacts import resolve
+from nl2query.cache import cached_call
+from nl2query.metrics import timed_request
+from nl2query.tracing import traced
+from nl2query.V2.ngram_filter import PRUNE_STAGES, NgramFilter, normalize_text
+from nl2query.V2.vector_index import VectorIndex, get_vector_index
 
 
 def generate_ngrams(text, max_words):
@@ -23,19 +34,125 @@ def generate_ngrams(text, max_words):
     return output, ngrams_dict
 
 
+ENCODINGS = ["ngram", "span_pooled"]
+EMBEDDING_MODEL = "intfloat/e5-base-v2"
+# state of the vector searches of the query being annotated, set by Vdb_simsearch.query_state
+QUERY_STATE = contextvars.ContextVar("QUERY_STATE", default=None)
+
+
+def pooling_position(modules: Sequence[torch.nn.Module]) -> int:
+    """position of the mean Pooling module of a sentence-transformers encoder,
+    found by type name so that sentence_transformers is only imported by langchain"""
+    for i, module in enumerate(modules):
+        if type(module).__name__ == "Pooling":
+            if not getattr(module, "pooling_mode_mean_tokens", True):
+                raise ValueError("The span_pooled encoding needs an encoder with mean pooling!")
+            return i
+    raise ValueError("The span_pooled encoding needs an encoder with a Pooling module!")
+
+
+def load_embeddings(snapshot: bool = False) -> HuggingFaceEmbeddings:
+    """e5 encoder, from the artifact store if prefetched,
+    and from its memory-mapped snapshot if enabled"""
+    model_name = resolve(EMBEDDING_MODEL) or EMBEDDING_MODEL
+    model_kwargs = {'device': 'cpu'}
+    encode_kwargs = {'normalize_embeddings': False}
+
+    def load():
+        return HuggingFaceEmbeddings(model_name=model_name, model_kwargs=model_kwargs, encode_kwargs=encode_kwargs)
+    if not snapshot:
+        return load()
+    from nl2query.snapshots import load_or_snapshot
+    return load_or_snapshot(EMBEDDING_MODEL, model_name, load, get_module=lambda embeddings: embeddings.client,
+                            set_module=lambda client: HuggingFaceEmbeddings.construct(
+                                client=client, model_name=model_name, model_kwargs=model_kwargs,
+                                encode_kwargs=encode_kwargs))
+
+
+def build_target_index(vocab_file: str) -> dict:
+    """Read the target vocabulary csv and map the normalized
+    varname and each of its aliases to the result string
+    returned by a target similarity search (varname, aliases)"""
+    index = {}
+    with open(vocab_file, "r", encoding="utf-8") as f:
+        reader = csv.DictReader(f, delimiter="#", quotechar='"')
+        for row in reader:
+            varname = (row.get("varname") or "").strip()
+            aliases = (row.get("aliases") or "").strip()
+            if not varname:
+                continue
+            rel = varname + (", " + aliases if aliases else "")
+            keys = [varname] + aliases.split(", ") if aliases else [varname]
+            for key in keys:
+                key = normalize_text(key)
+                if key and rel not in index.setdefault(key, []):
+                    index[key].append(rel)
+    return index
+
+
+def build_prop_index(vocab_file: str) -> dict:
+    """Read the property vocabulary csv and map the normalized
+    propval (name::value) to the propval.
+    The value alone is not indexed, being ambiguous between properties"""
+    index = {}
+    with open(vocab_file, "r", encoding="utf-8") as f:
+        reader = csv.DictReader(f, delimiter="#", quotechar='"')
+        for row in reader:
+            propval = (row.get("propval") or "").strip()
+            if not propval:
+                continue
+            key = normalize_text(propval)
+            if key and propval not in index.setdefault(key, []):
+                index[key].append(propval)
+    return index
+
+
+class QueryState:
+    """ class definition of the state of the vector searches of one query:
+    the search counters and the n-gram embeddings prefetched """
+
+    def __init__(self):
+        self.search_stats = Vdb_simsearch.new_search_stats()
+        self.prefetched = {}
+
+
 class Vdb_simsearch():
     """ class to handle vector database """
     
-    def __init__(self, prop_vdb_path, prop_vocab_file, targ_vdb_path, targ_vocab_file) -> None:
+    def __init__(self, prop_vdb_path, prop_vocab_file, targ_vdb_path, targ_vocab_file,
+                 exact_match: bool = True, backend: str = "chroma", mmap: bool = True,
+                 index_params: Optional[dict] = None, encoding: str = "ngram",
+                 ngram_filter: Optional[NgramFilter] = None, snapshot: bool = False) -> None:
         self.prop_vdb_path = prop_vdb_path
         self.prop_vocab_file = prop_vocab_file
         self.targ_vdb_path = targ_vdb_path
         self.targ_vocab_file = targ_vocab_file
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name='intfloat/e5-base-v2',
-            model_kwargs={'device': 'cpu'},
-            encode_kwargs={'normalize_embeddings': False}
-        )
+        # exact string index answering n-grams without embedding search
+        self.exact_match = exact_match
+        self.targ_exact_index = {}
+        self.prop_exact_index = {}
+        if self.exact_match:
+            self.targ_exact_index = build_target_index(self.targ_vocab_file)
+            self.prop_exact_index = build_prop_index(self.prop_vocab_file)
+        # prune query n-grams before searching them
+        self.ngram_filter = ngram_filter
+        # count n-grams answered by the exact index, by a vector search or pruned,
+        # and n-gram embeddings computed ahead of the searches (see prefetch_embeddings),
+        # per query (see query_state), this state being used by the calls outside of a query
+        self.default_state = QueryState()
+        # vector index backend (chroma, exact, hnswlib or faiss) and its parameters
+        self.backend = backend
+        self.mmap = mmap
+        self.index_params = index_params or {}
+        # n-gram encoding mode: "ngram" embeds every n-gram text separately,
+        # "span_pooled" pools the n-gram spans of a single forward pass of the query
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown n-gram encoding [{encoding}]! Must be one of: {ENCODINGS}")
+        self.encoding = encoding
+        # result cache of the n-gram searches, set by the pipeline
+        self.result_cache = None
+        self.cache_fingerprint = ""
+        self.embeddings = load_embeddings(snapshot)
         self.text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
         
         # set up property vdb
@@ -55,25 +172,164 @@ class Vdb_simsearch():
         self.targ_db = self.get_vdb(self.targ_vdb_path, self.targ_csv_loader, self.text_splitter, self.embeddings)
 
 
-    def get_vdb(self, db_dir, csv_loader, text_splitter, embeddings):
-        """Create or read existing vdb from given directory"""
-        if os.path.exists(db_dir):
-            print("Loading Chroma Vdb from...", db_dir)
-            return Chroma(persist_directory=db_dir, embedding_function=embeddings)
-        else:
-            print("Creating Chroma Vdb at...", db_dir)
-            documents = csv_loader.load()
-            texts = text_splitter.split_documents(documents)
-            db = Chroma.from_documents(texts, embedding=embeddings, persist_directory=db_dir)
-            # Save vector database as persistent files in the output folder
-            db.persist()
-            return db
+    def get_vdb(self, db_dir, csv_loader, text_splitter, embeddings) -> VectorIndex:
+        """Create or read existing vdb from given directory
+        with the configured vector index backend"""
+        return get_vector_index(self.backend, db_dir, csv_loader, text_splitter, embeddings,
+                                mmap=self.mmap, params=dict(self.index_params))
+
+    def share_memory(self) -> int:
+        """move the in-memory vector matrices of both databases to shared memory, return the bytes moved"""
+        return self.prop_db.share_memory() + self.targ_db.share_memory()
+
+    @staticmethod
+    def new_search_stats() -> dict:
+        stats = {"exact_hits": 0, "vector_searches": 0}
+        stats.update({"pruned_" + stage: 0 for stage in PRUNE_STAGES})
+        return stats
+
+    @contextmanager
+    def query_state(self) -> Iterator[QueryState]:
+        """State of the vector searches of a query, kept apart from the concurrent queries.
+        The stages run in a copy of the context (see nl2query.tracing.in_context) share it."""
+        state = QueryState()
+        token = QUERY_STATE.set(state)
+        try:
+            yield state
+        finally:
+            QUERY_STATE.reset(token)
+
+    def state(self) -> QueryState:
+        return QUERY_STATE.get() or self.default_state
+
+    @property
+    def search_stats(self) -> dict:
+        return self.state().search_stats
+
+    @search_stats.setter
+    def search_stats(self, search_stats: dict) -> None:
+        self.state().search_stats = search_stats
+
+    @property
+    def prefetched(self) -> dict:
+        return self.state().prefetched
+
+    @prefetched.setter
+    def prefetched(self, prefetched: dict) -> None:
+        self.state().prefetched = prefetched
+
+    def reset_search_stats(self) -> dict:
+        """reset the search counters, return the previous ones"""
+        state = self.state()
+        stats, state.search_stats = state.search_stats, self.new_search_stats()
+        return stats
+
+    def prune_ngrams(self, ngrams_list: List[str], covered: Optional[List[str]] = None):
+        """Apply the n-gram filter before searching.
+        Return the duplicate n-grams mapped to their searched
+        equivalent, and the set of pruned n-grams."""
+        if not self.ngram_filter:
+            return {}, set()
+        _, duplicates, pruned, stats = self.ngram_filter.filter(ngrams_list, covered)
+        for stage, count in stats.items():
+            self.search_stats["pruned_" + stage] += count
+        return duplicates, pruned
+
+    @traced("embed")
+    def span_pooled_embeddings(self, query: str, max_words: int) -> Dict[str, np.ndarray]:
+        """Run the query once through the encoder and mean-pool the
+        token hidden states of each 1 to max_words-gram span.
+        The full query is pooled over all its tokens like the sentence encoder does.
+        Return a dict of n-gram text to embedding vector."""
+        words = query.split()
+        if not words:
+            return {}
+        modules = list(self.embeddings.client)
+        pooling = pooling_position(modules)
+        transformer = modules[0]
+        encoded = transformer.tokenizer(words, is_split_into_words=True, truncation=True,
+                                        max_length=transformer.max_seq_length, return_tensors="pt")
+        word_ids = encoded.word_ids()
+        with torch.no_grad():
+            features = dict(encoded)
+            features["token_embeddings"] = transformer.auto_model(**encoded).last_hidden_state
+            # apply the modules between the transformer and the pooling to the token embeddings
+            for module in modules[1:pooling]:
+                features = module(features)
+            hidden = features["token_embeddings"][0]
+
+            def finalize(vector):
+                # apply the modules following the pooling (ex: Dense, Normalize)
+                features = {"sentence_embedding": vector.unsqueeze(0)}
+                for module in modules[pooling + 1:]:
+                    features = module(features)
+                return features["sentence_embedding"][0].numpy()
+
+            vectors = {query: finalize(hidden.mean(dim=0))}
+            for n in range(1, max_words + 1):
+                for i in range(len(words) - n + 1):
+                    ngram = " ".join(words[i:i + n])
+                    if ngram in vectors:
+                        continue
+                    tokens = [t for t, w in enumerate(word_ids) if w is not None and i <= w < i + n]
+                    # truncated spans are left to the per n-gram encoding
+                    if tokens:
+                        vectors[ngram] = finalize(hidden[tokens].mean(dim=0))
+        return vectors
+
+    @traced("embed")
+    def prefetch_embeddings(self, query: str, max_words: int = 3) -> int:
+        """Embed the n-grams of a query in a single batch, to be reused
+        by the following n-gram searches until clear_prefetched.
+        Only used by the per n-gram encoding. Return the number of n-grams embedded."""
+        if self.encoding != "ngram":
+            return 0
+        ngrams_list, _ = generate_ngrams(query, max_words)
+        pruned = set()
+        if self.ngram_filter:
+            _, _, pruned, _ = self.ngram_filter.filter(ngrams_list)
+        texts = list(dict.fromkeys(n for n in ngrams_list + [query] if n not in pruned))
+        if not texts:
+            return 0
+        vectors = self.embeddings.embed_documents(texts)
+        self.prefetched = dict(zip(texts, vectors))
+        return len(texts)
+
+    def clear_prefetched(self) -> None:
+        self.prefetched = {}
+
+    def ngram_embeddings(self, query: str, max_words: int) -> Dict[str, np.ndarray]:
+        """embeddings precomputed for the n-grams of a query,
+        the prefetched ones when every n-gram is encoded separately"""
+        if self.encoding == "span_pooled":
+            return self.span_pooled_embeddings(query, max_words)
+        return self.prefetched
+
+    def exact_target(self, query: str):
+        """look up a query in the exact target index.
+        Return (results, scores) with a score of 1.0 or None if not found"""
+        rel_docs = self.targ_exact_index.get(normalize_text(query))
+        if not rel_docs:
+            return None
+        return list(rel_docs), [1.0] * len(rel_docs)
+
+    def exact_prop(self, query: str):
+        """look up a query in the exact property index.
+        Return a list of (propval, 1.0) or None if not found"""
+        rel_docs = self.prop_exact_index.get(normalize_text(query))
+        if not rel_docs:
+            return None
+        return [(v, 1.0) for v in rel_docs]
         
 
-    def query_one_target(self, query:str, k:int=15, score_t:float=0.72, verbose:bool=False):
-        relevant = self.targ_db.similarity_search_with_relevance_scores(query, k=k, 
-                                                                    include_metadata=True, 
-                                                                    score_threshold=score_t)
+    @traced("vector_search")
+    @timed_request("vector_db")
+    def query_one_target(self, query:str, k:int=15, score_t:float=0.72, verbose:bool=False,
+                         embedding: Optional[Sequence[float]] = None):
+        if embedding is None:
+            relevant = self.targ_db.search(query, k=k, score_t=score_t)
+        else:
+            relevant = self.targ_db.search_vector(embedding, k=k, score_t=score_t)
         rel_docs = []
         scores = []
         if verbose:
@@ -81,7 +337,7 @@ class Vdb_simsearch():
             print("RESULTS: ", len(relevant))
         for (t,score) in relevant:
             rel = ""
-            result = t.page_content.split("\n")
+            result = t.split("\n")
             v = result[0]
             a = result[1]
             if v.startswith("varname: "):
@@ -97,15 +353,54 @@ class Vdb_simsearch():
         return rel_docs, scores
 
 
-    def query_ngram_target(self, query:str, ngrams:int=3, threshold:float=0.72, verbose:bool=False):
+    def query_ngram_target(self, query:str, ngrams:int=3, threshold:float=0.72, verbose:bool=False,
+                           covered: Optional[List[str]] = None):
+        """best target span and results of the query n-grams, cached if the vdbs have a result cache"""
+        return cached_call(None if verbose else self.result_cache, "query_ngram_target", self.cache_fingerprint,
+                           lambda: self.search_ngram_target(query, ngrams, threshold, verbose, covered),
+                           [query, ngrams, threshold, covered])
+
+    @traced("target_search")
+    def search_ngram_target(self, query:str, ngrams:int=3, threshold:float=0.72, verbose:bool=False,
+                            covered: Optional[List[str]] = None):
         # generate ngrams up to length 3 by default
+        max_words = ngrams
         ngrams_list, ngrams_dict = generate_ngrams(query, ngrams) 
         ngrams_list += [query]
+        duplicates, pruned = self.prune_ngrams(ngrams_list, covered)
         ngram_results = {}
         ngram_scores = {}
+        # n-grams answered by the exact index
+        exact_spans = set()
+        vectors = None
         for ngrams in ngrams_list:
+            if ngrams in ngram_results and self.ngram_filter:
+                # repeated n-gram
+                continue
+            if ngrams in pruned:
+                ngram_results[ngrams], ngram_scores[ngrams] = [], []
+                continue
+            if ngrams in duplicates:
+                # same normalized n-gram was searched before
+                ngram_results[ngrams] = list(ngram_results[duplicates[ngrams]])
+                ngram_scores[ngrams] = list(ngram_scores[duplicates[ngrams]])
+                if duplicates[ngrams] in exact_spans:
+                    exact_spans.add(ngrams)
+                continue
             # remember which results come from which query to identify span
-            ngram_results[ngrams], ngram_scores[ngrams] = self.query_one_target(ngrams, score_t=threshold, verbose=verbose)
+            exact = self.exact_target(ngrams)
+            if exact:
+                self.search_stats["exact_hits"] += 1
+                exact_spans.add(ngrams)
+                ngram_results[ngrams], ngram_scores[ngrams] = exact
+                if verbose:
+                    print("\nEXACT MATCH: ", ngrams, exact[0])
+                continue
+            self.search_stats["vector_searches"] += 1
+            if vectors is None:
+                vectors = self.ngram_embeddings(query, max_words)
+            ngram_results[ngrams], ngram_scores[ngrams] = self.query_one_target(ngrams, score_t=threshold, verbose=verbose,
+                                                                                embedding=vectors.get(ngrams))
                 
         # join ngram results
         if verbose:
@@ -118,6 +413,9 @@ class Vdb_simsearch():
         max_span = ""
         
         for k,v in ngram_results.items():
+            if k in pruned:
+                # pruned n-grams cannot be selected as span
+                continue
             if verbose:
                 print("")
                 print(k, len(v))
@@ -146,6 +444,11 @@ class Vdb_simsearch():
                 max_span = k
             if verbose:
                 print("LEN :", len(join_results[k]))
+        exact_spans = [k for k in join_results if k in exact_spans]
+        if exact_spans:
+            # exact matches rank first (score 1.0) whatever their number of results, the longest span first
+            max_span = max(exact_spans, key=lambda k: len(k.split()))
+            max_len = len(join_results[max_span])
         if verbose:
             print("\nBEST RESULT:")
             print(max_len, max_span, join_results[max_span])
@@ -158,15 +461,18 @@ class Vdb_simsearch():
             return "", ""
 
 
-    def query_one_prop(self, query, k=5, score_t=0.72, verbose=False):
+    @traced("vector_search")
+    @timed_request("vector_db")
+    def query_one_prop(self, query, k=5, score_t=0.72, verbose=False, embedding=None):
         if verbose:
             print("\nQUERY: ", query)
-        relevant = self.prop_db.similarity_search_with_relevance_scores(query, k=k, 
-                                                                    include_metadata=True, 
-                                                                    score_threshold=score_t)
+        if embedding is None:
+            relevant = self.prop_db.search(query, k=k, score_t=score_t)
+        else:
+            relevant = self.prop_db.search_vector(embedding, k=k, score_t=score_t)
         rel_docs = []
         for (t,score) in relevant:
-            v = t.page_content.split("\n")[0]
+            v = t.split("\n")[0]
             if v.startswith("propval: "):
                 v = v[9:]
             if verbose:
@@ -175,14 +481,44 @@ class Vdb_simsearch():
         return rel_docs
 
 
-    def query_ngram_prop(self, query, ngrams=3, threshold=0.6, verbose=False):
+    def query_ngram_prop(self, query, ngrams=3, threshold=0.6, verbose=False, covered=None):
+        """best property span and results of the query n-grams, cached if the vdbs have a result cache"""
+        return cached_call(None if verbose else self.result_cache, "query_ngram_prop", self.cache_fingerprint,
+                           lambda: self.search_ngram_prop(query, ngrams, threshold, verbose, covered),
+                           [query, ngrams, threshold, covered])
+
+    @traced("property_search")
+    def search_ngram_prop(self, query, ngrams=3, threshold=0.6, verbose=False, covered=None):
         collect_results = []
         # generate ngrams up to length 3
+        max_words = ngrams
         ngrams_list, _ = generate_ngrams(query, ngrams)
         ngrams_list += [query]
+        duplicates, pruned = self.prune_ngrams(ngrams_list, covered)
         ngram_results = {}
+        vectors = None
         for ngrams in ngrams_list:
-            rel_docs = self.query_one_prop(ngrams, score_t=threshold, verbose=verbose)
+            if ngrams in ngram_results and self.ngram_filter:
+                # repeated n-gram
+                continue
+            if ngrams in pruned:
+                ngram_results[ngrams] = []
+                continue
+            if ngrams in duplicates:
+                # same normalized n-gram was searched before
+                ngram_results[ngrams] = list(ngram_results[duplicates[ngrams]])
+                continue
+            rel_docs = self.exact_prop(ngrams)
+            if rel_docs:
+                self.search_stats["exact_hits"] += 1
+                if verbose:
+                    print("\nEXACT MATCH: ", ngrams, rel_docs)
+            else:
+                self.search_stats["vector_searches"] += 1
+                if vectors is None:
+                    vectors = self.ngram_embeddings(query, max_words)
+                rel_docs = self.query_one_prop(ngrams, score_t=threshold, verbose=verbose,
+                                               embedding=vectors.get(ngrams))
             # remember which results come from wihch query to identify span
             if len(rel_docs) > 0:
                 ngram_results[ngrams] = rel_docs
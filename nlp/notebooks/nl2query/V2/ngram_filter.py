@@ -0,0 +1,71 @@
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# pruning stages, in the order they are checked
+PRUNE_STAGES = ["stopwords", "numeric", "min_chars", "covered", "duplicate"]
+
+
+def normalize_text(text: str) -> str:
+    """lowercase, replace underscores by spaces and collapse
+    whitespaces so that query n-grams and vocabulary entries
+    can be compared as exact strings"""
+    return " ".join(text.replace("_", " ").lower().split())
+
+
+class NgramFilter:
+    """ class to prune the query n-grams before the vector searches:
+    - stopwords: n-grams made only of stopwords
+    - numeric: n-grams without any letter (numbers, punctuation)
+    - min_chars: n-grams shorter than min_chars (ignoring spaces)
+    - covered: n-grams inside an already annotated span (temporal, location)
+    - duplicate: n-grams equal to a previous one once normalized
+    """
+
+    def __init__(self, stopwords: Optional[Iterable[str]] = None, numeric: bool = True,
+                 min_chars: int = 2, covered: bool = True, dedup: bool = True) -> None:
+        self.stopwords = set(word.lower() for word in stopwords) if stopwords else set()
+        self.numeric = numeric
+        self.min_chars = min_chars
+        self.covered = covered
+        self.dedup = dedup
+
+    def prune_stage(self, ngram: str, covered_texts: List[str]) -> Optional[str]:
+        """return the stage pruning this normalized n-gram, or None to keep it"""
+        words = ngram.split()
+        if self.stopwords and all(word in self.stopwords for word in words):
+            return "stopwords"
+        if self.numeric and not any(c.isalpha() for c in ngram):
+            return "numeric"
+        if len(ngram.replace(" ", "")) < self.min_chars:
+            return "min_chars"
+        if self.covered and any(f" {ngram} " in f" {text} " for text in covered_texts):
+            return "covered"
+        return None
+
+    def filter(self, ngrams: List[str], covered: Optional[List[str]] = None
+               ) -> Tuple[List[str], Dict[str, str], Set[str], Dict[str, int]]:
+        """Filter the n-grams to search.
+        covered is a list of the texts of existing annotations.
+        Return the n-grams to search, a mapping of duplicate n-grams
+        to the searched n-gram with the same normalized text,
+        the set of pruned n-grams and the count of pruned n-grams per stage."""
+        covered_texts = [normalize_text(text) for text in covered or [] if text]
+        stats = dict.fromkeys(PRUNE_STAGES, 0)
+        kept = []
+        duplicates = {}
+        pruned = set()
+        seen = {}
+        for ngram in ngrams:
+            norm = normalize_text(ngram)
+            stage = self.prune_stage(norm, covered_texts)
+            if stage is None and self.dedup and norm in seen:
+                if seen[norm] != ngram:
+                    duplicates[ngram] = seen[norm]
+                stage = "duplicate"
+            if stage:
+                stats[stage] += 1
+                if stage != "duplicate":
+                    pruned.add(ngram)
+                continue
+            seen[norm] = ngram
+            kept.append(ngram)
+        return kept, duplicates, pruned, stats
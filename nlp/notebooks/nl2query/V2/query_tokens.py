@@ -0,0 +1,147 @@
+import bisect
+import re
+from typing import FrozenSet, List, Optional, Tuple, Union
+
+
+class QueryTokens:
+    """ class of the whitespace tokens of a query, built once per query:
+    - query: original query, the positions of the tokens refer to it
+    - stopwords: lowercase stopwords to mask
+    - remove: characters removed from the tokens (ex: parentheses and commas)
+    The annotated spans are consumed instead of being cut out of the query string,
+    text() is the query left to annotate. The remaining tokens, their rank and offset
+    in text() are updated by consume, so that the lookups do not scan the tokens.
+    """
+
+    def __init__(self, query: str, stopwords: Optional[FrozenSet[str]] = None, remove: str = ""):
+        self.query = query
+        self.tokens = []  # type: List[str]
+        self.starts = []  # type: List[int]
+        self.ends = []  # type: List[int]
+        table = str.maketrans("", "", remove)
+        for match in re.finditer(r"\S+", query):
+            token = match.group().translate(table)
+            if not token:
+                continue
+            raw = match.group()
+            # offsets without the removed characters at the ends of the token
+            self.starts.append(match.start() + len(raw) - len(raw.lstrip(remove)) if remove else match.start())
+            self.ends.append(match.end() - len(raw) + len(raw.rstrip(remove)) if remove else match.end())
+            self.tokens.append(token)
+        self.stopword = [token.lower() in stopwords for token in self.tokens] if stopwords \
+            else [False] * len(self.tokens)
+        self.consumed = [False] * len(self.tokens)
+        # token -> its indices, in query order
+        self.index = {}
+        for i, token in enumerate(self.tokens):
+            self.index.setdefault(token, []).append(i)
+        self.update_remaining()
+
+    def copy(self) -> "QueryTokens":
+        """copy sharing the tokens, with its own consumed mask"""
+        tokens = QueryTokens.__new__(QueryTokens)
+        tokens.__dict__.update(self.__dict__)
+        tokens.consumed = list(self.consumed)
+        return tokens
+
+    def update_remaining(self) -> None:
+        """indices of the tokens not consumed, their rank and offset in text() and text(),
+        new lists shared with the copies until their next consume"""
+        self.remaining_indices = [i for i, consumed in enumerate(self.consumed) if not consumed]
+        self.rank = {i: r for r, i in enumerate(self.remaining_indices)}
+        self.offsets = []
+        offset = 0
+        for i in self.remaining_indices:
+            self.offsets.append(offset)
+            offset += len(self.tokens[i]) + 1
+        self.remaining_text = " ".join(self.tokens[i] for i in self.remaining_indices)
+
+    def remaining(self, skip_stopwords: bool = False) -> List[int]:
+        """indices of the tokens not consumed (nor stopwords if skip_stopwords)"""
+        if not skip_stopwords:
+            return list(self.remaining_indices)
+        return [i for i in self.remaining_indices if not self.stopword[i]]
+
+    def text(self, skip_stopwords: bool = False) -> str:
+        """query left to annotate, tokens separated by single spaces"""
+        if not skip_stopwords:
+            return self.remaining_text
+        return " ".join(self.tokens[i] for i in self.remaining(skip_stopwords))
+
+    def __str__(self) -> str:
+        return self.text()
+
+    def consume_stopwords(self) -> None:
+        self.consume([i for i, stopword in enumerate(self.stopword) if stopword])
+
+    def consume(self, indices: List[int]) -> None:
+        indices = [i for i in indices if not self.consumed[i]]
+        for i in indices:
+            self.consumed[i] = True
+        if indices:
+            self.update_remaining()
+
+    def match(self, span: str) -> Optional[List[int]]:
+        """indices of the first run of remaining tokens equal to the words of the span, None if not found"""
+        words = span.split()
+        if not words:
+            return None
+        for first in self.index.get(words[0], []):
+            rank = self.rank.get(first)
+            if rank is None:
+                continue
+            run = self.remaining_indices[rank:rank + len(words)]
+            if [self.tokens[i] for i in run] == words:
+                return run
+        return None
+
+    def consume_span(self, span: str) -> bool:
+        """consume the remaining tokens of a span (see locate), False if not found"""
+        indices = self.locate(span)
+        self.consume(indices or [])
+        return indices is not None
+
+    def text_range(self, start: int, end: int) -> List[int]:
+        """indices of the remaining tokens overlapping characters [start, end) of text()"""
+        # last token starting at or before start, or the next one if it ends before start
+        first = max(bisect.bisect_right(self.offsets, start) - 1, 0)
+        if first < len(self.offsets) and self.offsets[first] + len(self.tokens[self.remaining_indices[first]]) <= start:
+            first += 1
+        # tokens starting before end
+        last = bisect.bisect_left(self.offsets, end)
+        return self.remaining_indices[first:last]
+
+    def map_range(self, start: int, end: int) -> Tuple[List[int], List[int]]:
+        """indices of the remaining tokens overlapping characters [start, end) of text(),
+        and the position of the range in the query"""
+        indices = self.text_range(start, end)
+        if not indices:
+            return indices, [start, end]
+        first, last = indices[0], indices[-1]
+        return indices, [self.starts[first] + max(start - self.offsets[self.rank[first]], 0),
+                         min(self.starts[last] + end - self.offsets[self.rank[last]], self.ends[last])]
+
+    def locate(self, span: str) -> Optional[List[int]]:
+        """indices of the remaining tokens of a span: the run of its words,
+        otherwise the tokens overlapping its first occurrence in text(), None if not in text()"""
+        indices = self.match(span)
+        if indices is None:
+            start = self.text().find(span) if span else -1
+            if start >= 0:
+                indices = self.text_range(start, start + len(span))
+        return indices
+
+    def positions(self, indices: List[int]) -> Tuple[Union[str, List[str]], List]:
+        """spans and positions in the query of tokens, as find_spans:
+        the span and [start, end] if contiguous, otherwise the list of spans and their positions"""
+        runs = []
+        for i in indices:
+            if runs and i == runs[-1][1] + 1:
+                runs[-1][1] = i
+            else:
+                runs.append([i, i])
+        pos = [[self.starts[first], self.ends[last]] for first, last in runs]
+        spans = [self.query[start:end] for start, end in pos]
+        if len(runs) == 1:
+            return spans[0], pos[0]
+        return spans, pos
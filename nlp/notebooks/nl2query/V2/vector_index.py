@@ -0,0 +1,355 @@
+"""
+Vector index backends used by Vdb_simsearch.
+
+The default backend is the persisted Chroma database used since V2.
+For vocabularies with hundreds of thousands to millions of rows, the
+vectors can instead be stored as a memory-mapped matrix and searched with
+an exact (numpy), HNSW (hnswlib) or FAISS (IVF/HNSW) index persisted next to it.
+
+All backends return (page_content, relevance score) pairs where the score
+is computed from the squared L2 distance like Chroma does, so that
+results and thresholds of every backend are comparable.
+"""
+import json
+import math
+import mmap
+import os
+from abc import ABC, abstractmethod
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+BACKENDS = ["chroma", "exact", "hnswlib", "faiss"]
+INDEX_PARAMS = ["hnsw_m", "ef_construction", "ef_search", "factory", "nprobe", "train_size"]
+# number of documents embedded at once when building an index
+EMBED_BATCH = 10000
+# default number of vectors sampled to train a faiss index (IVF centroids), about 100 per list of IVF4096
+TRAIN_SIZE = 100 * 4096
+
+
+def relevance_score(distance: float) -> float:
+    """convert a squared L2 distance into a relevance score,
+    same as langchain does for a Chroma 'l2' collection"""
+    return 1.0 - distance / math.sqrt(2)
+
+
+def write_matrix_files(db_dir: str, contents: List[str], vector_batches: Iterable[Sequence[Sequence[float]]],
+                       dim: int = 0) -> None:
+    """Write the texts and vectors files of a matrix index.
+    The vectors are given by consecutive batches and written straight
+    to disk to support vocabularies larger than memory.
+    dim is the dimension of the vectors matrix if there are no vectors."""
+    os.makedirs(db_dir, exist_ok=True)
+    offsets = [0]
+    with open(os.path.join(db_dir, "texts.bin"), "wb") as f:
+        for content in contents:
+            data = content.encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(os.path.join(db_dir, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    vectors_file = os.path.join(db_dir, "vectors.npy")
+    vectors = None
+    start = 0
+    for batch in vector_batches:
+        batch = np.asarray(batch, dtype=np.float32)
+        if vectors is None:
+            vectors = np.lib.format.open_memmap(vectors_file + ".tmp", mode="w+", dtype=np.float32,
+                                                shape=(len(contents), batch.shape[1]))
+        vectors[start:start + len(batch)] = batch
+        start += len(batch)
+    if vectors is None:
+        vectors = np.lib.format.open_memmap(vectors_file + ".tmp", mode="w+", dtype=np.float32,
+                                            shape=(len(contents), dim))
+    if start != len(contents):
+        raise ValueError(f"{start} vectors given for {len(contents)} texts!")
+    vectors.flush()
+    del vectors
+    # only expose complete vectors files
+    os.replace(vectors_file + ".tmp", vectors_file)
+
+
+def shared_array(array: np.ndarray) -> np.ndarray:
+    """read-only copy of an array in anonymous shared memory, mapped by the forked processes without copy"""
+    buffer = mmap.mmap(-1, max(array.nbytes, 1))
+    shared = np.frombuffer(buffer, dtype=array.dtype, count=array.size).reshape(array.shape)
+    shared[...] = array
+    shared.flags.writeable = False
+    return shared
+
+
+class VectorIndex(ABC):
+    """ minimal interface of a vector index backend """
+
+    backend = None
+
+    def __init__(self, embeddings) -> None:
+        self.embeddings = embeddings
+
+    def embed_query(self, query: str) -> np.ndarray:
+        return np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+
+    def search(self, query: str, k: int, score_t: float) -> List[Tuple[str, float]]:
+        """search the k nearest documents of a text query,
+        return (page_content, score) above the score threshold"""
+        return self.search_vector(self.embed_query(query), k, score_t)
+
+    def share_memory(self) -> int:
+        """move the in-memory matrices to shared memory before forking workers, return the bytes moved"""
+        return 0
+
+    @abstractmethod
+    def search_vector(self, vector: Sequence[float], k: int, score_t: float) -> List[Tuple[str, float]]:
+        """search the k nearest documents of an embedding vector,
+        return (page_content, score) above the score threshold"""
+        pass
+
+
+class ChromaIndex(VectorIndex):
+    """ persisted langchain Chroma vector database """
+
+    backend = "chroma"
+
+    def __init__(self, db_dir: str, csv_loader, text_splitter, embeddings) -> None:
+        super().__init__(embeddings)
+        # imported here to avoid requiring chromadb with the other backends
+        from langchain.vectorstores import Chroma
+
+        if os.path.exists(db_dir):
+            print("Loading Chroma Vdb from...", db_dir)
+            self.db = Chroma(persist_directory=db_dir, embedding_function=embeddings)
+        else:
+            print("Creating Chroma Vdb at...", db_dir)
+            documents = csv_loader.load()
+            texts = text_splitter.split_documents(documents)
+            self.db = Chroma.from_documents(texts, embedding=embeddings, persist_directory=db_dir)
+            # Save vector database as persistent files in the output folder
+            self.db.persist()
+
+    def search(self, query: str, k: int, score_t: float) -> List[Tuple[str, float]]:
+        # the metadata are always returned, other keywords are passed to the chromadb query
+        relevant = self.db.similarity_search_with_relevance_scores(query, k=k, score_threshold=score_t)
+        return [(doc.page_content, score) for doc, score in relevant]
+
+    def search_vector(self, vector: Sequence[float], k: int, score_t: float) -> List[Tuple[str, float]]:
+        relevant = self.db.similarity_search_by_vector_with_relevance_scores(list(map(float, vector)), k=k)
+        # same distance to relevance conversion as the text search
+        score_fn = self.db._select_relevance_score_fn()
+        results = []
+        for doc, distance in relevant:
+            score = score_fn(distance)
+            if score_t is None or score >= score_t:
+                results.append((doc.page_content, score))
+        return results
+
+
+class MatrixIndex(VectorIndex):
+    """ base class for the backends persisted as files in a directory:
+    - texts.bin / offsets.npy: utf-8 page contents and their byte offsets
+    - vectors.npy: float32 embedding matrix
+    - index.json: backend name and parameters
+    plus the backend specific index file.
+    The texts and vectors are memory-mapped when mmap is enabled. """
+
+    def __init__(self, db_dir: str, csv_loader, text_splitter, embeddings,
+                 mmap: bool = True, **params) -> None:
+        super().__init__(embeddings)
+        self.db_dir = db_dir
+        self.mmap = mmap
+        self.params = params
+        if os.path.exists(os.path.join(db_dir, "vectors.npy")):
+            print("Loading", self.backend, "index from...", db_dir)
+        else:
+            print("Creating", self.backend, "index at...", db_dir)
+            self.write_vectors(csv_loader, text_splitter)
+        mmap_mode = "r" if mmap else None
+        self.offsets = np.load(os.path.join(db_dir, "offsets.npy"), mmap_mode=mmap_mode)
+        self.vectors = np.load(os.path.join(db_dir, "vectors.npy"), mmap_mode=mmap_mode)
+        # an empty file cannot be memory-mapped
+        self.texts = np.memmap(os.path.join(db_dir, "texts.bin"), dtype=np.uint8, mode="r") \
+            if mmap and self.offsets[-1] else np.fromfile(os.path.join(db_dir, "texts.bin"), dtype=np.uint8)
+        if not os.path.exists(self.index_file()):
+            self.build_index()
+        self.load_index()
+        if not os.path.exists(os.path.join(db_dir, "index.json")):
+            with open(os.path.join(db_dir, "index.json"), "w", encoding="utf-8") as f:
+                json.dump({"backend": self.backend, "count": len(self), "dim": self.vectors.shape[1],
+                           "params": self.params}, f, indent=2)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def share_memory(self) -> int:
+        # memory-mapped files are already shared through the page cache
+        if self.mmap:
+            return 0
+        self.offsets, self.vectors, self.texts = [shared_array(array) for array in
+                                                  [self.offsets, self.vectors, self.texts]]
+        return self.offsets.nbytes + self.vectors.nbytes + self.texts.nbytes
+
+    def text(self, i: int) -> str:
+        return bytes(self.texts[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def write_vectors(self, csv_loader, text_splitter) -> None:
+        """embed the vocabulary documents and write texts and vectors files"""
+        documents = text_splitter.split_documents(csv_loader.load())
+        contents = [doc.page_content for doc in documents]
+        write_matrix_files(self.db_dir, contents, (
+            self.embeddings.embed_documents(contents[start:start + EMBED_BATCH])
+            for start in range(0, len(contents), EMBED_BATCH)
+        ), dim=0 if contents else len(self.embed_query("")))
+
+    def index_file(self) -> str:
+        return os.path.join(self.db_dir, "index." + self.backend)
+
+    def build_index(self) -> None:
+        """build and persist the backend index from the vectors"""
+        pass
+
+    def load_index(self) -> None:
+        """load the persisted backend index"""
+        pass
+
+    @abstractmethod
+    def knn(self, vector: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """return the ids and squared L2 distances of the k nearest vectors"""
+        pass
+
+    def search_vector(self, vector: Sequence[float], k: int, score_t: float) -> List[Tuple[str, float]]:
+        k = min(k, len(self))
+        if k <= 0:
+            return []
+        ids, distances = self.knn(np.asarray(vector, dtype=np.float32), k)
+        results = []
+        for i, distance in zip(ids, distances):
+            if i < 0:
+                continue
+            score = relevance_score(float(distance))
+            if score_t is None or score >= score_t:
+                results.append((self.text(int(i)), score))
+        return results
+
+
+class ExactIndex(MatrixIndex):
+    """ brute force search over the (memory-mapped) vectors matrix,
+    reference for the recall of the approximate backends """
+
+    backend = "exact"
+
+    def index_file(self) -> str:
+        return os.path.join(self.db_dir, "vectors.npy")
+
+    def load_index(self) -> None:
+        self.norms = np.einsum("ij,ij->i", self.vectors, self.vectors)
+
+    def share_memory(self) -> int:
+        self.norms = shared_array(self.norms)
+        return super().share_memory() + self.norms.nbytes
+
+    def knn(self, vector: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(k, len(self))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        distances = self.norms - 2 * (self.vectors @ vector) + vector @ vector
+        ids = np.argpartition(distances, k - 1)[:k]
+        ids = ids[np.argsort(distances[ids])]
+        return ids, distances[ids]
+
+
+class HnswIndex(MatrixIndex):
+    """ hnswlib HNSW graph index,
+    params: hnsw_m, ef_construction, ef_search """
+
+    backend = "hnswlib"
+
+    def build_index(self) -> None:
+        import hnswlib
+
+        index = hnswlib.Index(space="l2", dim=self.vectors.shape[1])
+        index.init_index(max_elements=len(self), M=int(self.params.get("hnsw_m", 16)),
+                         ef_construction=int(self.params.get("ef_construction", 200)))
+        for start in range(0, len(self), EMBED_BATCH):
+            end = min(start + EMBED_BATCH, len(self))
+            index.add_items(np.asarray(self.vectors[start:end]), np.arange(start, end))
+        index.save_index(self.index_file())
+
+    def load_index(self) -> None:
+        import hnswlib
+
+        self.index = hnswlib.Index(space="l2", dim=self.vectors.shape[1])
+        self.index.load_index(self.index_file(), max_elements=len(self))
+        self.set_ef(int(self.params.get("ef_search", 64)))
+
+    def set_ef(self, ef: int) -> None:
+        """tune the recall/latency trade-off at query time"""
+        self.params["ef_search"] = ef
+        self.index.set_ef(ef)
+
+    def knn(self, vector: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        ids, distances = self.index.knn_query(vector, k=k)
+        return ids[0], distances[0]
+
+
+class FaissIndex(MatrixIndex):
+    """ FAISS CPU index, built from a factory string,
+    for example 'HNSW32' or 'IVF4096,Flat',
+    params: factory, nprobe (IVF), ef_search (HNSW), train_size (vectors sampled to train IVF) """
+
+    backend = "faiss"
+
+    def build_index(self) -> None:
+        import faiss
+
+        index = faiss.index_factory(self.vectors.shape[1], self.params.get("factory", "HNSW32"), faiss.METRIC_L2)
+        if not index.is_trained and len(self):
+            # train on vectors sampled evenly over the vocabulary (IVF centroids)
+            train_size = int(self.params.get("train_size", TRAIN_SIZE))
+            sample = np.asarray(self.vectors[::max(1, len(self) // train_size)][:train_size])
+            index.train(sample)
+        for start in range(0, len(self), EMBED_BATCH):
+            index.add(np.asarray(self.vectors[start:start + EMBED_BATCH]))
+        faiss.write_index(index, self.index_file())
+
+    def load_index(self) -> None:
+        import faiss
+
+        flags = faiss.IO_FLAG_MMAP if self.mmap else 0
+        try:
+            self.index = faiss.read_index(self.index_file(), flags)
+        except RuntimeError:
+            # not every index type supports memory-mapping
+            self.index = faiss.read_index(self.index_file())
+        self.set_nprobe(int(self.params.get("nprobe", 16)))
+        self.set_ef(int(self.params.get("ef_search", 64)))
+
+    def set_nprobe(self, nprobe: int) -> None:
+        """tune the number of IVF lists visited at query time"""
+        import faiss
+
+        self.params["nprobe"] = nprobe
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            ivf.nprobe = nprobe
+
+    def set_ef(self, ef: int) -> None:
+        """tune the HNSW search depth at query time"""
+        self.params["ef_search"] = ef
+        if hasattr(self.index, "hnsw"):
+            self.index.hnsw.efSearch = ef
+
+    def knn(self, vector: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        distances, ids = self.index.search(vector.reshape(1, -1), k)
+        return ids[0], distances[0]
+
+
+def get_vector_index(backend: str, db_dir: str, csv_loader, text_splitter, embeddings,
+                     mmap: bool = True, params: Optional[dict] = None) -> VectorIndex:
+    """Create or load the vector index of the given backend.
+    The Chroma database is kept in db_dir, other backends
+    are persisted in the db_dir_<backend> directory."""
+    if backend == "chroma":
+        return ChromaIndex(db_dir, csv_loader, text_splitter, embeddings)
+    index_classes = {"exact": ExactIndex, "hnswlib": HnswIndex, "faiss": FaissIndex}
+    if backend not in index_classes:
+        raise ValueError(f"Unknown vector index backend [{backend}]! Must be one of: {BACKENDS}")
+    return index_classes[backend](db_dir.rstrip("/\\") + "_" + backend, csv_loader, text_splitter, embeddings,
+                                  mmap=mmap, **(params or {}))
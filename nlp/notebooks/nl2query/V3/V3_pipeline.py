@@ -1,7 +1,11 @@
-import json
+import asyncio
 import os
+from typing import Dict, List, Optional
 
+from nl2query.cache import acached_transform, cached_call, cached_transform, cached_transform_batch, pipeline_cache
+from nl2query.fusion import AnnotationFusion
 from nl2query.NL2QueryInterface import (
+    Annotation,
     LocationAnnotation,
     NL2QueryInterface,
     PropertyAnnotation,
@@ -9,8 +13,22 @@ from nl2query.NL2QueryInterface import (
     TargetAnnotation,
     TemporalAnnotation
 )
+from nl2query.registry import shared
+from nl2query.runner import run_ceda_queries
+from nl2query.stage_graph import Stage, StageGraph
+from nl2query.threads import apply_thread_budget
+from nl2query.tracing import (
+    atraced_transform,
+    in_context,
+    pipeline_tracer,
+    span,
+    traced,
+    traced_transform,
+    traced_transform_batch
+)
 from nl2query.V1 import NER_flair, NER_spacy
 from nl2query.V2 import V2_pipeline
+from nl2query.V2.query_tokens import QueryTokens
 
 
 class V3_pipeline(NL2QueryInterface):
@@ -20,11 +38,37 @@ class V3_pipeline(NL2QueryInterface):
         # use V1 - spacy and V2
         if self.config.get("spacy", "config_file", fallback=None):
             spacy_config_file = self.config.get("spacy", "config_file")
-        self.v1_spacy = NER_spacy.NER_spacy(spacy_config_file)
+        self.v1_spacy = shared(NER_spacy.NER_spacy, spacy_config_file)
         if self.config.get("flair", "config_file", fallback=None):
             flair_config_file = self.config.get("flair", "config_file")
-        self.v1_flair = NER_flair.NER_flair(flair_config_file)  
+        self.v1_flair = shared(NER_flair.NER_flair, flair_config_file)  
         self.v2_instance = V2_pipeline.V2_pipeline(v2_config)
+        # thread budget of the V1 config, applied after the V2 one
+        self.thread_budget = apply_thread_budget(self.config)
+        # cache of the results and NER annotations by query, the V2 stages use the cache of the V2 pipeline
+        self.result_cache, self.cache_fingerprint = pipeline_cache(self.config, self.config_file,
+                                                                   self.v2_instance.config_file)
+        # the results depend on the spaCy model actually loaded (fallback or NL2QUERY_SPACY_MODEL)
+        self.cache_fingerprint += "/" + self.v1_spacy.model
+        # traces of the queries (see nl2query.tracing), the V2 stages are spans of the V3 traces
+        self.tracer = pipeline_tracer(self.config)
+        # run the independent stages concurrently on a thread pool
+        # merge of the spaCy and Flair annotations
+        self.fusion = AnnotationFusion.from_config(self.config, sources=["spacy", "flair"])
+        self.concurrent = self.config.getboolean("executor", "concurrent", fallback=True)
+        self.max_workers = self.config.getint("executor", "max_workers", fallback=4)
+        self.stage_graph = self.build_stage_graph()
+        self.batch_stage_graph = self.build_stage_graph(ner_stages=False)
+
+    @property
+    def search_stats(self) -> dict:
+        """search counters of the last query annotated in the current context (thread)"""
+        return V2_pipeline.LAST_QUERY_STATS.get().get("search_stats", {})
+
+    @property
+    def stage_timings(self) -> Dict[str, float]:
+        """per stage wall times of the last query annotated in the current context (thread)"""
+        return V2_pipeline.LAST_QUERY_STATS.get().get("stage_timings", {})
 
     def create_temporal_annotation(self, annotation) -> TemporalAnnotation:
         return self.v2_instance.create_temporal_annotation(annotation)
@@ -38,156 +82,286 @@ class V3_pipeline(NL2QueryInterface):
     def create_target_annotation(self, annotation) -> TargetAnnotation:
         return self.v2_instance.create_target_annotation(annotation)
 
-    def transform_nl2query(self, nlq: str, verbose:bool=False) -> QueryAnnotationsDict:
-        newq = nlq.replace("(", "")
-        newq = newq.replace(")", "")
-        newq = newq.replace(",", "")
-        if verbose:
-            print("New query:", newq)
-        # collect annotations
-        combined_annotations = []
-        
-        spacy_annotations = self.v1_spacy.transform_nl2query(nlq, verbose)
-        v1_results = spacy_annotations.annotations 
-        flair_annotations = self.v1_flair.transform_nl2query(nlq, verbose)
-        for annot in flair_annotations.annotations:
-            # if not already overlap
-            overlap = False
-            for v1_result in v1_results:
-                if range(max(v1_result.position[0], annot.position[0]), min(v1_result.position[-1], annot.position[-1])):
-                    overlap = True
-            if not overlap:
-                v1_results.append(annot)
-        
-        # temporal annotation 
-        # annotate with duckling 
-        tempex, newq = self.v2_instance.temporal_annotate(newq, nlq, verbose)
-        if len(tempex) > 0:
-            combined_annotations += tempex
-         
+    def build_stage_graph(self, ner_stages: bool = True) -> StageGraph:
+        """Declare the stages of the V3 pipeline with their inputs and outputs.
+        spaCy, Flair and Duckling start at once, and the n-gram embeddings
+        are computed while the geocoding waits on the network.
+        Without ner_stages, the spaCy and Flair annotations are inputs of the graph (computed by batch)."""
+        ner = [
+            Stage("spacy", self.spacy_annotate,
+                  inputs=["nlq", "verbose"], outputs=["spacy_annotations"]),
+            Stage("flair", self.flair_annotate,
+                  inputs=["nlq", "verbose"], outputs=["flair_annotations"]),
+        ]
+        inputs = ["nlq", "newq", "verbose"]
+        if not ner_stages:
+            ner = []
+            inputs += ["spacy_annotations", "flair_annotations"]
+        return StageGraph(ner + [
+            Stage("duckling", self.v2_instance.temporal_annotate,
+                  inputs=["newq", "nlq", "verbose"], outputs=["tempex", "newq_tempex"]),
+            Stage("ner_merge", self.merge_ner_annotations,
+                  inputs=["spacy_annotations", "flair_annotations"], outputs=["v1_results"]),
+            Stage("v1_temporal", self.v1_temporal_annotate,
+                  inputs=["v1_results", "newq_tempex", "nlq", "verbose"], outputs=["v1_tempex", "newq_v1_tempex"]),
+            Stage("prefetch_embeddings", self.prefetch_embeddings,
+                  inputs=["newq_tempex"], outputs=["prefetched"]),
+            Stage("location", self.location_annotate,
+                  inputs=["v1_results", "newq_v1_tempex", "nlq", "verbose"], outputs=["locations", "newq_location"]),
+            Stage("vector_search", self.vector_annotate,
+                  inputs=["v1_results", "tempex", "v1_tempex", "locations", "newq_location", "nlq", "verbose",
+                          "prefetched"],
+                  outputs=["vector_annotations"]),
+        ], inputs=inputs, concurrent=self.concurrent, max_workers=self.max_workers)
+
+    def spacy_annotate(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        """spaCy annotations, cached by query (except the verbose calls)"""
+        return cached_call(None if verbose else self.result_cache, "NER_spacy", self.cache_fingerprint,
+                           lambda: self.v1_spacy.transform_nl2query(nlq, verbose), [nlq])
+
+    def flair_annotate(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        """Flair annotations, cached by query (except the verbose calls)"""
+        return cached_call(None if verbose else self.result_cache, "NER_flair", self.cache_fingerprint,
+                           lambda: self.v1_flair.transform_nl2query(nlq, verbose), [nlq])
+
+    def merge_ner_annotations(self, spacy_annotations: QueryAnnotationsDict,
+                              flair_annotations: QueryAnnotationsDict) -> List[Annotation]:
+        """non-overlapping spaCy and Flair annotations, by the fusion policy (default: spaCy first)"""
+        return self.fusion.fuse({"spacy": spacy_annotations.annotations, "flair": flair_annotations.annotations})
+
+    def v1_temporal_annotate(self, v1_results: List[Annotation], newq: QueryTokens, nlq: str, verbose: bool = False,
+                             tempexes: Optional[Dict[str, List[Annotation]]] = None):
+        """fill the V1 temporal annotations still in the query with Duckling
+        (or with the given Duckling annotations of their texts)"""
+        newq = newq.copy()
+        annotations = []
         # take annotations from v1
         v1_temp = [a for a in v1_results if isinstance(a, TemporalAnnotation)]
         # use duckling to fill in other values
         for temp in v1_temp:
             temp_text = temp.text
             # check if overlap with any previous annotations
-            if temp_text in newq:
+            indices = newq.locate(temp_text)
+            if indices is not None:
                 # add annotation from v1
-                tempex, _ = self.v2_instance.temporal_annotate(temp_text, nlq, verbose)
+                if tempexes is None:
+                    tempex, _ = self.v2_instance.temporal_annotate(temp_text, nlq, verbose)
+                else:
+                    tempex = tempexes.get(temp_text, [])
                 if len(tempex) > 0:
-                    combined_annotations += tempex
+                    annotations += tempex
                 else:
-                    combined_annotations.append(temp)
-                _, newpos = V2_pipeline.find_spans(temp_text, newq)
-                newq = newq[:newpos[0]] + newq[newpos[1]:]
-                newq = newq.replace("  ", " ")
+                    annotations.append(temp)
+                newq.consume(indices)
                 if verbose:
-                    print("TEMPEX - V1+V2:\n",combined_annotations[-1])
-                    print("New query:", newq)
-                    
+                    print("TEMPEX - V1+V2:\n",annotations[-1])
+                    print("New query:", newq.text())
+        return annotations, newq
+
+    async def av1_temporal_annotate(self, v1_results: List[Annotation], newq: QueryTokens, nlq: str,
+                                    verbose: bool = False):
+        """asynchronous v1_temporal_annotate, the V1 temporal texts are parsed concurrently"""
+        texts = list(dict.fromkeys(a.text for a in v1_results
+                                   if isinstance(a, TemporalAnnotation) and newq.locate(a.text) is not None))
+        results = await asyncio.gather(*[self.v2_instance.atemporal_annotate(text, nlq, verbose) for text in texts])
+        return self.v1_temporal_annotate(v1_results, newq, nlq, verbose,
+                                         tempexes={text: tempex for text, (tempex, _) in zip(texts, results)})
+
+    def prefetch_embeddings(self, newq: QueryTokens) -> int:
+        """embed the n-grams of the query without stopwords ahead of the vector searches"""
+        return self.v2_instance.vdbs.prefetch_embeddings(newq.text(skip_stopwords=True))
+
+    def location_annotate(self, v1_results: List[Annotation], newq: QueryTokens, nlq: str, verbose: bool = False,
+                          geocodings: Optional[Dict[str, tuple]] = None):
+        """geocode the query with osmnx, then the V1 locations still in the query
+        (or take the given geocodings of their texts)"""
+        def geocode(text):
+            if geocodings is not None:
+                return geocodings.get(text, (None, None))
+            return V2_pipeline.osmnx_geocode(self.v2_instance.vdbs, text, cache=self.v2_instance.result_cache)
+
+        newq = newq.copy()
+        annotations = []
         # location annotation        
-        loc_span, osmnx_annotation = V2_pipeline.osmnx_geocode(self.v2_instance.vdbs, newq)
+        loc_span, osmnx_annotation = geocode(newq.text())
         if loc_span:
-            _, pos = V2_pipeline.find_spans(loc_span, nlq)
+            _, pos = V2_pipeline.find_spans(loc_span, newq)
             loc = self.create_location_annotation([loc_span, pos, osmnx_annotation])
-            combined_annotations.append(loc)
+            annotations.append(loc)
             # remove loc annotations from newq
-            _, newpos = V2_pipeline.find_spans(loc.text, newq)
-            newq = newq[:newpos[0]] + newq[newpos[1]:]
-            newq = newq.replace("  ", " ")
+            newq.consume_span(loc.text)
             if verbose:
                 print("LOCATION - V2:\n", loc)
-                print("New query:", newq)
+                print("New query:", newq.text())
                 
         # take locations from V1
         v1_loc = [a for a in v1_results if isinstance(a, LocationAnnotation)]  
         # use osmnx to fill values
         for loc in v1_loc:
             # print("V1 Loc:", loc.text)
-            if loc.text in newq:
-                loc_span, osmnx_annotation = V2_pipeline.osmnx_geocode(self.v2_instance.vdbs, loc.text)
+            indices = newq.locate(loc.text)
+            if indices is not None:
+                loc_span, osmnx_annotation = geocode(loc.text)
                 if loc_span:
                     loc = self.create_location_annotation([loc_span, loc.position, osmnx_annotation])
-                combined_annotations.append(loc)
+                annotations.append(loc)
                 # remove loc annotations from newq
-                _, newpos = V2_pipeline.find_spans(loc.text, newq)
-                newq = newq[:newpos[0]] + newq[newpos[1]:]
-                newq = newq.replace("  ", " ")
+                newq.consume(indices)
                 if verbose:
                     print("LOCATION - V1+V2:\n", loc)
-                    print("New query:", newq)
-        
-        newq = V2_pipeline.remove_stopwords(newq)
+                    print("New query:", newq.text())
+        return annotations, newq
+
+    async def alocation_annotate(self, v1_results: List[Annotation], newq: QueryTokens, nlq: str,
+                                 verbose: bool = False):
+        """asynchronous location_annotate, the query and the V1 locations are geocoded concurrently"""
+        texts = list(dict.fromkeys([newq.text()] + [a.text for a in v1_results if isinstance(a, LocationAnnotation)
+                                                    and newq.locate(a.text) is not None]))
+        client, limiter = self.v2_instance.async_client()
+        results = await asyncio.gather(*[V2_pipeline.aosmnx_geocode(client, limiter, text,
+                                                                    cache=self.v2_instance.result_cache)
+                                         for text in texts])
+        return self.location_annotate(v1_results, newq, nlq, verbose, geocodings=dict(zip(texts, results)))
+
+    def vector_annotate(self, v1_results: List[Annotation], tempex: List[Annotation], v1_tempex: List[Annotation],
+                        locations: List[Annotation], newq: QueryTokens, nlq: str, verbose: bool = False,
+                        prefetched: int = 0) -> List[Annotation]:
+        """target and property annotations from the vector searches"""
+        annotations = []
+        newq = newq.copy()
+        newq.consume_stopwords()
         if verbose:
             print("\nRemoving stopwords")
-            print("New query:", newq)
+            print("New query:", newq.text())
                         
         # target annotation
-        targ_span, targ_results = self.v2_instance.vdbs.query_ngram_target(newq)
+        # n-grams inside temporal and location spans are not searched
+        covered = V2_pipeline.covered_texts(tempex + v1_tempex + locations)
+        targ_span, targ_results = self.v2_instance.vdbs.query_ngram_target(newq.text(), covered=covered)
         if len(targ_span) > 1 :
-            targ_spans, pos = V2_pipeline.find_spans(targ_span, nlq)
+            targ_spans, pos = V2_pipeline.find_spans(targ_span, newq)
             targ_annotation = self.create_target_annotation([targ_spans, pos, targ_results])
-            combined_annotations.append(targ_annotation)
-            _, newpos = V2_pipeline.find_spans(targ_span, newq)
-            newq = newq[:newpos[0]] + newq[newpos[1]:]
-            newq = newq.replace("  ", " ")
+            annotations.append(targ_annotation)
+            newq.consume_span(targ_span)
             if verbose:
                 print("TARGET - V2:", targ_annotation)
-                print("New query:", newq)
+                print("New query:", newq.text())
         
-        if len(newq) >1:
+        if len(newq.text()) >1:
             # property annotation
-            prop_span, prop_results = self.v2_instance.vdbs.query_ngram_prop(newq, threshold=0.8)
+            prop_span, prop_results = self.v2_instance.vdbs.query_ngram_prop(newq.text(), threshold=0.8,
+                                                                             covered=covered)
             while len(prop_span) > 1:
-                prop_spans, pos = V2_pipeline.find_spans(prop_span, nlq)
+                prop_spans, pos = V2_pipeline.find_spans(prop_span, newq)
                 prop_annotation = self.create_property_annotation([prop_spans, pos, prop_results])
-                combined_annotations.append(prop_annotation)
-                _, newpos = V2_pipeline.find_spans(prop_span, newq)
-                newq = newq[:newpos[0]] + newq[newpos[1]:]
-                newq = newq.replace("  ", " ")
+                annotations.append(prop_annotation)
+                if not newq.consume_span(prop_span):
+                    break
                 if verbose:
                     print("PROPERTY - V2:\n", prop_annotation)
-                    print("New query:", newq)
-                prop_span, prop_results = self.v2_instance.vdbs.query_ngram_prop(newq, threshold=0.82)
+                    print("New query:", newq.text())
+                prop_span, prop_results = self.v2_instance.vdbs.query_ngram_prop(newq.text(), threshold=0.82,
+                                                                                 covered=covered)
 
         # take prop from V1
         v1_prop = [a for a in v1_results if isinstance(a, PropertyAnnotation)]
         for prop in v1_prop:
-            if prop.text in newq:
+            if newq.locate(prop.text) is not None:
                 # try to find value for this span with low threshold
                 prop_span, prop_results = self.v2_instance.vdbs.query_ngram_prop(prop.text, threshold=0.5, verbose=verbose)
                 if len(prop_span) > 1:
                     prop = self.create_property_annotation([prop_span, prop.position, prop_results])
-                combined_annotations.append(prop)
+                annotations.append(prop)
                 if verbose:
                     print("PROPERTY - V1+V2:\n", prop)
+        return annotations
+
+    @traced_transform
+    @V2_pipeline.reset_query_stats
+    @cached_transform
+    def transform_nl2query(self, nlq: str, verbose:bool=False) -> QueryAnnotationsDict:
+        return self.run_stage_graph(self.stage_graph, {"nlq": nlq, "verbose": verbose})
+
+    @traced_transform_batch
+    @V2_pipeline.reset_query_stats
+    @cached_transform_batch
+    def transform_nl2query_batch(self, nlqs: List[str], verbose: bool = False) -> List[QueryAnnotationsDict]:
+        """transform several queries, with the spaCy and Flair models run on all of them at once"""
+        with span("spacy", queries=len(nlqs)):
+            spacy_results = self.v1_spacy.transform_nl2query_batch(nlqs, verbose)
+        with span("flair", queries=len(nlqs)):
+            flair_results = self.v1_flair.transform_nl2query_batch(nlqs, verbose)
+        return [self.run_stage_graph(self.batch_stage_graph, {"nlq": nlq, "verbose": verbose,
+                                                              "spacy_annotations": spacy_annotations,
+                                                              "flair_annotations": flair_annotations})
+                for nlq, spacy_annotations, flair_annotations in zip(nlqs, spacy_results, flair_results)]
+
+    def run_stage_graph(self, graph: StageGraph, values: dict) -> QueryAnnotationsDict:
+        """run the stages of one query given its initial values, return its annotations"""
+        nlq, verbose = values["nlq"], values["verbose"]
+        newq = self.query_tokens(nlq, verbose)
+        # search counters, prefetched embeddings and stage wall times of this query, apart from the concurrent ones
+        timings = {}
+        with self.v2_instance.vdbs.query_state() as state:
+            values = graph.run(dict(values, newq=newq), timings)
+        # collect annotations
+        combined_annotations = values["tempex"] + values["v1_tempex"] + values["locations"] \
+            + values["vector_annotations"]
+
+        V2_pipeline.LAST_QUERY_STATS.set({"search_stats": state.search_stats, "stage_timings": timings})
+        if verbose:
+            V2_pipeline.print_search_stats(state.search_stats)
+            print("Stage wall times (s):", {name: round(t, 3) for name, t in timings.items()})
            
-        # sort and return
+        return self.query_annotations(nlq, combined_annotations)
+
+    @atraced_transform
+    @V2_pipeline.reset_query_stats
+    @acached_transform
+    async def atransform_nl2query(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        """asynchronous transform_nl2query: spaCy, Flair and the vector searches run in the default executor
+        while Duckling and the geocoding are awaited with httpx"""
+        loop = asyncio.get_running_loop()
+        newq = self.query_tokens(nlq, verbose)
+        spacy_annotations, flair_annotations, (tempex, newq_tempex) = await asyncio.gather(
+            loop.run_in_executor(None, in_context(traced("spacy")(self.spacy_annotate)), nlq, verbose),
+            loop.run_in_executor(None, in_context(traced("flair")(self.flair_annotate)), nlq, verbose),
+            self.v2_instance.atemporal_annotate(newq, nlq, verbose))
+        v1_results = self.merge_ner_annotations(spacy_annotations, flair_annotations)
+        v1_tempex, newq = await self.av1_temporal_annotate(v1_results, newq_tempex, nlq, verbose)
+        locations, newq = await self.alocation_annotate(v1_results, newq, nlq, verbose)
+        # search counters of this query, apart from the concurrent ones
+        with self.v2_instance.vdbs.query_state():
+            vector_annotations = await loop.run_in_executor(
+                None, in_context(traced("vector_search")(self.vector_annotate)),
+                v1_results, tempex, v1_tempex, locations, newq, nlq, verbose)
+        return self.query_annotations(nlq, tempex + v1_tempex + locations + vector_annotations)
+
+    @staticmethod
+    def query_tokens(nlq: str, verbose: bool = False) -> QueryTokens:
+        """tokens of the query without parentheses and commas"""
+        newq = QueryTokens(nlq, V2_pipeline.english_stopwords(), remove="(),")
+        if verbose:
+            print("New query:", newq.text())
+        return newq
+
+    @staticmethod
+    def query_annotations(nlq: str, combined_annotations: List[Annotation]) -> QueryAnnotationsDict:
+        """query annotations sorted by position"""
         combined_annotations.sort(key=lambda a:(a.position[0][0] \
                                   if isinstance(a.position[0], list) else a.position[0]))
         return QueryAnnotationsDict(query=nlq, annotations=combined_annotations)
 
+    def close(self) -> None:
+        """stop the stage executor threads"""
+        self.stage_graph.shutdown()
+        self.batch_stage_graph.shutdown()
+
 
     def run_ceda_queries(self, write_out:bool=False):
         """run V3 instance on ceda evaluation dataset"""
-        path = os.path.dirname(os.path.realpath(__file__))
-        qfile =  os.path.join(path, "../../nl2q_eval/ceda_gold_queries.json")
-        struct_results = []
-        with open(qfile, 'r', encoding="utf-8") as f:
-            qs = json.load(f)
-            if 'queries' in qs.keys():
-                qlist = qs['queries']
-                # iterate over queries
-                for q in qlist:
-                    print("\n"+q['query'])
-                    res = my_instance.transform_nl2query(q['query'])
-                    # print(res)
-                    struct_results.append(res.to_dict())
-            if write_out:
-                ofile = os.path.join(path , "v3_ceda_test_results.json")
-                with open(ofile, 'w', encoding="utf-8") as f:
-                    json.dump({'queries': struct_results}, f, indent=2)
-        return struct_results
+        ofile = os.path.join(os.path.dirname(os.path.realpath(__file__)), "v3_ceda_test_results.json") if write_out else None
+        return run_ceda_queries(self.transform_nl2query_batch, ofile)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,293 @@
+"""
+Local store of the models and corpora used by the pipelines.
+
+The artifacts are listed in ``artifacts.json`` with their version, source,
+path in the store and the sha256 checksums of their files. Once prefetched,
+the components load them from the store without any network call:
+
+    python -m nl2query.artifacts lock       # pin the Hugging Face revisions and record the checksums
+    python -m nl2query.artifacts prefetch   # download, then verify against the checksums
+    python -m nl2query.artifacts verify     # check the store against the checksums
+    python -m nl2query.artifacts list
+
+An artifact is locked once the manifest has the checksums of its files and, for the
+Hugging Face ones, the commit of their revision (``lock`` replaces a branch like ``main``
+by its current commit). An artifact not locked by the manifest is locked in the store
+on its first prefetch (``artifacts.lock.json`` of the store, with the same pins), then
+verified against it: commit the pins with ``lock`` to verify every store against them.
+
+The store directory is given by the ``NL2QUERY_ARTIFACTS`` environment variable
+(default: ``~/.cache/nl2query``). With ``NL2QUERY_OFFLINE=1``, a missing artifact
+is an error instead of a download, and the Hugging Face libraries run offline.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import zipfile
+from typing import Dict, List, Optional
+
+MANIFEST = os.path.join(os.path.dirname(os.path.realpath(__file__)), "artifacts.json")
+# file written in an artifact directory once completely fetched and verified
+COMPLETE_MARKER = ".complete"
+# pins of the artifacts not locked by the manifest, written in the store on their first prefetch
+STORE_LOCK = "artifacts.lock.json"
+# Hugging Face revision pinned to a commit
+COMMIT_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+
+
+def store_dir() -> str:
+    return os.path.expanduser(os.getenv("NL2QUERY_ARTIFACTS", os.path.join("~", ".cache", "nl2query")))
+
+
+def offline() -> bool:
+    return os.getenv("NL2QUERY_OFFLINE", "").lower() in ["1", "true", "yes"]
+
+
+def snapshots_enabled(config, section: str = "snapshot", option: str = "enabled") -> bool:
+    """snapshot option of a component config, forced by the NL2QUERY_SNAPSHOTS environment variable"""
+    if os.getenv("NL2QUERY_SNAPSHOTS", "").lower() in ["1", "true", "yes"]:
+        return True
+    return bool(config) and config.getboolean(section, option, fallback=False)
+
+
+def read_manifest(manifest: str = MANIFEST) -> List[dict]:
+    with open(manifest, "r", encoding="utf-8") as f:
+        return json.load(f)["artifacts"]
+
+
+def write_manifest(artifacts: List[dict], manifest: str = MANIFEST) -> None:
+    with open(manifest, "w", encoding="utf-8") as f:
+        json.dump({"artifacts": artifacts}, f, indent=2)
+        f.write("\n")
+
+
+def get_artifact(name: str, manifest: str = MANIFEST) -> Optional[dict]:
+    for artifact in read_manifest(manifest):
+        if artifact["name"] == name:
+            return artifact
+    return None
+
+
+def artifact_path(artifact: dict, store: Optional[str] = None) -> str:
+    return os.path.join(store or store_dir(), artifact["path"])
+
+
+def resolve(name: str, version: Optional[str] = None, store: Optional[str] = None) -> Optional[str]:
+    """Return the local path of an artifact of the manifest if it was prefetched in the store,
+    otherwise None (the component then uses its usual download) or an error when offline.
+    Only the completion marker is checked, the checksums are verified by the prefetch and verify commands."""
+    artifact = get_artifact(name)
+    if artifact is None:
+        return None
+    path = artifact_path(artifact, store)
+    # a spaCy model of another version than the manifest one is not in the store
+    same_version = not version or artifact["type"] != "spacy" or version == artifact["version"]
+    if same_version and os.path.exists(os.path.join(path, COMPLETE_MARKER)):
+        if offline():
+            # prevent the Hugging Face libraries from checking for updates
+            os.environ.setdefault("HF_HUB_OFFLINE", "1")
+            os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+        return path
+    if offline():
+        raise FileNotFoundError(f"Artifact [{name}] {version or ''} not found in the store {path}! "
+                                f"Run 'python -m nl2query.artifacts prefetch' with network access.")
+    return None
+
+
+def file_checksums(path: str) -> Dict[str, str]:
+    """sha256 of every file of an artifact directory, by relative path"""
+    checksums = {}
+    for root, _, files in os.walk(path):
+        for file in sorted(files):
+            if file == COMPLETE_MARKER:
+                continue
+            full_path = os.path.join(root, file)
+            sha = hashlib.sha256()
+            with open(full_path, "rb") as f:
+                for chunk in iter(lambda: f.read(2 ** 20), b""):
+                    sha.update(chunk)
+            checksums[os.path.relpath(full_path, path).replace(os.sep, "/")] = sha.hexdigest()
+    return checksums
+
+
+def unlocked(artifact: dict) -> Optional[str]:
+    """reason why an artifact of the manifest is not locked, None if it is"""
+    if not artifact.get("sha256"):
+        return "no checksums in the manifest"
+    if artifact["type"] == "huggingface" and not COMMIT_PATTERN.match(artifact["version"]):
+        return f"revision [{artifact['version']}] is not a commit"
+    return None
+
+
+def store_lock_path(store: Optional[str] = None) -> str:
+    return os.path.join(store or store_dir(), STORE_LOCK)
+
+
+def read_store_lock(store: Optional[str] = None) -> Dict[str, dict]:
+    try:
+        with open(store_lock_path(store), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def store_locked(artifact: dict, store: Optional[str] = None) -> dict:
+    """the artifact with the pins of the store lock if the manifest does not lock it
+    (same source and requested version)"""
+    if not unlocked(artifact):
+        return artifact
+    pins = read_store_lock(store).get(artifact["name"])
+    if pins and pins["source"] == artifact["source"] and pins["requested"] == artifact["version"]:
+        return dict(artifact, version=pins["version"], sha256=pins["sha256"])
+    return artifact
+
+
+def write_store_lock(artifact: dict, requested: str, store: Optional[str] = None) -> None:
+    """record the pins of an artifact fetched from its requested version in the store lock"""
+    pins = read_store_lock(store)
+    pins[artifact["name"]] = {"source": artifact["source"], "requested": requested, "version": artifact["version"],
+                              "sha256": artifact["sha256"]}
+    tmp_path = store_lock_path(store) + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(pins, f, indent=2)
+    os.replace(tmp_path, store_lock_path(store))
+
+
+def verify(artifact: dict, store: Optional[str] = None) -> List[str]:
+    """list of the problems of an artifact: not locked (by the manifest or the store),
+    files missing or with a checksum different from the pinned ones"""
+    artifact = store_locked(artifact, store)
+    reason = unlocked(artifact)
+    if reason:
+        return [f"not locked ({reason}), run 'python -m nl2query.artifacts prefetch' or 'lock'"]
+    path = artifact_path(artifact, store)
+    if not os.path.isdir(path):
+        return [path]
+    checksums = file_checksums(path)
+    return [file for file, sha in artifact.get("sha256", {}).items() if checksums.get(file) != sha]
+
+
+def fetch_spacy(artifact: dict, path: str) -> None:
+    """download the model wheel and extract its model data directory"""
+    import requests
+
+    response = requests.get(artifact["source"], timeout=60)
+    response.raise_for_status()
+    data_dir = f"{artifact['name']}/{artifact['name']}-{artifact['version']}/"
+    with zipfile.ZipFile(io.BytesIO(response.content)) as wheel:
+        for member in wheel.namelist():
+            if member.startswith(data_dir) and not member.endswith("/"):
+                target = os.path.join(path, member[len(data_dir):])
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with wheel.open(member) as src, open(target, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+
+
+def pin_revision(artifact: dict) -> None:
+    """replace the revision of a Hugging Face artifact (ex: main) by its current commit"""
+    from huggingface_hub import HfApi
+
+    artifact["version"] = HfApi().model_info(artifact["source"], revision=artifact["version"] or None).sha
+
+
+def fetch_huggingface(artifact: dict, path: str) -> None:
+    from huggingface_hub import snapshot_download
+
+    snapshot_download(repo_id=artifact["source"], revision=artifact["version"] or None, local_dir=path,
+                      allow_patterns=artifact.get("files"))
+    # remove the download cache metadata, which is not part of the checksums
+    shutil.rmtree(os.path.join(path, ".cache"), ignore_errors=True)
+
+
+def fetch_nltk(artifact: dict, path: str) -> None:
+    import nltk
+
+    if not nltk.download(artifact["source"], download_dir=path, quiet=True):
+        raise RuntimeError(f"nltk download of [{artifact['source']}] failed!")
+
+
+FETCHERS = {"spacy": fetch_spacy, "huggingface": fetch_huggingface, "nltk": fetch_nltk}
+
+
+def prefetch(artifact: dict, store: Optional[str] = None, lock: bool = False, force: bool = False) -> bool:
+    """Fetch an artifact in the store and verify it against the manifest (or store lock) checksums.
+    With lock, the Hugging Face revision is pinned to its commit and the checksums of the
+    fetched files are recorded in the artifact instead. An artifact locked by neither
+    is pinned the same way in the store lock.
+    Return False if the verification failed."""
+    requested = artifact["version"]
+    if not lock:
+        artifact = store_locked(artifact, store)
+    reason = unlocked(artifact)
+    store_lock = reason is not None and not lock
+    if store_lock:
+        print(f"{artifact['name']}: not locked ({reason}), pinned in {store_lock_path(store)}, "
+              f"run 'python -m nl2query.artifacts lock' to pin it in the manifest")
+        artifact = dict(artifact)
+    path = artifact_path(artifact, store)
+    marker = os.path.join(path, COMPLETE_MARKER)
+    if os.path.exists(marker) and not force and not lock and not store_lock:
+        print(f"{artifact['name']}: already in the store")
+        return True
+    print(f"{artifact['name']}: fetching {artifact['source']} to {path}")
+    if os.path.exists(marker):
+        os.remove(marker)
+    os.makedirs(path, exist_ok=True)
+    if (lock or store_lock) and artifact["type"] == "huggingface":
+        pin_revision(artifact)
+    FETCHERS[artifact["type"]](artifact, path)
+    if lock or store_lock:
+        artifact["sha256"] = file_checksums(path)
+        if store_lock:
+            write_store_lock(artifact, requested, store)
+    else:
+        mismatches = verify(artifact, store)
+        if mismatches:
+            print(f"{artifact['name']}: checksum mismatch of {mismatches}")
+            return False
+    with open(marker, "w", encoding="utf-8") as f:
+        f.write(artifact["version"])
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["lock", "prefetch", "verify", "list"])
+    parser.add_argument("--store", default=None, help="store directory (default: $NL2QUERY_ARTIFACTS)")
+    parser.add_argument("--manifest", default=MANIFEST, help="artifact manifest")
+    parser.add_argument("--name", nargs="+", default=None, help="only these artifacts")
+    parser.add_argument("--lock", action="store_true", help="prefetch and lock (same as the lock command)")
+    parser.add_argument("--force", action="store_true", help="fetch again the artifacts already in the store")
+    args = parser.parse_args()
+
+    artifacts = read_manifest(args.manifest)
+    lock = args.command == "lock" or args.lock
+    selected = [a for a in artifacts if not args.name or a["name"] in args.name]
+    ok = True
+    for artifact in selected:
+        if args.command in ["lock", "prefetch"]:
+            ok = prefetch(artifact, args.store, lock=lock, force=args.force) and ok
+        elif args.command == "verify":
+            mismatches = verify(artifact, args.store)
+            print(f"{artifact['name']}: {'ok' if not mismatches else 'mismatch of ' + str(mismatches)}")
+            ok = ok and not mismatches
+        else:
+            path = artifact_path(artifact, args.store)
+            state = "complete" if os.path.exists(os.path.join(path, COMPLETE_MARKER)) else "missing"
+            if unlocked(store_locked(artifact, args.store)):
+                state += ", not locked"
+            elif unlocked(artifact):
+                state += ", store lock"
+            print(f"{artifact['name']:<28}{artifact['type']:<14}{artifact['version'][:10]:<12}{state:<24}{path}")
+    if lock:
+        write_manifest(artifacts, args.manifest)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Benchmarks of the nl2query pipelines and components.
+Run them as modules from the notebooks directory, for example:
+    python -m nl2query.benchmarks.ann_recall --help
+"""
+import json
+import os
+import sys
+from typing import List
+
+from typedefs import JSON
+
+NOTEBOOKS_DIR = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../.."))
+GOLD_QUERIES = os.path.join(NOTEBOOKS_DIR, "nl2q_eval/ceda_gold_queries.json")
+V1_CONFIG = os.path.join(NOTEBOOKS_DIR, "nl2query/V1/v1_config.cfg")
+V2_CONFIG = os.path.join(NOTEBOOKS_DIR, "nl2query/V2/v2_config.cfg")
+
+# the benchmarks time the pipelines, not their result cache (also in the worker subprocesses)
+os.environ.setdefault("NL2QUERY_CACHE", "0")
+
+
+def read_gold_queries(gold_path: str = GOLD_QUERIES) -> JSON:
+    """read the CEDA gold queries annotations"""
+    with open(gold_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def gold_query_texts(gold_path: str = GOLD_QUERIES) -> List[str]:
+    """the natural language queries of the gold set"""
+    return [q["query"] for q in read_gold_queries(gold_path)["queries"]]
+
+
+def annotation_quality(results_path: str, gold_path: str = GOLD_QUERIES) -> dict:
+    """span metrics of query_eval.global_stats and nervaluate F1 of a results file against the gold queries"""
+    from nl2q_eval.query_eval import global_stats
+
+    # query_nervaluate imports MetricsClasses from its own directory
+    sys.path.insert(0, os.path.join(NOTEBOOKS_DIR, "nl2q_eval"))
+    from query_nervaluate import nervaluate_performance
+
+    with open(results_path, "r", encoding="utf-8") as f:
+        results = json.load(f)
+    span = global_stats(read_gold_queries(gold_path), results).span_measures.get_span_metrics("global")
+    nervaluate, _ = nervaluate_performance(gold_path, results_path)
+    return {
+        "span_perfect_match_type_match": span.perfect_match_type_match,
+        "span_overlapping_type_match_avg": span.overlapping_span_type_match.avg,
+        "nervaluate_strict_f1": nervaluate["strict"]["f1"],
+        "nervaluate_ent_type_f1": nervaluate["ent_type"]["f1"],
+    }
+
+
+def create_pipeline(version: str, v1_config: str = V1_CONFIG, v2_config: str = V2_CONFIG):
+    """instantiate the V1, V2 or V3 pipeline with the default configs"""
+    if version == "V1":
+        from nl2query.V1.V1_pipeline import V1_pipeline
+        return V1_pipeline(v1_config)
+    if version == "V2":
+        from nl2query.V2.V2_pipeline import V2_pipeline
+        return V2_pipeline(v2_config)
+    if version == "V3":
+        from nl2query.V3.V3_pipeline import V3_pipeline
+        return V3_pipeline(v1_config, v2_config)
+    raise ValueError(f"Unknown pipeline version [{version}]! Must be one of: V1, V2, V3")
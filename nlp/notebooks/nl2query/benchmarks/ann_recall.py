@@ -0,0 +1,137 @@
+"""
+Recall vs latency benchmark of the approximate vector index backends
+(hnswlib, faiss) against the exact numpy search.
+
+Synthetic vectors can be used to simulate vocabularies of millions of rows
+without running the encoder:
+    python -m nl2query.benchmarks.ann_recall --synthetic 1000000 --dim 768
+
+Otherwise, the persisted indexes of a vocabulary are used, with the CEDA
+gold queries n-grams as search queries (requires the e5 encoder):
+    python -m nl2query.benchmarks.ann_recall --vdb nl2query/V2/target_vdb --vocab nl2query/V2/target_vocab3.csv
+"""
+import argparse
+import os
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+
+from nl2query.benchmarks import gold_query_texts
+from nl2query.V2.vector_index import EMBED_BATCH, ExactIndex, FaissIndex, HnswIndex, write_matrix_files
+
+
+def recall_at_k(exact_ids: List[np.ndarray], ann_ids: List[np.ndarray]) -> float:
+    """average fraction of the exact k nearest neighbours found by the approximate search"""
+    found = [len(set(e.tolist()) & set(a.tolist())) / len(e) for e, a in zip(exact_ids, ann_ids)]
+    return sum(found) / len(found)
+
+
+def run_queries(index, queries: np.ndarray, k: int):
+    """run all queries, return the ids found and the latencies in ms"""
+    ids = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        found, _ = index.knn(query, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        ids.append(found)
+    return ids, np.asarray(latencies)
+
+
+def synthetic_dir(count: int, dim: int, seed: int = 42) -> str:
+    """write random normalized vectors in a temporary index directory"""
+    db_dir = os.path.join(tempfile.mkdtemp(prefix="ann_recall_"), "synthetic")
+    rng = np.random.default_rng(seed)
+
+    def batches():
+        for start in range(0, count, EMBED_BATCH):
+            batch = rng.standard_normal((min(EMBED_BATCH, count - start), dim), dtype=np.float32)
+            yield batch / np.linalg.norm(batch, axis=1, keepdims=True)
+
+    write_matrix_files(db_dir, [str(i) for i in range(count)], batches())
+    return db_dir
+
+
+def gold_ngrams() -> List[str]:
+    """all the 1 to 3-grams of the CEDA gold queries"""
+    from nl2query.V2.Vdb_simsearch import generate_ngrams
+
+    ngrams = []
+    for query in gold_query_texts():
+        ngrams += generate_ngrams(query, 3)[0] + [query]
+    return sorted(set(ngrams))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--synthetic", type=int, default=0, help="number of random vectors to index")
+    parser.add_argument("--dim", type=int, default=768, help="dimension of the random vectors")
+    parser.add_argument("--vdb", help="vocabulary index path (the <vdb>_<backend> directories are used)")
+    parser.add_argument("--vocab", help="vocabulary csv file, used to build missing indexes")
+    parser.add_argument("--queries", type=int, default=1000, help="number of queries (synthetic only)")
+    parser.add_argument("-k", type=int, default=15, help="number of neighbours searched")
+    parser.add_argument("--ef", type=int, nargs="+", default=[16, 32, 64, 128, 256], help="HNSW ef_search values")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64], help="faiss IVF nprobe values")
+    parser.add_argument("--factory", default="IVF1024,Flat", help="faiss index factory string")
+    parser.add_argument("--backends", nargs="+", default=["hnswlib", "faiss"])
+    args = parser.parse_args()
+
+    embeddings = None
+    loader = splitter = None
+    if args.synthetic:
+        db_dir = synthetic_dir(args.synthetic, args.dim)
+        exact = ExactIndex(db_dir, None, None, None)
+        rng = np.random.default_rng(0)
+        noise = rng.standard_normal((args.queries, exact.vectors.shape[1]), dtype=np.float32) * 0.1
+        queries = np.asarray(exact.vectors[rng.integers(0, len(exact), args.queries)]) + noise
+        dirs = {backend: db_dir for backend in args.backends}
+    else:
+        from langchain.document_loaders.csv_loader import CSVLoader
+        from langchain.embeddings import HuggingFaceEmbeddings
+        from langchain.text_splitter import CharacterTextSplitter
+
+        from nl2query.artifacts import resolve
+        from nl2query.V2.Vdb_simsearch import EMBEDDING_MODEL
+
+        embeddings = HuggingFaceEmbeddings(model_name=resolve(EMBEDDING_MODEL) or EMBEDDING_MODEL, model_kwargs={'device': 'cpu'},
+                                           encode_kwargs={'normalize_embeddings': False})
+        with open(args.vocab, "r", encoding="utf-8") as f:
+            fieldnames = f.readline().strip().split("#")
+        loader = CSVLoader(file_path=args.vocab, source_column=fieldnames[0],
+                           csv_args={'delimiter': '#', 'quotechar': '"', 'fieldnames': fieldnames})
+        splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+        exact = ExactIndex(args.vdb + "_exact", loader, splitter, embeddings)
+        queries = np.asarray(embeddings.embed_documents(gold_ngrams()), dtype=np.float32)
+        dirs = {backend: args.vdb + "_" + backend for backend in args.backends}
+
+    print(f"\n{len(exact)} vectors, {len(queries)} queries, k={args.k}")
+    exact_ids, latencies = run_queries(exact, queries, args.k)
+    print(f"{'backend':<10}{'param':<16}{'recall':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    print(f"{'exact':<10}{'-':<16}{1.0:>8.3f}{np.percentile(latencies, 50):>10.3f}"
+          f"{np.percentile(latencies, 99):>10.3f}")
+
+    if "hnswlib" in args.backends:
+        hnsw = HnswIndex(dirs["hnswlib"], loader, splitter, embeddings)
+        for ef in args.ef:
+            hnsw.set_ef(max(ef, args.k))
+            ids, latencies = run_queries(hnsw, queries, args.k)
+            print(f"{'hnswlib':<10}{'ef=' + str(ef):<16}{recall_at_k(exact_ids, ids):>8.3f}"
+                  f"{np.percentile(latencies, 50):>10.3f}{np.percentile(latencies, 99):>10.3f}")
+    if "faiss" in args.backends:
+        faiss_index = FaissIndex(dirs["faiss"], loader, splitter, embeddings, factory=args.factory)
+        is_hnsw = hasattr(faiss_index.index, "hnsw")
+        for value in (args.ef if is_hnsw else args.nprobe):
+            if is_hnsw:
+                faiss_index.set_ef(max(value, args.k))
+            else:
+                faiss_index.set_nprobe(value)
+            ids, latencies = run_queries(faiss_index, queries, args.k)
+            param = ("ef=" if is_hnsw else "nprobe=") + str(value)
+            print(f"{'faiss':<10}{param:<16}{recall_at_k(exact_ids, ids):>8.3f}"
+                  f"{np.percentile(latencies, 50):>10.3f}{np.percentile(latencies, 99):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
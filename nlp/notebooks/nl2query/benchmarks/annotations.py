@@ -0,0 +1,75 @@
+"""
+Time and memory to build, serialize and parse annotations.
+
+The annotations of the CEDA gold queries are repeated up to --count annotations,
+then built from their dicts (from_dict), serialized (to_dict, then json and orjson
+when installed) and parsed back (loads and from_dict) as QueryAnnotationsDict.
+
+    python -m nl2query.benchmarks.annotations --count 1000000
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from itertools import cycle, islice
+
+from nl2query.benchmarks import read_gold_queries
+from nl2query.NL2QueryInterface import ANNOTATION_CLASSES, QueryAnnotationsDict, loads, orjson
+
+
+def gold_annotations() -> list:
+    """to_dict() dicts of the gold annotations valid for the annotation classes"""
+    dicts = []
+    for query in read_gold_queries()["queries"]:
+        for annotation in query["annotations"]:
+            try:
+                dicts.append(ANNOTATION_CLASSES[annotation["type"]].from_dict(annotation).to_dict())
+            except Exception:
+                # gold annotations without the fields of their class
+                continue
+    return dicts
+
+
+def timed(results: dict, name: str, func):
+    start = time.perf_counter()
+    value = func()
+    results[name] = time.perf_counter() - start
+    return value
+
+
+def run(count: int, per_query: int) -> dict:
+    dicts = list(islice(cycle(gold_annotations()), count))
+    results = {}
+    annotations = timed(results, "build_s", lambda: [ANNOTATION_CLASSES[d["type"]].from_dict(d) for d in dicts])
+    # memory of the annotation objects (their values are shared with the dicts), on a sample
+    sample = dicts[:10000]
+    tracemalloc.start()
+    built = [ANNOTATION_CLASSES[d["type"]].from_dict(d) for d in sample]
+    results["bytes_per_annotation"] = tracemalloc.get_traced_memory()[0] / len(built)
+    tracemalloc.stop()
+    queries = [QueryAnnotationsDict(query="query", annotations=annotations[i:i + per_query])
+               for i in range(0, count, per_query)]
+    data = timed(results, "to_dict_s", lambda: [query.to_dict() for query in queries])
+    texts = timed(results, "json_dumps_s", lambda: [json.dumps(d) for d in data])
+    timed(results, "json_loads_s", lambda: [json.loads(text) for text in texts])
+    if orjson is not None:
+        texts = timed(results, "orjson_dumps_s", lambda: [query.to_json() for query in queries])
+    timed(results, "parse_s", lambda: [QueryAnnotationsDict.from_dict(loads(text)) for text in texts])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=1000000, help="number of annotations")
+    parser.add_argument("--per-query", type=int, default=4, help="annotations per query")
+    args = parser.parse_args()
+
+    results = run(args.count, args.per_query)
+    print(f"{args.count} annotations, {args.per_query} per query, orjson: {orjson is not None}")
+    for name, value in results.items():
+        per_annotation = f"{value / args.count * 1e9:>10.1f} ns/annotation" if name.endswith("_s") else ""
+        print(f"{name:<24}{value:>14.3f}  {per_annotation}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Import time of the notebook entry points, measured in a fresh interpreter
+with ``python -X importtime``, and checked against a time budget.
+The heavy dependencies of the pipelines must not be imported before
+a pipeline is instantiated.
+
+    python -m nl2query.benchmarks.import_time --module nlu_demo --budget 1.0
+"""
+import argparse
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+from nl2query.benchmarks import NOTEBOOKS_DIR
+
+# dependencies only needed once a pipeline is instantiated
+HEAVY_MODULES = ["spacy", "flair", "torch", "transformers", "langchain", "chromadb", "osmnx", "geopandas",
+                 "nltk", "pystac_client"]
+
+
+def import_profile(module: str) -> Tuple[float, Dict[str, int], List[str]]:
+    """Import module in a fresh interpreter.
+    Return the wall time in seconds, the cumulative import time (us) per module
+    and the heavy modules imported."""
+    code = (f"import sys; import {module}; "
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=NOTEBOOKS_DIR,
+                          capture_output=True, text=True, check=True)
+    wall_time = time.perf_counter() - start
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumul, name = line[len("import time:"):].split("|")
+        cumulative[name.strip()] = int(cumul)
+    heavy = [name for name in proc.stdout.strip().split(",") if name]
+    return wall_time, cumulative, heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", nargs="+", default=["nlu_demo", "nl2query"], help="modules to import")
+    parser.add_argument("--budget", type=float, default=1.0, help="maximum import wall time in seconds")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to show")
+    parser.add_argument("--repeat", type=int, default=3, help="imports per module, the best time is kept")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.module:
+        runs = [import_profile(module) for _ in range(args.repeat)]
+        wall_time, cumulative, heavy = min(runs, key=lambda run: run[0])
+        print(f"\nimport {module}: {wall_time:.3f}s (budget {args.budget:.3f}s)")
+        for name, cumul in sorted(cumulative.items(), key=lambda item: -item[1])[:args.top]:
+            print(f"  {cumul / 1e6:>8.3f}s  {name}")
+        if heavy:
+            print(f"  heavy modules imported: {heavy}")
+        failed = failed or wall_time > args.budget or bool(heavy)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Load time and resident memory of the spaCy, Flair and e5 models,
+loaded normally or from their memory-mapped snapshots.
+Each load runs in a fresh interpreter. The snapshots are written by
+a first load, the following ones measure the warm loading.
+
+    python -m nl2query.benchmarks.model_load --models spacy flair e5 --repeat 3
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from nl2query.benchmarks import NOTEBOOKS_DIR
+
+LOADERS = {
+    "spacy": "from nl2query.V1.NER_spacy import NER_spacy; NER_spacy('nl2query/V1/spacy_config.cfg')",
+    "flair": "from nl2query.V1.NER_flair import NER_flair; NER_flair('nl2query/V1/flair_config.cfg')",
+    "e5": "from nl2query.V2.Vdb_simsearch import load_embeddings; load_embeddings(snapshot={snapshot})",
+}
+
+MEASURE = """
+import json, time
+from nl2query.registry import resident_memory
+rss_before = resident_memory()
+start = time.perf_counter()
+{load}
+print(json.dumps({{"load_s": time.perf_counter() - start, "rss_before": rss_before, "rss_after": resident_memory()}}))
+"""
+
+
+def measure(model: str, snapshot: bool) -> dict:
+    """load a model in a fresh interpreter, return the load time and the resident memory before and after"""
+    env = dict(os.environ, NL2QUERY_SNAPSHOTS="1" if snapshot else "0")
+    code = MEASURE.format(load=LOADERS[model].format(snapshot=snapshot))
+    proc = subprocess.run([sys.executable, "-c", code], cwd=NOTEBOOKS_DIR, env=env,
+                          capture_output=True, text=True, check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", nargs="+", default=list(LOADERS), choices=list(LOADERS))
+    parser.add_argument("--repeat", type=int, default=3, help="loads per model and mode")
+    args = parser.parse_args()
+
+    print(f"{'model':<8}{'mode':<10}{'load s':>10}{'RSS before MB':>16}{'RSS after MB':>15}{'added MB':>11}")
+    for model in args.models:
+        # write the snapshot if missing
+        measure(model, snapshot=True)
+        for mode in ["model", "snapshot"]:
+            runs = [measure(model, snapshot=mode == "snapshot") for _ in range(args.repeat)]
+            before = statistics.median(r["rss_before"] for r in runs) / 2 ** 20
+            after = statistics.median(r["rss_after"] for r in runs) / 2 ** 20
+            load_s = statistics.median(r["load_s"] for r in runs)
+            print(f"{model:<8}{mode:<10}{load_s:>10.2f}{before:>16.0f}{after:>15.0f}{after - before:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
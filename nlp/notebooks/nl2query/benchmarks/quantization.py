@@ -0,0 +1,112 @@
+"""
+Accuracy gate and latency/memory comparison of the int8 dynamic quantization
+of the spaCy transformer and Flair NER models.
+
+The spaCy and Flair annotations (merged as in the V3 pipeline) of the CEDA
+gold queries are evaluated with query_eval.global_stats and
+query_nervaluate.nervaluate_performance, in fp32 and int8, each mode in a fresh
+interpreter. The gate fails (exit code 1) if a quality metric drops by more
+than --max-drop.
+
+    python -m nl2query.benchmarks.quantization --out /tmp/quantization --max-drop 0.02
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from configparser import ConfigParser
+
+from nl2query.benchmarks import NOTEBOOKS_DIR, annotation_quality, gold_query_texts
+
+SPACY_CONFIG = os.path.join(NOTEBOOKS_DIR, "nl2query/V1/spacy_config.cfg")
+FLAIR_CONFIG = os.path.join(NOTEBOOKS_DIR, "nl2query/V1/flair_config.cfg")
+MODES = ["fp32", "int8"]
+
+
+def mode_config(config_file: str, quantized: bool, out_dir: str) -> str:
+    """copy of a component config with the quantization enabled or disabled"""
+    config = ConfigParser()
+    config.read(config_file)
+    if not config.has_section("quantization"):
+        config.add_section("quantization")
+    config.set("quantization", "enabled", str(quantized).lower())
+    path = os.path.join(out_dir, f"{'int8' if quantized else 'fp32'}_{os.path.basename(config_file)}")
+    with open(path, "w", encoding="utf-8") as f:
+        config.write(f)
+    return path
+
+
+def run_mode(mode: str, out_dir: str) -> dict:
+    """load the NER models in this mode and annotate the gold queries,
+    write the results file and return the load and latency measures"""
+    from nl2query.NL2QueryInterface import QueryAnnotationsDict
+    from nl2query.registry import resident_memory
+    from nl2query.V1.NER_flair import NER_flair
+    from nl2query.V1.NER_spacy import NER_spacy
+    from nl2query.V3.V3_pipeline import V3_pipeline
+
+    quantized = mode == "int8"
+    rss_before = resident_memory()
+    start = time.perf_counter()
+    spacy_ner = NER_spacy(mode_config(SPACY_CONFIG, quantized, out_dir))
+    flair_ner = NER_flair(mode_config(FLAIR_CONFIG, quantized, out_dir))
+    load_s = time.perf_counter() - start
+    rss_after = resident_memory()
+
+    results = []
+    latencies = []
+    for query in gold_query_texts():
+        start = time.perf_counter()
+        annotations = V3_pipeline.merge_ner_annotations(spacy_ner.transform_nl2query(query),
+                                                        flair_ner.transform_nl2query(query))
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(QueryAnnotationsDict(query=query, annotations=annotations).to_dict())
+    with open(os.path.join(out_dir, f"{mode}_results.json"), "w", encoding="utf-8") as f:
+        json.dump({"queries": results}, f, indent=2)
+    return {
+        "load_s": load_s,
+        "model_rss_mb": (rss_after - rss_before) / 2 ** 20,
+        "query_ms_p50": statistics.median(latencies),
+        "query_ms_mean": statistics.mean(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default=None, help="directory of the results files (default: temporary)")
+    parser.add_argument("--max-drop", type=float, default=0.02, help="maximum drop of each quality metric")
+    parser.add_argument("--worker", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    out_dir = args.out or tempfile.mkdtemp(prefix="quantization_")
+    os.makedirs(out_dir, exist_ok=True)
+
+    if args.worker:
+        print(json.dumps(run_mode(args.worker, out_dir)))
+        return
+
+    summary = {}
+    for mode in MODES:
+        proc = subprocess.run([sys.executable, "-m", "nl2query.benchmarks.quantization", "--worker", mode,
+                               "--out", out_dir], cwd=NOTEBOOKS_DIR, capture_output=True, text=True, check=True)
+        summary[mode] = json.loads(proc.stdout.strip().splitlines()[-1])
+        summary[mode].update(annotation_quality(os.path.join(out_dir, f"{mode}_results.json")))
+
+    print(f"\n{'metric':<36}" + "".join(f"{mode:>12}" for mode in MODES) + f"{'ratio':>10}")
+    for metric in summary["fp32"]:
+        fp32, int8 = summary["fp32"][metric], summary["int8"][metric]
+        ratio = fp32 / int8 if int8 else float("nan")
+        print(f"{metric:<36}{fp32:>12.3f}{int8:>12.3f}{ratio:>10.2f}")
+    drops = {metric: summary["fp32"][metric] - summary["int8"][metric] for metric in summary["fp32"]
+             if metric.startswith(("span_", "nervaluate_"))}
+    failed = {metric: round(drop, 4) for metric, drop in drops.items() if drop > args.max_drop}
+    print(f"\nAccuracy gate (max drop {args.max_drop}): {'FAILED ' + str(failed) if failed else 'passed'}")
+    print("Results written in", out_dir)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Load time, resident memory, per-query latency, batch throughput and NER quality
+on the CEDA gold queries of spaCy models and execution profiles.
+
+Each variant is given as model:profile (profile full or entities) and runs in a fresh
+interpreter. The latency is the spaCy processing of one query, the throughput the
+processing of all the gold queries with nlp.pipe. The quality is measured on the
+NER_spacy annotations (without geocoding) with query_eval.global_stats and nervaluate.
+
+    python -m nl2query.benchmarks.spacy_profile --variants en_core_web_trf:full en_core_web_trf:entities \
+        en_core_web_lg:entities en_core_web_sm:entities --batch-size 32
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from configparser import ConfigParser
+
+from nl2query.benchmarks import NOTEBOOKS_DIR, annotation_quality, gold_query_texts
+
+SPACY_CONFIG = os.path.join(NOTEBOOKS_DIR, "nl2query/V1/spacy_config.cfg")
+VARIANTS = ["en_core_web_trf:full", "en_core_web_trf:entities", "en_core_web_lg:entities", "en_core_web_sm:entities"]
+
+
+def variant_config(model: str, profile: str, out_dir: str) -> str:
+    """copy of the spaCy config with the given model (without fallback) and profile"""
+    config = ConfigParser()
+    config.read(SPACY_CONFIG)
+    if model != config.get("components.ner", "source"):
+        config.set("components.ner", "version", "")
+    config.set("components.ner", "source", model)
+    config.set("components.ner", "fallback", "")
+    config.set("profile", "name", profile)
+    path = os.path.join(out_dir, f"{model}_{profile}_config.cfg")
+    with open(path, "w", encoding="utf-8") as f:
+        config.write(f)
+    return path
+
+
+def run_variant(variant: str, out_dir: str, batch_size: int, repeat: int) -> dict:
+    """load the variant, measure it on the gold queries and write its results file"""
+    from nl2query.registry import resident_memory
+    from nl2query.V1.NER_spacy import NER_spacy
+
+    model, profile = variant.split(":")
+    # the variant selects the model, not the deployment
+    os.environ.pop("NL2QUERY_SPACY_MODEL", None)
+    queries = gold_query_texts()
+    rss_before = resident_memory()
+    start = time.perf_counter()
+    ner = NER_spacy(variant_config(model, profile, out_dir))
+    load_s = time.perf_counter() - start
+    rss_after = resident_memory()
+
+    latencies = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            ner.spacy_engine(query)
+            latencies.append((time.perf_counter() - start) * 1000)
+    start = time.perf_counter()
+    docs = list(ner.spacy_engine.pipe(queries, batch_size=batch_size))
+    throughput = len(docs) / (time.perf_counter() - start)
+
+    # only the span and type of the entities are evaluated, skip the geocoding of the locations
+    results = [ner.doc_annotations(doc, geocode=False).to_dict() for doc in docs]
+    with open(os.path.join(out_dir, f"{model}_{profile}_results.json"), "w", encoding="utf-8") as f:
+        json.dump({"queries": results}, f, indent=2)
+    return {
+        "components": len(ner.spacy_engine.pipe_names),
+        "load_s": load_s,
+        "model_rss_mb": (rss_after - rss_before) / 2 ** 20,
+        "query_ms_p50": statistics.median(latencies),
+        "query_ms_mean": statistics.mean(latencies),
+        "batch_queries_per_s": throughput,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--variants", nargs="+", default=VARIANTS, help="model:profile variants to compare")
+    parser.add_argument("--batch-size", type=int, default=32, help="nlp.pipe batch size of the throughput")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of the per-query latency")
+    parser.add_argument("--out", default=None, help="directory of the results files (default: temporary)")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    out_dir = args.out or tempfile.mkdtemp(prefix="spacy_profile_")
+    os.makedirs(out_dir, exist_ok=True)
+
+    if args.worker:
+        print(json.dumps(run_variant(args.worker, out_dir, args.batch_size, args.repeat)))
+        return
+
+    summary = {}
+    for variant in args.variants:
+        proc = subprocess.run([sys.executable, "-m", "nl2query.benchmarks.spacy_profile", "--worker", variant,
+                               "--out", out_dir, "--batch-size", str(args.batch_size), "--repeat", str(args.repeat)],
+                              cwd=NOTEBOOKS_DIR, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"{variant} failed:\n{proc.stderr.strip()[-2000:]}")
+            continue
+        summary[variant] = json.loads(proc.stdout.strip().splitlines()[-1])
+        model, profile = variant.split(":")
+        summary[variant].update(annotation_quality(os.path.join(out_dir, f"{model}_{profile}_results.json")))
+
+    if not summary:
+        sys.exit(1)
+    variants = list(summary)
+    print(f"\n{'metric':<36}" + "".join(f"{variant:>28}" for variant in variants))
+    for metric in summary[variants[0]]:
+        print(f"{metric:<36}" + "".join(f"{summary[variant][metric]:>28.3f}" for variant in variants))
+    print("Results written in", out_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Compare the per n-gram encoding of the query n-grams with the span-pooled
+encoding (one forward pass of the query) used by the vector searches.
+
+- latency: time of the target and property n-gram searches of every CEDA gold query
+- quality: query_eval.global_stats of the pipeline results on the CEDA gold set
+
+    python -m nl2query.benchmarks.span_pooling --version V2 --out /tmp/span_pooling
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+from nl2q_eval.query_eval import global_stats
+from nl2query.benchmarks import create_pipeline, gold_query_texts, read_gold_queries
+from nl2query.V2.Vdb_simsearch import ENCODINGS
+
+
+def time_searches(vdbs, queries, repeat: int = 3):
+    """best time in ms over repeated runs of the n-gram target and property searches of each query"""
+    latencies = []
+    for query in queries:
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            vdbs.query_ngram_target(query)
+            vdbs.query_ngram_prop(query)
+            runs.append((time.perf_counter() - start) * 1000)
+        latencies.append(min(runs))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--version", default="V2", choices=["V2", "V3"], help="pipeline version")
+    parser.add_argument("--out", default=None, help="directory to write the results and evaluation of each mode")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of the latency measure per query")
+    args = parser.parse_args()
+
+    pipeline = create_pipeline(args.version)
+    vdbs = pipeline.vdbs if args.version == "V2" else pipeline.v2_instance.vdbs
+    gold = read_gold_queries()
+    queries = gold_query_texts()
+    summary = {}
+    for encoding in ENCODINGS:
+        vdbs.encoding = encoding
+        latencies = time_searches(vdbs, queries, args.repeat)
+        results = [pipeline.transform_nl2query(query).to_dict() for query in queries]
+        stats = global_stats(gold, {"queries": results})
+        span = stats.span_measures.get_span_metrics("global")
+        attr = stats.attribute_measures.get_attribute_metrics("global")
+        summary[encoding] = {
+            "search_ms_mean": statistics.mean(latencies),
+            "search_ms_p50": statistics.median(latencies),
+            "search_ms_max": max(latencies),
+            "span_perfect_match_type_match": span.perfect_match_type_match,
+            "span_overlapping_type_match_avg": span.overlapping_span_type_match.avg,
+            "attribute_perfect_match_precision": attr.perfect_match_precision,
+            "attribute_match_avg": attr.attribute_match.avg,
+        }
+        if args.out:
+            os.makedirs(args.out, exist_ok=True)
+            with open(os.path.join(args.out, f"{encoding}_results.json"), "w", encoding="utf-8") as f:
+                json.dump({"queries": results}, f, indent=2)
+            with open(os.path.join(args.out, f"{encoding}_eval_out.json"), "w", encoding="utf-8") as f:
+                json.dump(stats.to_dict(), f, indent=2)
+
+    print(f"\n{'metric':<36}" + "".join(f"{encoding:>14}" for encoding in ENCODINGS))
+    for metric in summary[ENCODINGS[0]]:
+        print(f"{metric:<36}" + "".join(f"{summary[encoding][metric]:>14.3f}" for encoding in ENCODINGS))
+
+
+if __name__ == "__main__":
+    main()
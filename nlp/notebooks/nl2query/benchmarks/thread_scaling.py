@@ -0,0 +1,129 @@
+"""
+Throughput and latency of concurrent worker processes on one node,
+for every combination of number of workers and threads per worker.
+
+Each worker is a fresh interpreter with its thread budget (NL2QUERY_THREADS),
+it loads the target model or pipeline, then all the workers annotate the CEDA
+gold queries at the same time. The best split of the node cores between
+workers and threads is the one with the highest throughput at an acceptable p99.
+
+    python -m nl2query.benchmarks.thread_scaling --target spacy --workers 1 2 4 --threads 1 2 4
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import List
+
+from nl2query.benchmarks import NOTEBOOKS_DIR
+from nl2query.threads import available_cpus
+
+# code defining run(query) for each target
+TARGETS = {
+    "spacy": "from nl2query.V1.NER_spacy import NER_spacy\n"
+             "ner = NER_spacy('nl2query/V1/spacy_config.cfg')\n"
+             "run = ner.spacy_engine",
+    "flair": "from nl2query.V1.NER_flair import NER_flair\n"
+             "run = NER_flair('nl2query/V1/flair_config.cfg').transform_nl2query",
+    "e5": "from nl2query.V2.Vdb_simsearch import load_embeddings\n"
+          "run = load_embeddings().embed_query",
+    "V1": "from nl2query.benchmarks import create_pipeline\nrun = create_pipeline('V1').transform_nl2query",
+    "V2": "from nl2query.benchmarks import create_pipeline\nrun = create_pipeline('V2').transform_nl2query",
+    "V3": "from nl2query.benchmarks import create_pipeline\nrun = create_pipeline('V3').transform_nl2query",
+}
+
+WORKER = """
+import json, sys, time
+from nl2query.benchmarks import gold_query_texts
+from nl2query.threads import ThreadBudget
+ThreadBudget.from_config(None).apply()
+{load}
+ThreadBudget.from_config(None).apply()
+queries = gold_query_texts()
+run(queries[0])
+print("ready", flush=True)
+sys.stdin.readline()
+latencies = []
+for _ in range({repeat}):
+    for query in queries:
+        start = time.perf_counter()
+        run(query)
+        latencies.append(time.perf_counter() - start)
+print(json.dumps(latencies), flush=True)
+"""
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def measure(target: str, workers: int, threads: int, repeat: int) -> dict:
+    """start the workers, wait until all are loaded, then time them annotating the gold queries together"""
+    env = dict(os.environ, NL2QUERY_THREADS=str(threads), NL2QUERY_WORKERS=str(workers))
+    code = WORKER.format(load=TARGETS[target], repeat=repeat)
+    procs = [subprocess.Popen([sys.executable, "-c", code], cwd=NOTEBOOKS_DIR, env=env, text=True,
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+             for _ in range(workers)]
+    try:
+        for proc in procs:
+            while proc.stdout.readline().strip() != "ready":
+                if proc.poll() is not None:
+                    raise RuntimeError(f"Worker of {target} failed with code {proc.returncode}")
+        start = time.perf_counter()
+        for proc in procs:
+            proc.stdin.write("\n")
+            proc.stdin.flush()
+        latencies = []
+        for proc in procs:
+            latencies += json.loads(proc.stdout.readline())
+        wall = time.perf_counter() - start
+    finally:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+    return {
+        "workers": workers,
+        "threads": threads,
+        "queries_per_s": len(latencies) / wall,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=list(TARGETS), default="spacy")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--repeat", type=int, default=1, help="passes on the gold queries per worker")
+    parser.add_argument("--oversubscribe", action="store_true",
+                        help="also run the splits using more threads than available cores")
+    parser.add_argument("--out", default=None, help="json file of the results")
+    args = parser.parse_args()
+
+    cpus = available_cpus()
+    print(f"{cpus} available cores, target {args.target}")
+    print(f"{'workers':>8}{'threads':>8}{'queries/s':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    results = []
+    for workers in args.workers:
+        for threads in args.threads:
+            if workers * threads > cpus and not args.oversubscribe:
+                continue
+            result = measure(args.target, workers, threads, args.repeat)
+            results.append(result)
+            print(f"{workers:>8}{threads:>8}{result['queries_per_s']:>12.2f}"
+                  f"{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}")
+    if results:
+        best = max(results, key=lambda result: result["queries_per_s"])
+        print(f"Best throughput: {best['workers']} workers x {best['threads']} threads")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"cpus": cpus, "target": args.target, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Throughput of the pre-fork worker pool on the CEDA gold queries for an increasing
+number of workers, compared to annotating them in the parent process.
+The memory of the workers is reported as their summed RSS (which counts the shared
+model pages once per worker) and summed PSS (which divides them between the workers).
+
+    python -m nl2query.benchmarks.worker_pool --version V3 --workers 1 2 4 --repeat 2
+"""
+import argparse
+import json
+import time
+from typing import Optional
+
+from nl2query.benchmarks import create_pipeline, gold_query_texts
+from nl2query.worker_pool import WorkerPool, load_pipeline
+
+
+def process_memory(pid: int) -> Optional[dict]:
+    """RSS and PSS (MB) of a process from /proc/<pid>/smaps_rollup, None if not available"""
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r", encoding="utf-8") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ["Rss", "Pss"]:
+                    memory[name.lower() + "_mb"] = int(value.split()[0]) / 1024
+    except OSError:
+        return None
+    return memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--version", choices=["V1", "V2", "V3"], default="V3")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, default=1, help="torch and BLAS threads per worker")
+    parser.add_argument("--chunksize", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1, help="passes on the gold queries")
+    parser.add_argument("--out", default=None, help="json file of the results")
+    args = parser.parse_args()
+
+    queries = gold_query_texts() * args.repeat
+    pipeline = load_pipeline(lambda: create_pipeline(args.version))
+    start = time.perf_counter()
+    for query in queries:
+        pipeline.transform_nl2query(query)
+    results = [{"workers": 0, "queries_per_s": len(queries) / (time.perf_counter() - start)}]
+    print(f"{'workers':>8}{'queries/s':>12}{'speedup':>10}{'sum RSS MB':>12}{'sum PSS MB':>12}")
+    print(f"{'parent':>8}{results[0]['queries_per_s']:>12.2f}")
+    for workers in args.workers:
+        with WorkerPool(pipeline, workers=workers, threads=args.threads, chunksize=args.chunksize) as pool:
+            # first tasks on each worker are not timed
+            pool.map(queries[:workers])
+            start = time.perf_counter()
+            pool.map(queries)
+            result = {"workers": workers, "queries_per_s": len(queries) / (time.perf_counter() - start)}
+            memory = [process_memory(pid) for pid in pool.worker_pids()]
+        if all(memory):
+            result["sum_rss_mb"] = sum(m["rss_mb"] for m in memory)
+            result["sum_pss_mb"] = sum(m["pss_mb"] for m in memory)
+        results.append(result)
+        print(f"{workers:>8}{result['queries_per_s']:>12.2f}"
+              f"{result['queries_per_s'] / results[0]['queries_per_s']:>10.2f}"
+              f"{result.get('sum_rss_mb', float('nan')):>12.0f}{result.get('sum_pss_mb', float('nan')):>12.0f}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"version": args.version, "threads": args.threads, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
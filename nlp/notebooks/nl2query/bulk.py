@@ -0,0 +1,162 @@
+"""
+Bulk annotation of large query files (ex: search logs) by shards on several nodes.
+
+Each node runs one shard of the input, the shards take every shard-count-th
+query so that they are deterministic and balanced. The shard outputs and
+checkpoints are written to a directory of a shared filesystem (see
+nl2query.runner, an interrupted shard resumes where it stopped):
+
+    python -m nl2query.bulk run logs.jsonl out/ --version V3 --shard-index 0 --shard-count 4 --workers 8
+    ...
+    python -m nl2query.bulk run logs.jsonl out/ --version V3 --shard-index 3 --shard-count 4 --workers 8
+
+The merge restores the input order of the results and combines the statistics of the shards:
+
+    python -m nl2query.bulk merge out/ logs_annotations.jsonl
+
+No scheduler is needed, any launcher (ssh, cron, a job array) can run the shards
+(from the notebooks directory, as the paths of the configs are relative to it).
+"""
+import argparse
+import glob
+import heapq
+import json
+import os
+import re
+import sys
+from functools import partial
+from typing import Dict, List
+
+from nl2query.NL2QueryInterface import dumps
+from nl2query.runner import read_checkpoint, read_results, run_dataset
+
+SHARD_PATTERN = re.compile(r"shard-(\d+)-of-(\d+)\.jsonl$")
+
+
+def shard_path(output_dir: str, shard_index: int, shard_count: int) -> str:
+    return os.path.join(output_dir, f"shard-{shard_index:05d}-of-{shard_count:05d}.jsonl")
+
+
+def run_shard(input_path: str, output_dir: str, version: str, shard_index: int = 0, shard_count: int = 1,
+              v1_config: str = None, v2_config: str = None, workers: int = 0, threads: int = None,
+              batch_size: int = 64, verbose: bool = False) -> dict:
+    """annotate a shard of the input with a pipeline, in forked worker processes if workers > 0"""
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard index {shard_index} is not in [0, {shard_count})!")
+    # the bulk runs use the [cache] section of the configs (repeated queries of the logs), unlike the benchmarks,
+    # the forked workers open their own SQLite connection (journal_mode = DELETE on a shared filesystem)
+    os.environ.setdefault("NL2QUERY_CACHE", "1")
+    from nl2query.benchmarks import V1_CONFIG, V2_CONFIG, create_pipeline
+    from nl2query.worker_pool import WorkerPool, load_pipeline
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = shard_path(output_dir, shard_index, shard_count)
+    checkpoint = read_checkpoint(output_path + ".checkpoint")
+    if checkpoint and checkpoint["done"]:
+        # nothing to do, without loading the models
+        return checkpoint
+    factory = partial(create_pipeline, version, v1_config or V1_CONFIG, v2_config or V2_CONFIG)
+    if workers:
+        with WorkerPool(load_pipeline(factory), workers=workers, threads=threads) as pool:
+            return run_dataset(pool.map, input_path, output_path, batch_size=batch_size, verbose=verbose,
+                               shard_index=shard_index, shard_count=shard_count)
+    pipeline = factory()
+    return run_dataset(pipeline.transform_nl2query_batch, input_path, output_path, batch_size=batch_size,
+                       verbose=verbose, shard_index=shard_index, shard_count=shard_count)
+
+
+def shard_outputs(output_dir: str) -> Dict[int, str]:
+    """shard outputs of a directory by shard index, all of them must be from the same shard count"""
+    shards = {}
+    counts = set()
+    for path in glob.glob(os.path.join(output_dir, "shard-*-of-*.jsonl")):
+        match = SHARD_PATTERN.search(path)
+        if match:
+            shards[int(match.group(1))] = path
+            counts.add(int(match.group(2)))
+    if len(counts) != 1:
+        raise ValueError(f"Expected the shard outputs of a single shard count in {output_dir}, found: {counts}")
+    shard_count = counts.pop()
+    missing = [index for index in range(shard_count) if index not in shards]
+    if missing:
+        raise ValueError(f"Missing shards {missing} of {shard_count} in {output_dir}!")
+    return shards
+
+
+def merge_stats(checkpoints: List[dict]) -> dict:
+    """statistics of the shards combined: totals, slowest shard and throughput"""
+    queries = sum(checkpoint["queries"] for checkpoint in checkpoints)
+    annotate_s = sum(checkpoint["annotate_s"] for checkpoint in checkpoints)
+    elapsed_s = max((checkpoint["elapsed_s"] for checkpoint in checkpoints), default=0.0)
+    return {
+        "shards": len(checkpoints),
+        "done": all(checkpoint["done"] for checkpoint in checkpoints),
+        "queries": queries,
+        "errors": sum(checkpoint["errors"] for checkpoint in checkpoints),
+        "annotate_s": annotate_s,
+        "annotate_ms_per_query": annotate_s / queries * 1000 if queries else 0.0,
+        "slowest_shard_s": elapsed_s,
+        "queries_per_s": queries / elapsed_s if elapsed_s else 0.0,
+        "shard_elapsed_s": [checkpoint["elapsed_s"] for checkpoint in checkpoints],
+    }
+
+
+def merge_shards(output_dir: str, merged_path: str, allow_partial: bool = False) -> dict:
+    """merge the shard outputs into one JSON lines file in input order, write and return the combined statistics"""
+    shards = shard_outputs(output_dir)
+    checkpoints = [read_checkpoint(shards[index] + ".checkpoint") for index in sorted(shards)]
+    unfinished = [index for index, checkpoint in zip(sorted(shards), checkpoints)
+                  if not checkpoint or not checkpoint["done"]]
+    if unfinished and not allow_partial:
+        raise ValueError(f"Shards {unfinished} are not done!")
+    inputs = {checkpoint["input"] for checkpoint in checkpoints if checkpoint}
+    if len(inputs) > 1:
+        raise ValueError(f"The shards of {output_dir} are from different inputs: {sorted(inputs)}")
+    stats = merge_stats([checkpoint for checkpoint in checkpoints if checkpoint])
+    # each shard is in input order, a k-way merge restores the order of the input
+    merged = heapq.merge(*[read_results(shards[index]) for index in sorted(shards)],
+                         key=lambda result: result["index"])
+    with open(merged_path, "wb") as f:
+        for result in merged:
+            f.write(dumps(result).encode("utf-8") + b"\n")
+    with open(merged_path + ".stats.json", "w", encoding="utf-8") as f:
+        json.dump(stats, f, indent=2)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="annotate a shard of the input")
+    run.add_argument("input", help="JSON lines (or gold format JSON) queries")
+    run.add_argument("output_dir", help="directory of the shard outputs, on a filesystem shared by the nodes")
+    run.add_argument("--version", choices=["V1", "V2", "V3"], default="V3")
+    run.add_argument("--v1-config", default=None, help="V1 config of the V1 and V3 pipelines")
+    run.add_argument("--v2-config", default=None, help="V2 config of the V2 and V3 pipelines")
+    run.add_argument("--shard-index", type=int, default=0)
+    run.add_argument("--shard-count", type=int, default=1)
+    run.add_argument("--workers", type=int, default=0, help="forked worker processes (0: annotate in this process)")
+    run.add_argument("--threads", type=int, default=None, help="torch and BLAS threads per worker")
+    run.add_argument("--batch-size", type=int, default=64, help="queries per batch (and checkpoint)")
+    run.add_argument("--verbose", action="store_true", help="print the progress")
+    merge = commands.add_parser("merge", help="merge the shard outputs in input order")
+    merge.add_argument("output_dir", help="directory of the shard outputs")
+    merge.add_argument("merged", help="merged JSON lines results")
+    merge.add_argument("--allow-partial", action="store_true", help="merge even if shards are not done")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "run":
+            stats = run_shard(args.input, args.output_dir, args.version, args.shard_index, args.shard_count,
+                              args.v1_config, args.v2_config, args.workers, args.threads, args.batch_size,
+                              args.verbose)
+        else:
+            stats = merge_shards(args.output_dir, args.merged, args.allow_partial)
+    except ValueError as exc:
+        print(exc)
+        sys.exit(1)
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
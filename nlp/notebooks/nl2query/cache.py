@@ -0,0 +1,511 @@
+"""
+Cache of the pipeline and stage results.
+
+The results of transform_nl2query and of the costly stages (NER models, Duckling,
+geocoding, vector searches) are kept by key: the stage name, the query (or stage
+arguments) and a fingerprint of everything the result depends on: the
+config files and the files they reference (vocabularies, vector databases, component
+configs), the model manifest, the library versions and the nl2query code.
+
+Only the normalized queries (see normalize_query) are cached, the others are
+transformed as given since the positions of the annotations refer to the query.
+
+Two tiers: an in-memory LRU per process and, if enabled, an SQLite file shared by the
+processes and kept between sessions, whose entries expire after max_age_days (ex: those of
+previous fingerprints) and are capped to max_rows. The results are stored as JSON
+(see encode_result), never as pickles: reading the file cannot run code.
+Concurrent requests of the same key in a process (threads or coroutines of the
+asynchronous API) wait for the first one instead of computing it again (single flight).
+
+The SQLite connection is opened on first use by each process: a process forked
+from another one (ex: the workers of nl2query.worker_pool) opens its own connection,
+lock and in flight requests instead of using those of its parent.
+
+Results depending on the current date (the Duckling answers, relative ones as
+"last 10 years" or "#currentdate", and the pipeline results with temporal annotations)
+are tagged with the day they were computed and are only valid on that day.
+"""
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from configparser import ConfigParser
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from importlib.metadata import PackageNotFoundError, version as get_package_version
+from typing import Any, Awaitable, Callable, List, Optional, Sequence, Tuple, Union
+
+from nl2query.artifacts import MANIFEST, store_dir
+from nl2query.metrics import record_cache_lookup
+from nl2query.NL2QueryInterface import Annotation, QueryAnnotationsDict, dumps, loads
+from nl2query.tracing import add_count
+
+NL2QUERY_DIR = os.path.dirname(os.path.realpath(__file__))
+# SQLite journal modes, WAL is not supported on network filesystems (NFS, shared filesystems of multi-node runs)
+JOURNAL_MODES = ["WAL", "DELETE", "TRUNCATE", "PERSIST"]
+# libraries whose version changes the results
+FINGERPRINT_PACKAGES = ["spacy", "spacy-transformers", "flair", "torch", "transformers", "sentence-transformers",
+                        "langchain", "chromadb", "osmnx", "nltk"]
+
+
+def normalize_query(query: str) -> str:
+    """unicode NFC form with the whitespace runs collapsed and stripped"""
+    return " ".join(unicodedata.normalize("NFC", query).split())
+
+
+def today() -> str:
+    return datetime.date.today().isoformat()
+
+
+def add_path(sha, path: str) -> None:
+    """add a file contents, or the names and sizes of a directory files, to a hash"""
+    sha.update(path.encode("utf-8"))
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                sha.update(f"{os.path.relpath(file_path, path)}:{os.path.getsize(file_path)}".encode("utf-8"))
+    elif os.path.isfile(path):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b""):
+                sha.update(chunk)
+
+
+@lru_cache(maxsize=None)
+def code_fingerprint() -> str:
+    """hash of the nl2query sources and of the versions of the libraries producing the results"""
+    sha = hashlib.sha1()
+    for root, dirs, files in os.walk(NL2QUERY_DIR):
+        dirs[:] = sorted(d for d in dirs if d not in ["__pycache__", "benchmarks"])
+        for file in sorted(files):
+            if file.endswith(".py"):
+                add_path(sha, os.path.join(root, file))
+    add_path(sha, MANIFEST)
+    for package in FINGERPRINT_PACKAGES:
+        try:
+            sha.update(f"{package}=={get_package_version(package)}".encode("utf-8"))
+        except PackageNotFoundError:
+            pass
+    return sha.hexdigest()
+
+
+def config_fingerprint(config_file: str) -> str:
+    """hash of a config file, of the files and directories it references (recursively for the configs)
+    and of the code and libraries"""
+    sha = hashlib.sha1(code_fingerprint().encode("utf-8"))
+    visited = set()
+
+    def add_config(path):
+        if path in visited:
+            return
+        visited.add(path)
+        add_path(sha, path)
+        config = ConfigParser(interpolation=None)
+        config.read(path)
+        for section in config.sections():
+            for _, value in config.items(section):
+                value = value.strip().strip('"')
+                if not value or "\n" in value:
+                    continue
+                if os.path.isfile(value) and value.endswith(".cfg"):
+                    add_config(value)
+                elif os.path.exists(value):
+                    add_path(sha, value)
+    add_config(config_file)
+    return sha.hexdigest()
+
+
+def encode_result(result: Any) -> Any:
+    """JSON compatible form of a result: the annotations, tuples and GeoDataFrames
+    (geocoding) are tagged to be rebuilt by decode_result"""
+    if isinstance(result, QueryAnnotationsDict):
+        return {"__result__": "annotations", "data": result.to_dict()}
+    if isinstance(result, Annotation):
+        return {"__result__": "annotation", "data": result.to_dict()}
+    if isinstance(result, tuple):
+        return {"__result__": "tuple", "data": [encode_result(value) for value in result]}
+    if isinstance(result, list):
+        return [encode_result(value) for value in result]
+    if isinstance(result, dict):
+        return {key: encode_result(value) for key, value in result.items()}
+    if type(result).__name__ == "GeoDataFrame":
+        return {"__result__": "geodataframe", "data": json.loads(result.to_json()),
+                "crs": result.crs.to_string() if result.crs is not None else None}
+    if type(result).__module__ == "numpy" and hasattr(result, "tolist"):
+        return result.tolist()
+    return result
+
+
+def decode_result(data: Any) -> Any:
+    """result of its encode_result form"""
+    if isinstance(data, list):
+        return [decode_result(value) for value in data]
+    if not isinstance(data, dict):
+        return data
+    result_type = data.get("__result__")
+    if result_type == "annotations":
+        return QueryAnnotationsDict.from_dict(data["data"])
+    if result_type == "annotation":
+        return Annotation.from_dict(data["data"])
+    if result_type == "tuple":
+        return tuple(decode_result(value) for value in data["data"])
+    if result_type == "geodataframe":
+        import geopandas as gpd
+        return gpd.GeoDataFrame.from_features(data["data"]["features"], crs=data["crs"])
+    return {key: decode_result(value) for key, value in data.items()}
+
+
+def serialize(result: Any) -> str:
+    return dumps(encode_result(result))
+
+
+def deserialize(value: str) -> Any:
+    return decode_result(loads(value))
+
+
+class ResultCache:
+    """ class of a two tier (memory LRU and SQLite) cache of JSON serialized results with single flight:
+    - path: SQLite file (None: memory only)
+    - max_items: results kept in memory
+    - max_age_days: days after which the SQLite results are removed (0: never)
+    - max_rows: SQLite results kept, the oldest ones are removed (0: no limit)
+    - journal_mode: SQLite journal mode, WAL or DELETE (TRUNCATE, PERSIST) on network filesystems
+    """
+    # results stored between two prunings of the SQLite file
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: Optional[str] = None, max_items: int = 1024, max_age_days: float = 30,
+                 max_rows: int = 100000, journal_mode: str = "WAL"):
+        if journal_mode.upper() not in JOURNAL_MODES:
+            raise ValueError(f"Unknown SQLite journal mode [{journal_mode}]! Must be one of: {JOURNAL_MODES}")
+        self.path = path
+        self.max_items = max_items
+        self.max_age_days = max_age_days
+        self.max_rows = max_rows
+        self.journal_mode = journal_mode.upper()
+        self.stores = 0
+        # key -> (day or "", serialized result), least recently used first
+        self.memory = OrderedDict()  # type: OrderedDict[str, Tuple[str, str]]
+        self.stats = {"memory_hits": 0, "sqlite_hits": 0, "shared": 0, "misses": 0, "expired": 0}
+        # connections inherited from a parent process, never used nor closed (see after_fork)
+        self.inherited = []
+        self.pid = None
+        self.after_fork()
+
+    def after_fork(self) -> None:
+        """new lock, in flight requests and SQLite connection (opened on first use) of the current process"""
+        self.lock = threading.Lock()
+        # key -> future of its computation
+        self.in_flight = {}
+        if self.pid not in [None, os.getpid()] and self.db is not None:
+            # closing the connection of the parent may checkpoint and remove its WAL file
+            self.inherited.append(self.db)
+        self.db = None
+        self.pid = os.getpid()
+
+    def connection(self) -> Optional[sqlite3.Connection]:
+        """SQLite connection of the current process, opened on first use (None: memory only)"""
+        if self.pid != os.getpid():
+            self.after_fork()
+        if self.db is not None or not self.path:
+            return self.db
+        with self.lock:
+            opened = self.db is None
+            if opened:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+                self.db.execute(f"PRAGMA journal_mode={self.journal_mode}")
+                self.db.execute("CREATE TABLE IF NOT EXISTS results "
+                                "(key TEXT PRIMARY KEY, stage TEXT, day TEXT, value BLOB, created REAL)")
+        if opened:
+            self.prune()
+        return self.db
+
+    def close(self) -> None:
+        """close the SQLite connection, opened again on next use (ex: before forking workers)"""
+        if self.pid != os.getpid():
+            self.after_fork()
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def prune(self) -> None:
+        """remove the SQLite results expired (older than max_age_days or of a previous day) then the oldest ones"""
+        db = self.connection()
+        if db is None:
+            return
+        with self.lock:
+            db.execute("DELETE FROM results WHERE (day != '' AND day < ?)"
+                            " OR (? > 0 AND created < julianday('now') - ?)",
+                            (today(), self.max_age_days, self.max_age_days))
+            if self.max_rows:
+                db.execute("DELETE FROM results WHERE key IN (SELECT key FROM results"
+                           " ORDER BY created DESC, rowid DESC LIMIT -1 OFFSET ?)", (self.max_rows,))
+
+    @staticmethod
+    def key(stage: str, fingerprint: str, args: Sequence[Any]) -> str:
+        return hashlib.sha1(json.dumps([stage, fingerprint, list(args)], sort_keys=True,
+                                       default=repr).encode("utf-8")).hexdigest()
+
+    def lookup(self, key: str) -> Optional[str]:
+        """serialized result of a key valid today, from memory then SQLite"""
+        db = self.connection()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                tier = "memory_hits"
+            elif db is not None:
+                row = db.execute("SELECT day, value FROM results WHERE key = ?", (key,)).fetchone()
+                entry = tuple(row) if row else None
+                tier = "sqlite_hits"
+            if entry is None:
+                return None
+            day, value = entry
+            if day and day != today():
+                self.stats["expired"] += 1
+                self.memory.pop(key, None)
+                if db is not None:
+                    db.execute("DELETE FROM results WHERE key = ?", (key,))
+                return None
+            self.stats[tier] += 1
+            if tier == "sqlite_hits":
+                self.remember(key, day, value)
+            return value
+
+    def remember(self, key: str, day: str, value: str) -> None:
+        self.memory[key] = (day, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def store(self, key: str, stage: str, day: str, value: str) -> None:
+        db = self.connection()
+        with self.lock:
+            self.remember(key, day, value)
+            if db is not None:
+                db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, julianday('now'))",
+                           (key, stage, day, value))
+            self.stores += 1
+            prune = db is not None and self.stores % self.PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+
+    def get(self, stage: str, fingerprint: str, args: Sequence[Any]) -> Tuple[bool, Any]:
+        """(True, copy of the result) if cached and valid today, otherwise (False, None)"""
+        value = self.lookup(self.key(stage, fingerprint, args))
+        return (False, None) if value is None else (True, deserialize(value))
+
+    def put(self, stage: str, fingerprint: str, args: Sequence[Any], result: Any,
+            dated: Union[bool, Callable[[Any], bool]] = False) -> str:
+        """cache a result, dated tells (or is a function of the result telling) if it depends on the current date,
+        return its serialized form"""
+        value = serialize(result)
+        is_dated = dated(result) if callable(dated) else dated
+        self.store(self.key(stage, fingerprint, args), stage, today() if is_dated else "", value)
+        return value
+
+    def get_or_compute(self, stage: str, fingerprint: str, args: Sequence[Any], compute: Callable[[], Any],
+                       dated: Union[bool, Callable[[Any], bool]] = False) -> Any:
+        """Cached result of compute() for the stage, fingerprint and arguments, computed once
+        for the concurrent calls. The results are copies, they can be modified by the caller."""
+        found, result = self.get(stage, fingerprint, args)
+        if found:
+            record_cache_lookup(stage, "hit")
+            return result
+        key = self.key(stage, fingerprint, args)
+        owner, future = self.claim(key)
+        if not owner:
+            record_cache_lookup(stage, "shared")
+            return deserialize(future.result())
+        record_cache_lookup(stage, "miss")
+        with self.computing(key, future):
+            result = compute()
+            future.set_result(self.put(stage, fingerprint, args, result, dated))
+        return result
+
+    async def aget_or_compute(self, stage: str, fingerprint: str, args: Sequence[Any],
+                              compute: Callable[[], Awaitable[Any]],
+                              dated: Union[bool, Callable[[Any], bool]] = False) -> Any:
+        """get_or_compute of a coroutine function, the concurrent calls (coroutines or threads) wait
+        for the first one without blocking the event loop"""
+        found, result = self.get(stage, fingerprint, args)
+        if found:
+            record_cache_lookup(stage, "hit")
+            return result
+        key = self.key(stage, fingerprint, args)
+        owner, future = self.claim(key)
+        if not owner:
+            record_cache_lookup(stage, "shared")
+            return deserialize(await asyncio.wrap_future(future))
+        record_cache_lookup(stage, "miss")
+        with self.computing(key, future):
+            result = await compute()
+            future.set_result(self.put(stage, fingerprint, args, result, dated))
+        return result
+
+    def claim(self, key: str) -> Tuple[bool, Future]:
+        """(True, new future) for the first request of a key being computed, otherwise (False, its future)"""
+        if self.pid != os.getpid():
+            self.after_fork()
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.stats["shared"] += 1
+                return False, future
+            future = self.in_flight[key] = Future()
+            return True, future
+
+    @contextmanager
+    def computing(self, key: str, future: Future):
+        """release a claimed key, its future gets the exception if the computation fails"""
+        try:
+            yield
+            self.stats["misses"] += 1
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+    def clear(self) -> None:
+        db = self.connection()
+        with self.lock:
+            self.memory.clear()
+            if db is not None:
+                db.execute("DELETE FROM results")
+
+
+@lru_cache(maxsize=None)
+def get_cache(path: Optional[str], max_items: int, max_age_days: float = 30, max_rows: int = 100000,
+              journal_mode: str = "WAL") -> ResultCache:
+    """cache shared by the pipelines of the process using the same SQLite file"""
+    return ResultCache(path, max_items, max_age_days, max_rows, journal_mode)
+
+
+def pipeline_cache(config, *config_files: str) -> Tuple[Optional[ResultCache], str]:
+    """cache of the [cache] section of a pipeline config and the fingerprint of the pipeline
+    from its config files, (None, "") if disabled (also by NL2QUERY_CACHE=0)"""
+    if os.getenv("NL2QUERY_CACHE", "").lower() in ["0", "false", "no", "off"]:
+        return None, ""
+    if not config or not config.getboolean("cache", "enabled", fallback=False):
+        return None, ""
+    path = None
+    if config.getboolean("cache", "sqlite", fallback=False):
+        path = config.get("cache", "path", fallback="") or os.path.join(store_dir(), "results.sqlite")
+    cache = get_cache(path, config.getint("cache", "max_items", fallback=1024),
+                      config.getfloat("cache", "max_age_days", fallback=30),
+                      config.getint("cache", "max_rows", fallback=100000),
+                      config.get("cache", "journal_mode", fallback="WAL"))
+    if not config_files:
+        return cache, code_fingerprint()
+    sha = hashlib.sha1()
+    for config_file in config_files:
+        sha.update(config_fingerprint(config_file).encode("utf-8"))
+    return cache, sha.hexdigest()
+
+
+def cached_call(cache: Optional[ResultCache], stage: str, fingerprint: str, compute: Callable[[], Any],
+                args: Sequence[Any], dated: Union[bool, Callable[[Any], bool]] = False) -> Any:
+    """result of compute() from the cache if any, otherwise computed"""
+    if cache is None:
+        return compute()
+    computed = []
+
+    def counted_compute():
+        computed.append(True)
+        return compute()
+    result = cache.get_or_compute(stage, fingerprint, args, counted_compute, dated)
+    add_count("cache_misses" if computed else "cache_hits")
+    return result
+
+
+async def acached_call(cache: Optional[ResultCache], stage: str, fingerprint: str,
+                       compute: Callable[[], Awaitable[Any]], args: Sequence[Any],
+                       dated: Union[bool, Callable[[Any], bool]] = False) -> Any:
+    """result of await compute() from the cache if any, otherwise computed"""
+    if cache is None:
+        return await compute()
+    computed = []
+
+    async def counted_compute():
+        computed.append(True)
+        return await compute()
+    result = await cache.aget_or_compute(stage, fingerprint, args, counted_compute, dated)
+    add_count("cache_misses" if computed else "cache_hits")
+    return result
+
+
+def has_temporal(result) -> bool:
+    """query annotations with a temporal annotation, whose value may be relative to the current date"""
+    return any(getattr(annotation, "annot_type", None) == "tempex" for annotation in result.annotations)
+
+
+def cacheable(nlq: str) -> bool:
+    """if the results of a query are cached: the annotation positions of the other queries
+    would refer to their normalized form"""
+    return nlq == normalize_query(nlq)
+
+
+def cached_transform(method):
+    """Cache the results of a transform_nl2query method by (normalized) query,
+    with the result_cache and cache_fingerprint of the pipeline. The verbose calls are not cached."""
+    @wraps(method)
+    def transform(self, nlq: str, verbose: bool = False):
+        cache = getattr(self, "result_cache", None)
+        if cache is None or verbose or not cacheable(nlq):
+            return method(self, nlq, verbose)
+        return cache.get_or_compute(f"{type(self).__name__}.transform_nl2query", self.cache_fingerprint, [nlq],
+                                    lambda: method(self, nlq, verbose), dated=has_temporal)
+    return transform
+
+
+def acached_transform(method):
+    """cached_transform of an atransform_nl2query coroutine method, sharing the results of transform_nl2query"""
+    @wraps(method)
+    async def atransform(self, nlq: str, verbose: bool = False):
+        cache = getattr(self, "result_cache", None)
+        if cache is None or verbose or not cacheable(nlq):
+            return await method(self, nlq, verbose)
+        return await cache.aget_or_compute(f"{type(self).__name__}.transform_nl2query", self.cache_fingerprint,
+                                           [nlq], lambda: method(self, nlq, verbose), dated=has_temporal)
+    return atransform
+
+
+def cached_transform_batch(method):
+    """Cache the results of a transform_nl2query_batch method like cached_transform,
+    only the queries not in the cache are transformed (as one batch)."""
+    @wraps(method)
+    def transform_batch(self, nlqs: List[str], verbose: bool = False):
+        cache = getattr(self, "result_cache", None)
+        if cache is None or verbose:
+            return method(self, nlqs, verbose)
+        stage = f"{type(self).__name__}.transform_nl2query"
+        values = {}
+        for query in nlqs:
+            if query in values or not cacheable(query):
+                continue
+            value = cache.lookup(cache.key(stage, self.cache_fingerprint, [query]))
+            if value is not None:
+                values[query] = value
+                record_cache_lookup(stage, "hit")
+        missing = [query for query in dict.fromkeys(nlqs) if query not in values]
+        if missing:
+            for query, result in zip(missing, method(self, missing, verbose)):
+                if cacheable(query):
+                    values[query] = cache.put(stage, self.cache_fingerprint, [query], result, dated=has_temporal)
+                    record_cache_lookup(stage, "miss")
+                    cache.stats["misses"] += 1
+                else:
+                    values[query] = serialize(result)
+        return [deserialize(values[query]) for query in nlqs]
+    return transform_batch
@@ -0,0 +1,126 @@
+"""
+Fusion of the annotations of several sources (ex: spaCy and Flair) into
+non-overlapping annotations.
+
+The candidates of all the sources are sorted once by the policy, then
+accepted in that order when none of their intervals overlaps an accepted one
+(the accepted intervals are disjoint, so a binary search over their starts
+finds the only neighbours to check). A split position ([[s1, e1], [s2, e2]])
+is a set of intervals, all of them must be free. Empty intervals never overlap.
+The annotations of the kept sources are all accepted first, even when they
+overlap each other, and the other ones are fused around them.
+
+Policies (``[fusion]`` section of the config):
+
+    [fusion]
+    policy = priority       # priority: the first source wins, longest: the longest span wins
+    sources = spacy, flair  # source order, ties of the longest policy
+    tempex = flair, spacy   # type specific source order (property, location, tempex, target)
+"""
+import bisect
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from nl2query.NL2QueryInterface import ANNOTATION_TYPES, Annotation
+
+POLICIES = ["priority", "longest"]
+
+
+def intervals(position: List) -> List[Tuple[int, int]]:
+    """intervals of a position, [start, end] or the [[start, end], ...] of a split span"""
+    if position and isinstance(position[0], (list, tuple)):
+        return [(p[0], p[-1]) for p in position]
+    return [(position[0], position[-1])]
+
+
+class AnnotationFusion:
+    """ class to merge the annotations of several sources:
+    - policy: priority (source order) or longest (longest span, then source order)
+    - sources: source names, in order of priority
+    - type_sources: source order by annotation type, overriding sources for that type
+    """
+
+    def __init__(self, policy: str = "priority", sources: Sequence[str] = (),
+                 type_sources: Optional[Dict[str, Sequence[str]]] = None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown fusion policy [{policy}]! Must be one of: {POLICIES}")
+        self.policy = policy
+        self.sources = list(sources)
+        self.type_sources = {annot_type: list(order) for annot_type, order in (type_sources or {}).items()}
+        unknown = [annot_type for annot_type in self.type_sources if annot_type not in ANNOTATION_TYPES]
+        if unknown:
+            raise ValueError(f"Unknown annotation types {unknown} in the fusion rules!")
+
+    @classmethod
+    def from_config(cls, config, section: str = "fusion", sources: Sequence[str] = ()) -> "AnnotationFusion":
+        """fusion of a config section, sources is the default source order"""
+        def names(value: str) -> List[str]:
+            return [name.strip() for name in value.split(",") if name.strip()]
+        if not config.has_section(section):
+            return cls(sources=sources)
+        return cls(policy=config.get(section, "policy", fallback="priority"),
+                   sources=names(config.get(section, "sources", fallback=",".join(sources))),
+                   type_sources={annot_type: names(config.get(section, annot_type))
+                                 for annot_type in ANNOTATION_TYPES if config.has_option(section, annot_type)})
+
+    def rank(self, source: str, annot_type: str) -> int:
+        """rank of a source for an annotation type, the unlisted sources come after the listed ones"""
+        order = self.type_sources.get(annot_type, self.sources)
+        if source in order:
+            return order.index(source)
+        return len(order) + (self.sources.index(source) if source in self.sources else len(self.sources))
+
+    def fuse(self, sources: Dict[str, Optional[List[Annotation]]], keep: Sequence[str] = ()) -> List[Annotation]:
+        """non-overlapping annotations of the sources (None: disabled source), sorted by start,
+        all the annotations of the keep sources are accepted"""
+        starts, ends, accepted = [], [], []
+        for source in keep:
+            for annotation in sources.get(source) or []:
+                spans = intervals(annotation.position)
+                for start, end in spans:
+                    self.occupy(starts, ends, start, end)
+                accepted.append((spans[0][0], annotation))
+
+        candidates = []
+        for order, (source, annotations) in enumerate(sources.items()):
+            if source in keep:
+                continue
+            for i, annotation in enumerate(annotations or []):
+                spans = intervals(annotation.position)
+                length = sum(end - start for start, end in spans)
+                rank = (self.rank(source, annotation.annot_type), order)
+                key = (rank, -length) if self.policy == "priority" else (-length, rank)
+                candidates.append((key + (spans[0][0], i), spans, annotation))
+        candidates.sort(key=lambda candidate: candidate[0])
+
+        for _, spans, annotation in candidates:
+            if any(self.overlaps(starts, ends, start, end) for start, end in spans):
+                continue
+            for start, end in spans:
+                self.occupy(starts, ends, start, end)
+            accepted.append((spans[0][0], annotation))
+        accepted.sort(key=lambda item: item[0])
+        return [annotation for _, annotation in accepted]
+
+    @staticmethod
+    def occupy(starts: List[int], ends: List[int], start: int, end: int) -> None:
+        """add [start, end) to the disjoint sorted intervals, merged with the ones it overlaps"""
+        # empty intervals do not overlap anything
+        if end <= start:
+            return
+        first = bisect.bisect_left(starts, start)
+        if first > 0 and ends[first - 1] > start:
+            first -= 1
+        last = bisect.bisect_left(starts, end)
+        if last > first:
+            start, end = min(start, starts[first]), max(end, ends[last - 1])
+        starts[first:last] = [start]
+        ends[first:last] = [end]
+
+    @staticmethod
+    def overlaps(starts: List[int], ends: List[int], start: int, end: int) -> bool:
+        """whether [start, end) overlaps one of the disjoint sorted intervals"""
+        if end <= start:
+            return False
+        index = bisect.bisect_left(starts, start)
+        # only the previous interval may end after start, and the next one start before end
+        return (index > 0 and ends[index - 1] > start) or (index < len(starts) and starts[index] < end)
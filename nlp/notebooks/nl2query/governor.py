@@ -0,0 +1,139 @@
+"""
+Memory governor of the loaded pipelines.
+
+The pipelines are kept in least recently used order and are released
+(with the models they own in the registry) when they are idle for longer
+than the idle timeout, or when the resident memory of the process is above
+the budget. Released pipelines are loaded again on their next use.
+"""
+import contextlib
+import gc
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterator, List, Optional
+
+from nl2query.registry import resident_memory
+
+
+def trim_memory() -> None:
+    """collect the released objects and return the freed heap memory to the system"""
+    gc.collect()
+    try:
+        import ctypes
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def rss_mb() -> Optional[float]:
+    rss = resident_memory()
+    return None if rss is None else round(rss / 2 ** 20, 1)
+
+
+class MemoryGovernor:
+    """ class to release the least recently used pipelines:
+    - budget_mb: resident memory budget of the process (None to disable)
+    - idle_timeout: seconds without use after which a pipeline is released (None to disable)
+    - release: function called with the name of the pipeline to release
+    """
+
+    def __init__(self, release: Callable[[str], None], budget_mb: Optional[float] = None,
+                 idle_timeout: Optional[float] = None, check_interval: float = 60.0):
+        self.release = release
+        self.budget_mb = budget_mb
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        # pipeline name -> last use time, least recently used first
+        self.last_used = OrderedDict()  # type: OrderedDict[str, float]
+        # version -> number of queries running it
+        self.in_use = {}
+        self.events = []  # type: List[dict]
+        self.lock = threading.RLock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def loaded(self, name: str) -> None:
+        """register a loaded pipeline, then enforce the budget on the other ones"""
+        with self.lock:
+            self.last_used[name] = time.monotonic()
+            self.last_used.move_to_end(name)
+        self.enforce(keep=name)
+
+    @contextlib.contextmanager
+    def using(self, name: str) -> Iterator[None]:
+        """mark a pipeline as used (never released) in this context"""
+        with self.lock:
+            self.in_use[name] = self.in_use.get(name, 0) + 1
+            if name in self.last_used:
+                self.last_used.move_to_end(name)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_use[name] -= 1
+                if name in self.last_used:
+                    self.last_used[name] = time.monotonic()
+
+    def evict(self, name: str, reason: str) -> dict:
+        """release a pipeline and record the eviction event"""
+        with self.lock:
+            self.last_used.pop(name, None)
+        before = rss_mb()
+        self.release(name)
+        trim_memory()
+        event = {"time": time.time(), "pipeline": name, "reason": reason,
+                 "rss_before_mb": before, "rss_after_mb": rss_mb()}
+        with self.lock:
+            self.events.append(event)
+        print(f"Released pipeline {name} ({reason}): RSS {before} MB -> {event['rss_after_mb']} MB")
+        return event
+
+    def evictable(self, keep: Optional[str] = None) -> List[str]:
+        """pipelines that can be released, least recently used first"""
+        with self.lock:
+            return [name for name in self.last_used if name != keep and not self.in_use.get(name)]
+
+    def enforce(self, keep: Optional[str] = None) -> List[dict]:
+        """Release the idle pipelines, then the least recently used ones while above budget.
+        keep is never released. Return the eviction events."""
+        events = []
+        if self.idle_timeout is not None:
+            now = time.monotonic()
+            for name in self.evictable(keep):
+                if now - self.last_used.get(name, now) > self.idle_timeout:
+                    events.append(self.evict(name, "idle"))
+        if self.budget_mb is not None:
+            while (rss_mb() or 0) > self.budget_mb:
+                candidates = self.evictable(keep)
+                if not candidates:
+                    break
+                events.append(self.evict(candidates[0], "budget"))
+        return events
+
+    def residency(self) -> List[dict]:
+        """loaded pipelines, least recently used first, with their idle time"""
+        now = time.monotonic()
+        with self.lock:
+            return [{"pipeline": name, "idle_s": round(now - last, 1), "in_use": bool(self.in_use.get(name))}
+                    for name, last in self.last_used.items()]
+
+    def start(self) -> None:
+        """check the idle pipelines periodically in a background thread"""
+        if self.thread is None and self.idle_timeout is not None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, name="memory-governor", daemon=True)
+            self.thread.start()
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.check_interval):
+            try:
+                self.enforce()
+            except Exception as exc:
+                print("Memory governor check failed:", exc)
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,347 @@
+"""
+Process-wide metrics of the pipelines: counters, gauges and latency histograms.
+
+Unlike the traces (see nl2query.tracing), which describe one query, the metrics
+aggregate every query of the process since it started (or since METRICS.reset()):
+
+- nl2query_requests_total{service}: requests to the external services
+  (duckling, nominatim, geogratis, vector_db, stac), with their errors, timeouts
+  and latency histogram (nl2query_request_seconds)
+- nl2query_stage_seconds{stage}: latency histogram of the pipeline stages
+- nl2query_cache_lookups_total{stage, result}: lookups of the result cache (hit, shared, miss)
+- nl2query_model_load_seconds{component}: load time of the shared models
+
+The annotation service exports them in the Prometheus text format (GET /metrics),
+and a notebook can print them:
+
+    from nl2query.metrics import METRICS, print_summary
+    print_summary()                # requests, errors, latencies and cache hit ratios
+    METRICS.dump("metrics.prom")   # Prometheus text format (printed without path)
+
+    with request_timer("duckling"):
+        ...
+
+The metrics are per process, each worker of a WorkerPool has its own.
+"""
+import asyncio
+import math
+import threading
+import time
+from functools import wraps
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# latency buckets (seconds), up to the slow geocoding and model calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """ class of a counter by label values """
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}  # type: Dict[Tuple[str, ...], float]
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values: str, n: float = 1) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + n
+
+    def get(self, *label_values: str) -> float:
+        return self.values.get(label_values, 0)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.values.clear()
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """(name, labels, value) of the Prometheus samples"""
+        with self.lock:
+            return [(self.name, format_labels(self.labels, label_values), value)
+                    for label_values, value in sorted(self.values.items())]
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {",".join(label_values): value for label_values, value in sorted(self.values.items())}
+
+
+class Gauge(Counter):
+    """ class of a gauge (last value) by label values """
+    kind = "gauge"
+
+    def set(self, *label_values: str, value: float) -> None:
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Counter):
+    """ class of a histogram of observations by label values, with the Prometheus cumulative buckets """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.values = {}  # type: Dict[Tuple[str, ...], list]
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                # per bucket counts, then sum and count
+                counts = self.values[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def get(self, *label_values: str) -> float:
+        """number of observations"""
+        counts = self.values.get(label_values)
+        return counts[-1] if counts else 0
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        samples = []
+        with self.lock:
+            for label_values, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((self.name + "_bucket",
+                                    format_labels(self.labels + ("le",), label_values + (format_value(bound),)),
+                                    cumulative))
+                labels = format_labels(self.labels, label_values)
+                samples.append((self.name + "_sum", labels, counts[-2]))
+                samples.append((self.name + "_count", labels, counts[-1]))
+        return samples
+
+    def quantile(self, q: float, *label_values: str) -> Optional[float]:
+        """upper bound of the bucket of the q quantile, None without observations"""
+        with self.lock:
+            counts = self.values.get(label_values)
+            if not counts:
+                return None
+            rank = q * counts[-1]
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                if cumulative >= rank:
+                    return bound
+        return None
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            items = sorted(self.values.items())
+        return {",".join(label_values): {"count": counts[-1], "sum": counts[-2],
+                                         "mean": counts[-2] / counts[-1] if counts[-1] else 0.0,
+                                         "p50": self.quantile(0.5, *label_values),
+                                         "p95": self.quantile(0.95, *label_values)}
+                for label_values, counts in items}
+
+
+class MetricsRegistry:
+    """ class of the metrics of a process by name """
+
+    def __init__(self):
+        self.metrics = {}  # type: Dict[str, Counter]
+        self.lock = threading.Lock()
+
+    def register(self, metric: Counter) -> Counter:
+        """the registered metric of the same name, or the new one"""
+        with self.lock:
+            registered = self.metrics.setdefault(metric.name, metric)
+        if type(registered) is not type(metric) or registered.labels != metric.labels:
+            raise ValueError(f"Metric [{metric.name}] is already registered as a {registered.kind} "
+                             f"with labels {list(registered.labels)}!")
+        return registered
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def reset(self) -> None:
+        """forget the values of all the metrics"""
+        for metric in list(self.metrics.values()):
+            metric.reset()
+
+    def to_prometheus(self) -> str:
+        """metrics in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for sample, labels, value in metric.samples():
+                lines.append(f"{sample}{labels} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """values of the metrics by name, then by comma separated label values"""
+        return {name: metric.snapshot() for name, metric in sorted(self.metrics.items())}
+
+    def dump(self, path: Optional[str] = None) -> None:
+        """write the metrics in the Prometheus text format to a file, or print them"""
+        text = self.to_prometheus()
+        if path is None:
+            print(text, end="")
+            return
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+# metrics of the process, exported by the annotation service
+METRICS = MetricsRegistry()
+REQUESTS = METRICS.counter("nl2query_requests_total", "Requests to the external services.", ["service"])
+REQUEST_ERRORS = METRICS.counter("nl2query_request_errors_total",
+                                 "Failed requests to the external services, timeouts included.", ["service"])
+REQUEST_TIMEOUTS = METRICS.counter("nl2query_request_timeouts_total",
+                                   "Requests to the external services that timed out.", ["service"])
+REQUEST_SECONDS = METRICS.histogram("nl2query_request_seconds", "Latency of the requests to the external services.",
+                                    ["service"])
+STAGE_SECONDS = METRICS.histogram("nl2query_stage_seconds", "Latency of the pipeline stages.", ["stage"])
+CACHE_LOOKUPS = METRICS.counter("nl2query_cache_lookups_total",
+                                "Lookups of the result cache by stage and result (hit, shared, miss).",
+                                ["stage", "result"])
+MODEL_LOAD_SECONDS = METRICS.gauge("nl2query_model_load_seconds", "Load time of the shared models.", ["component"])
+
+
+def is_timeout(exc: BaseException) -> bool:
+    """if an exception, or one it was raised from, is a timeout (builtin, requests, httpx, asyncio)"""
+    while exc is not None:
+        if isinstance(exc, (TimeoutError, asyncio.TimeoutError)) \
+                or any("Timeout" in cls.__name__ for cls in type(exc).__mro__):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+class RequestTimer:
+    """ class measuring a request to an external service: count, errors, timeouts and latency """
+    __slots__ = ("service", "start", "failed")
+
+    def __init__(self, service: str):
+        self.service = service
+        self.failed = False
+
+    def error(self) -> None:
+        """count the request as failed without an exception (ex: an error status)"""
+        self.failed = True
+
+    def __enter__(self) -> "RequestTimer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        REQUEST_SECONDS.observe(time.perf_counter() - self.start, self.service)
+        REQUESTS.inc(self.service)
+        if self.failed or isinstance(exc, Exception):
+            REQUEST_ERRORS.inc(self.service)
+            if is_timeout(exc):
+                REQUEST_TIMEOUTS.inc(self.service)
+
+
+class StageTimer:
+    """ class measuring the latency of a pipeline stage """
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self) -> "StageTimer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, self.stage)
+
+
+def request_timer(service: str) -> RequestTimer:
+    return RequestTimer(service)
+
+
+def stage_timer(stage: str) -> StageTimer:
+    return StageTimer(stage)
+
+
+def timed(timer, name: str):
+    """decorator measuring a function or coroutine function with timer(name)"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def awrapper(*args, **kwargs):
+                with timer(name):
+                    return await func(*args, **kwargs)
+            return awrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_request(service: str):
+    """decorator measuring each call as a request to an external service"""
+    return timed(RequestTimer, service)
+
+
+def timed_stage(stage: str):
+    """decorator measuring the latency of a pipeline stage"""
+    return timed(StageTimer, stage)
+
+
+def record_cache_lookup(stage: str, result: str) -> None:
+    """count a lookup of the result cache: hit, shared (computed by a concurrent call) or miss"""
+    CACHE_LOOKUPS.inc(stage, result)
+
+
+def record_model_load(component: str, seconds: float) -> None:
+    MODEL_LOAD_SECONDS.set(component, value=seconds)
+
+
+def cache_hit_ratios() -> Dict[str, float]:
+    """ratio of the lookups found in the cache (or computed by a concurrent call) by stage"""
+    with CACHE_LOOKUPS.lock:
+        counts = list(CACHE_LOOKUPS.values.items())
+    lookups = {}
+    for (stage, result), count in counts:
+        hits, total = lookups.get(stage, (0, 0))
+        lookups[stage] = (hits + (count if result != "miss" else 0), total + count)
+    return {stage: hits / total for stage, (hits, total) in lookups.items() if total}
+
+
+def print_summary() -> None:
+    """print the requests to the external services with their errors and latencies, and the cache hit ratios"""
+    latencies = REQUEST_SECONDS.snapshot()
+    print(f"{'service':<12}{'requests':>10}{'errors':>8}{'timeouts':>10}{'mean ms':>10}{'p95 ms':>10}")
+    for service, count in REQUESTS.snapshot().items():
+        latency = latencies.get(service, {"mean": 0.0, "p95": None})
+        p95 = "-" if latency["p95"] in [None, math.inf] else round(latency["p95"] * 1000)
+        print(f"{service:<12}{int(count):>10}{int(REQUEST_ERRORS.get(service)):>8}"
+              f"{int(REQUEST_TIMEOUTS.get(service)):>10}{latency['mean'] * 1000:>10.1f}{p95:>10}")
+    for stage, ratio in sorted(cache_hit_ratios().items()):
+        print(f"cache hits of {stage}: {ratio:.1%}")
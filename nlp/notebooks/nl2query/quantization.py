@@ -0,0 +1,34 @@
+"""
+Dynamic int8 quantization of the PyTorch NER models on CPU.
+
+The weights of the linear layers are converted to int8 once at load time,
+and their activations are quantized on the fly at each call, which speeds up
+the transformer layers of en_core_web_trf and Flair ner-large on CPUs
+at the cost of a small accuracy loss (see nl2query.benchmarks.quantization).
+"""
+from typing import List
+
+# torch.nn layer types that can be quantized dynamically
+QUANTIZABLE_LAYERS = ["Linear", "LSTM", "GRU"]
+
+
+def quantization_layers(config) -> List[str]:
+    """layer types to quantize from the [quantization] section of a component config, empty if disabled"""
+    if not config or not config.getboolean("quantization", "enabled", fallback=False):
+        return []
+    layers = [name.strip() for name in config.get("quantization", "layers", fallback="Linear").split(",")]
+    unknown = [name for name in layers if name not in QUANTIZABLE_LAYERS]
+    if unknown:
+        raise ValueError(f"Unknown layers to quantize {unknown}! Must be in: {QUANTIZABLE_LAYERS}")
+    return layers
+
+
+def quantize_dynamic(module, layers: List[str]):
+    """replace in place the given layer types of a module by their dynamically quantized int8 version"""
+    import torch
+
+    engines = torch.backends.quantized.supported_engines
+    if torch.backends.quantized.engine in [None, "none"]:
+        torch.backends.quantized.engine = "fbgemm" if "fbgemm" in engines else engines[0]
+    return torch.ao.quantization.quantize_dynamic(module, {getattr(torch.nn, name) for name in layers},
+                                                  dtype=torch.qint8, inplace=True)
@@ -0,0 +1,215 @@
+"""
+Process-wide registry of the loaded models.
+
+The pipelines get their components (spaCy, Flair, HeidelTime, textsearch
+vocabularies, vector databases) from the registry instead of constructing
+them, so that V1, V2 and V3 share a single instance of each model per
+resolved configuration:
+
+    spacy_instance = shared(NER_spacy, "nl2query/V1/spacy_config.cfg")
+
+The shared instance is the instance itself. The methods changing its state between
+calls (ex: the temporary file of HeidelTime) are decorated with ``@synchronized``
+to hold a per-instance lock, the others run concurrently. The state of a query
+is rather kept in a context variable (ex: Vdb_simsearch.query_state).
+
+The instances obtained while constructing a pipeline inside ``MODELS.owner(name)``
+are released with ``MODELS.release_owner(name)`` once no other owner uses them.
+"""
+import contextlib
+import contextvars
+import functools
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from nl2query.metrics import record_model_load
+
+# owner (ex: pipeline version) of the instances obtained in the current context
+CURRENT_OWNER = contextvars.ContextVar("CURRENT_OWNER", default=None)
+
+
+def resident_memory() -> Optional[int]:
+    """resident set size (bytes) of the current process, None if unknown"""
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+
+def config_key(value: Any) -> Any:
+    """Hashable key of a constructor argument.
+    A path to an existing file is resolved to its absolute path and the hash of its contents,
+    so that the same config given with different relative paths shares the same instance."""
+    if isinstance(value, str) and os.path.isfile(value):
+        with open(value, "rb") as f:
+            return os.path.realpath(value), hashlib.sha1(f.read()).hexdigest()
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), config_key(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(config_key(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(config_key(v) for v in value))
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    # simple option objects (ex: NgramFilter) are compared by their attributes
+    return type(value).__qualname__, config_key(vars(value))
+
+
+def instance_lock(instance: Any) -> threading.RLock:
+    """lock of an instance, created on first use"""
+    # dict.setdefault is atomic, the threads get the same lock
+    return instance.__dict__.setdefault("_shared_lock", threading.RLock())
+
+
+def synchronized(method):
+    """decorator serializing the calls of a method changing the state of a shared instance"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with instance_lock(self):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class RegistryEntry:
+    """ class definition of a registry entry: the shared instance and its loading measures """
+
+    def __init__(self, component: str, key: Tuple, instance: Any,
+                 rss_bytes: Optional[int], load_time: float):
+        self.component = component
+        self.key = key
+        self.instance = instance
+        self.rss_bytes = rss_bytes
+        self.load_time = load_time
+        # number of times the instance was handed out
+        self.refs = 0
+        # owners using the instance, the instance is never released if obtained without owner
+        self.owners = set()
+        self.pinned = False
+
+    def add_ref(self, owner: Optional[str]) -> None:
+        self.refs += 1
+        if owner is None:
+            self.pinned = True
+        else:
+            self.owners.add(owner)
+
+    def to_dict(self) -> dict:
+        return {
+            "component": self.component,
+            "config": self.key,
+            "rss_mb": None if self.rss_bytes is None else round(self.rss_bytes / 2 ** 20, 1),
+            "load_s": round(self.load_time, 2),
+            "refs": self.refs,
+            "owners": sorted(self.owners),
+        }
+
+
+class ModelRegistry:
+    """ class to create and share one instance per component class and resolved configuration """
+
+    def __init__(self):
+        self.entries = {}  # type: Dict[Tuple, RegistryEntry]
+        self.lock = threading.Lock()
+        # models are loaded one at a time so that the memory measured for each is its own
+        self.load_lock = threading.Lock()
+
+    def get(self, cls: type, *args, **kwargs) -> Any:
+        """Return the shared instance of cls(*args, **kwargs), creating it on first use."""
+        component = f"{cls.__module__}.{cls.__qualname__}"
+        key = (component, config_key(args), config_key(kwargs))
+        owner = CURRENT_OWNER.get()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                entry.add_ref(owner)
+                return entry.instance
+        with self.load_lock:
+            # created by another thread while waiting
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry:
+                    entry.add_ref(owner)
+                    return entry.instance
+            rss_before = resident_memory()
+            start = time.perf_counter()
+            instance = cls(*args, **kwargs)
+            load_time = time.perf_counter() - start
+            record_model_load(component, load_time)
+            rss_after = resident_memory()
+            rss_bytes = None if rss_before is None or rss_after is None else max(rss_after - rss_before, 0)
+            with self.lock:
+                entry = RegistryEntry(component, key, instance, rss_bytes, load_time)
+                entry.add_ref(owner)
+                self.entries[key] = entry
+            return instance
+
+    @contextlib.contextmanager
+    def owner(self, name: str) -> Iterator[None]:
+        """record name as the owner of the instances obtained in this context"""
+        token = CURRENT_OWNER.set(name)
+        try:
+            yield
+        finally:
+            CURRENT_OWNER.reset(token)
+
+    def release_owner(self, name: str) -> List[dict]:
+        """Remove an owner from the instances it uses.
+        Forget the instances left without owner, which are freed once no longer referenced.
+        Return the released entries."""
+        released = []
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if name not in entry.owners:
+                    continue
+                entry.owners.discard(name)
+                if not entry.owners and not entry.pinned:
+                    released.append(entry.to_dict())
+                    del self.entries[key]
+        return released
+
+    def residency(self) -> Dict[str, List[str]]:
+        """loaded components per owner"""
+        owners = {}
+        with self.lock:
+            for entry in self.entries.values():
+                for owner in entry.owners:
+                    owners.setdefault(owner, []).append(entry.component)
+        return owners
+
+    def memory_report(self) -> List[dict]:
+        """loaded components with the resident memory added by their loading"""
+        with self.lock:
+            return [entry.to_dict() for entry in self.entries.values()]
+
+    def print_memory_report(self) -> None:
+        report = self.memory_report()
+        total = sum(entry["rss_mb"] or 0 for entry in report)
+        print(f"{'component':<50}{'rss MB':>10}{'load s':>10}{'refs':>6}  owners")
+        for entry in report:
+            rss = "?" if entry["rss_mb"] is None else entry["rss_mb"]
+            print(f"{entry['component']:<50}{rss:>10}{entry['load_s']:>10}{entry['refs']:>6}  "
+                  f"{','.join(entry['owners'])}")
+        print(f"{'total':<50}{round(total, 1):>10}")
+
+    def clear(self) -> None:
+        """forget all instances (they are freed once the pipelines using them are)"""
+        with self.lock:
+            self.entries.clear()
+
+
+# registry shared by all the pipelines of the process
+MODELS = ModelRegistry()
+
+
+def shared(cls: type, *args, **kwargs) -> Any:
+    """shared instance of cls(*args, **kwargs) from the process registry"""
+    return MODELS.get(cls, *args, **kwargs)
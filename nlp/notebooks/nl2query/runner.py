@@ -0,0 +1,179 @@
+"""
+Streaming, resumable annotation of query datasets.
+
+The queries are read one at a time from a JSON file of the gold format
+({"queries": [{"query": ...}, ...]}) or from a JSON lines file (one query
+string or {"query": ...} object per line, a text line is also a query),
+annotated by batches and written as JSON lines as soon as their batch is done:
+
+    {"index": 0, "query": "...", "annotations": [...]}
+    {"index": 1, "query": "...", "error": "ValueError: ..."}
+
+After each batch the output is flushed and a checkpoint (<output>.checkpoint)
+records the completed queries, the size of the output and the position in the
+input, so that a crashed run resumes after its last batch (the lines of an
+unfinished batch are truncated from the output).
+
+    results = run_dataset(pipeline.transform_nl2query_batch, "logs.jsonl", "logs_annotations.jsonl")
+"""
+import json
+import os
+import tempfile
+import time
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from nl2query.NL2QueryInterface import QueryAnnotationsDict, dumps, loads
+
+GOLD_QUERIES = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                             "../nl2q_eval/ceda_gold_queries.json"))
+
+
+def query_text(item) -> str:
+    """query of a dataset item, a string or an object with a query"""
+    return item if isinstance(item, str) else item["query"]
+
+
+def in_shard(index: int, shard_index: int, shard_count: int) -> bool:
+    """whether the query of an input index belongs to a shard, the shards take every shard_count-th query"""
+    return index % shard_count == shard_index
+
+
+def iter_queries(input_path: str, start: int = 0, offset: Optional[int] = None, shard_index: int = 0,
+                 shard_count: int = 1) -> Iterator[Tuple[int, str, int]]:
+    """(index, query, input offset after it) of the queries of a shard from the start index,
+    a JSON lines input is streamed and seeked to the offset of the start index when known"""
+    if input_path.endswith(".json"):
+        with open(input_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        items = data["queries"] if isinstance(data, dict) else data
+        for index in range(start, len(items)):
+            if in_shard(index, shard_index, shard_count):
+                yield index, query_text(items[index]), index + 1
+        return
+    with open(input_path, "rb") as f:
+        index = 0
+        if offset is not None:
+            f.seek(offset)
+            index = start
+        for line in iter(f.readline, b""):
+            line = line.strip()
+            if not line:
+                continue
+            if index >= start and in_shard(index, shard_index, shard_count):
+                item = loads(line) if line[:1] in (b"{", b'"') else line.decode("utf-8")
+                yield index, query_text(item), f.tell()
+            index += 1
+
+
+def read_checkpoint(checkpoint_path: str) -> Optional[dict]:
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_checkpoint(checkpoint_path: str, checkpoint: dict) -> None:
+    """replace the checkpoint atomically, a crash leaves the previous one"""
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, checkpoint_path)
+
+
+def annotate_batch(annotate: Callable[[List[str]], List[QueryAnnotationsDict]],
+                   queries: List[str]) -> List[dict]:
+    """result dicts of a batch, the queries of a failing batch are annotated one at a time
+    so that only the failing ones get an error"""
+    try:
+        return [result.to_dict() for result in annotate(queries)]
+    except Exception as exc:
+        if len(queries) == 1:
+            return [{"query": queries[0], "error": f"{type(exc).__name__}: {exc}"}]
+        return [result for query in queries for result in annotate_batch(annotate, [query])]
+
+
+def run_dataset(annotate: Callable[[List[str]], List[QueryAnnotationsDict]], input_path: str, output_path: str,
+                batch_size: int = 32, resume: bool = True, verbose: bool = False, shard_index: int = 0,
+                shard_count: int = 1) -> dict:
+    """Annotate the queries of the input (or of one of its shards) with annotate (ex: transform_nl2query_batch
+    of a pipeline) by batches, appending the results to the JSON lines output. Return the statistics of the run."""
+    checkpoint_path = output_path + ".checkpoint"
+    checkpoint = read_checkpoint(checkpoint_path) if resume else None
+    if checkpoint and (checkpoint["input"], checkpoint["shard"]) != (os.path.realpath(input_path),
+                                                                      [shard_index, shard_count]):
+        raise ValueError(f"Checkpoint {checkpoint_path} is for another input or shard: "
+                         f"{checkpoint['input']} {checkpoint['shard']}")
+    if checkpoint is None:
+        checkpoint = {"input": os.path.realpath(input_path), "shard": [shard_index, shard_count], "completed": 0,
+                      "input_offset": None, "output_offset": 0, "queries": 0, "errors": 0, "annotate_s": 0.0,
+                      "elapsed_s": 0.0, "done": False}
+    elif verbose:
+        print(f"Resuming {input_path} after {checkpoint['completed']} queries")
+
+    with open(output_path, "r+b" if os.path.exists(output_path) else "wb") as out:
+        # drop the results written after the checkpoint
+        out.truncate(checkpoint["output_offset"])
+        out.seek(checkpoint["output_offset"])
+        queries = iter_queries(input_path, checkpoint["completed"], checkpoint["input_offset"], shard_index,
+                               shard_count)
+        batch = []
+        last = time.perf_counter()
+        while True:
+            item = next(queries, None)
+            if item is not None:
+                batch.append(item)
+            if batch and (item is None or len(batch) == batch_size):
+                start = time.perf_counter()
+                results = annotate_batch(annotate, [query for _, query, _ in batch])
+                checkpoint["annotate_s"] += time.perf_counter() - start
+                for (index, _, _), result in zip(batch, results):
+                    checkpoint["errors"] += "error" in result
+                    out.write(dumps(dict(index=index, **result)).encode("utf-8") + b"\n")
+                out.flush()
+                os.fsync(out.fileno())
+                now = time.perf_counter()
+                checkpoint.update(completed=batch[-1][0] + 1, output_offset=out.tell(),
+                                  input_offset=batch[-1][2] if not input_path.endswith(".json") else None,
+                                  queries=checkpoint["queries"] + len(batch),
+                                  elapsed_s=checkpoint["elapsed_s"] + now - last)
+                last = now
+                write_checkpoint(checkpoint_path, checkpoint)
+                if verbose:
+                    print(f"{checkpoint['completed']} queries annotated, {checkpoint['errors']} errors")
+                batch = []
+            if item is None:
+                break
+    checkpoint["done"] = True
+    write_checkpoint(checkpoint_path, checkpoint)
+    return checkpoint
+
+
+def read_results(output_path: str) -> Iterator[dict]:
+    """result dicts of a JSON lines output, in order"""
+    with open(output_path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
+
+
+def run_ceda_queries(annotate: Callable[[List[str]], List[QueryAnnotationsDict]], ofile: Optional[str] = None,
+                     batch_size: int = 8, verbose: bool = True) -> List[dict]:
+    """Annotate the CEDA gold queries from the start, return the result dicts
+    and write them in the gold format to ofile if given.
+    The intermediate JSON lines and checkpoint are temporary files."""
+    fd, output_path = tempfile.mkstemp(prefix="ceda_results_", suffix=".jsonl")
+    os.close(fd)
+    try:
+        run_dataset(annotate, GOLD_QUERIES, output_path, batch_size=batch_size, resume=False, verbose=verbose)
+        struct_results = [{key: value for key, value in result.items() if key != "index"}
+                          for result in read_results(output_path)]
+    finally:
+        for path in [output_path, output_path + ".checkpoint"]:
+            if os.path.exists(path):
+                os.remove(path)
+    if ofile:
+        with open(ofile, 'w', encoding="utf-8") as f:
+            json.dump({'queries': struct_results}, f, indent=2)
+    return struct_results
@@ -0,0 +1,327 @@
+"""
+Annotation service hosting nl2query pipelines, so that all the kernels
+and users of a node share a single copy of the models.
+
+    python -m nl2query.service --versions V3 --port 8085
+    python -m nl2query.service --versions V1 V3 --unix-socket /tmp/nl2query.sock
+
+Endpoints (JSON):
+- POST /annotate        {"query": "...", "version": "V3"}     -> QueryAnnotationsDict.to_dict()
+- POST /annotate_batch  {"queries": [...], "version": "V3"}   -> {"results": [QueryAnnotationsDict.to_dict(), ...]}
+- GET  /health                                                -> hosted versions and batching statistics
+- GET  /metrics            (Prometheus text format)            -> requests to the external services, stage latencies,
+                                                                  cache lookups and model load times (nl2query.metrics)
+
+The version defaults to the first hosted one. The queries of concurrent requests
+are coalesced into micro-batches (at most max_batch queries, collected during at most
+max_wait_ms after the first one) given to the pipeline transform_nl2query_batch,
+so that the transformer forward passes run on batches.
+
+NL2QueryClient implements NL2QueryInterface on top of the service, and is used
+by NLU_demo instead of the local pipelines when NL2QUERY_SERVICE is set to the
+service URL (http://host:port or unix:///path/to/socket).
+"""
+import argparse
+import http.client
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from nl2query.metrics import METRICS
+from nl2query.NL2QueryInterface import (
+    LocationAnnotation,
+    NL2QueryInterface,
+    PropertyAnnotation,
+    QueryAnnotationsDict,
+    TargetAnnotation,
+    TemporalAnnotation,
+    dumps,
+    loads
+)
+
+
+class MicroBatcher:
+    """ class to run the queries of concurrent requests through a pipeline by micro-batches:
+    a single thread calls the pipeline, with up to max_batch queries received
+    within max_wait_ms of the first one """
+
+    def __init__(self, pipeline: NL2QueryInterface, max_batch: int = 16, max_wait_ms: float = 10.0):
+        self.pipeline = pipeline
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()  # type: queue.Queue[Optional[Tuple[str, Future]]]
+        self.stats = {"batches": 0, "queries": 0, "largest_batch": 0}
+        self.thread = threading.Thread(target=self.run, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, queries: List[str]) -> List[Future]:
+        """queue queries, return the futures of their annotations"""
+        futures = []
+        for query in queries:
+            future = Future()
+            self.queue.put((query, future))
+            futures.append(future)
+        return futures
+
+    def annotate(self, queries: List[str]) -> List[QueryAnnotationsDict]:
+        """annotations of the queries, in the same order"""
+        return [future.result() for future in self.submit(queries)]
+
+    def next_batch(self) -> Optional[List[Tuple[str, Future]]]:
+        """wait for a query, then collect the following ones until the batch is full or the window is over"""
+        item = self.queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                # stop once this batch is done
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def run(self) -> None:
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            self.process(batch)
+
+    def process(self, batch: List[Tuple[str, Future]]) -> None:
+        queries = [query for query, _ in batch]
+        self.stats["batches"] += 1
+        self.stats["queries"] += len(batch)
+        self.stats["largest_batch"] = max(self.stats["largest_batch"], len(batch))
+        try:
+            results = self.pipeline.transform_nl2query_batch(queries)
+        except Exception as exc:
+            if len(batch) == 1:
+                batch[0][1].set_exception(exc)
+                return
+            # find the failing queries one at a time, the other ones get their results
+            for item in batch:
+                self.process([item])
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+
+
+class AnnotationHandler(BaseHTTPRequestHandler):
+    """ HTTP handler of the annotation requests, the server has the micro-batchers by version """
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status: int, data: dict) -> None:
+        self.send_text(status, dumps(data), "application/json")
+
+    def send_text(self, status: int, text: str, content_type: str) -> None:
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path == "/metrics":
+            self.send_text(200, METRICS.to_prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+            return
+        if self.path != "/health":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        self.send_json(200, {"versions": list(self.server.batchers),
+                             "stats": {version: dict(batcher.stats)
+                                       for version, batcher in self.server.batchers.items()}})
+
+    def do_POST(self) -> None:
+        if self.path not in ["/annotate", "/annotate_batch"]:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            request = loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            version = request.get("version") or next(iter(self.server.batchers))
+            if version not in self.server.batchers:
+                raise KeyError(f"Pipeline version [{version}] is not hosted! Hosted: {list(self.server.batchers)}")
+            queries = [request["query"]] if self.path == "/annotate" else list(request["queries"])
+            if not all(isinstance(query, str) for query in queries):
+                raise ValueError("The queries must be strings!")
+        except (ValueError, KeyError, TypeError) as exc:
+            self.send_json(400, {"error": str(exc)})
+            return
+        try:
+            results = [result.to_dict() for result in self.server.batchers[version].annotate(queries)]
+        except Exception as exc:
+            self.send_json(500, {"error": f"{type(exc).__name__}: {exc}"})
+            return
+        self.send_json(200, results[0] if self.path == "/annotate" else {"results": results})
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ threaded HTTP server listening on a Unix socket """
+    daemon_threads = True
+
+
+def create_server(batchers: Dict[str, MicroBatcher], host: str = "127.0.0.1", port: int = 8085,
+                  unix_socket: Optional[str] = None, verbose: bool = False) -> socketserver.BaseServer:
+    """HTTP server of the micro-batchers by version, on a TCP port or a Unix socket"""
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, AnnotationHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), AnnotationHandler)
+        server.daemon_threads = True
+    server.batchers = batchers
+    server.verbose = verbose
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ HTTP connection over a Unix socket """
+
+    def __init__(self, path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class NL2QueryClient(NL2QueryInterface):
+    """ NL2query interface implemented by the annotation service:
+    - url: http://host:port or unix:///path/to/socket
+    - version: pipeline version hosted by the service (default: its first one)
+    """
+
+    def __init__(self, url: str = "http://127.0.0.1:8085", version: Optional[str] = None,
+                 timeout: float = 300.0, config_file: str = None):
+        super().__init__(config_file)
+        self.url = url
+        self.version = version
+        self.timeout = timeout
+
+    def connection(self) -> http.client.HTTPConnection:
+        parsed = urlparse(self.url)
+        if parsed.scheme == "unix":
+            return UnixHTTPConnection(parsed.path, timeout=self.timeout)
+        return http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=self.timeout)
+
+    def request(self, method: str, path: str, data: Optional[dict] = None) -> dict:
+        connection = self.connection()
+        try:
+            body = dumps(data) if data is not None else None
+            connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            result = loads(response.read() or b"{}")
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError(f"Annotation service error {response.status}: {result.get('error')}")
+        return result
+
+    def health(self) -> dict:
+        return self.request("GET", "/health")
+
+    def metrics(self) -> str:
+        """metrics of the service process in the Prometheus text format"""
+        connection = self.connection()
+        try:
+            connection.request("GET", "/metrics")
+            response = connection.getresponse()
+            text = response.read().decode("utf-8")
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError(f"Annotation service error {response.status}")
+        return text
+
+    def transform_nl2query(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        return self.create_query_annotations(self.request("POST", "/annotate",
+                                                          {"query": nlq, "version": self.version}))
+
+    def transform_nl2query_batch(self, nlqs: List[str], verbose: bool = False) -> List[QueryAnnotationsDict]:
+        results = self.request("POST", "/annotate_batch", {"queries": nlqs, "version": self.version})["results"]
+        return [self.create_query_annotations(result) for result in results]
+
+    def create_query_annotations(self, result: dict) -> QueryAnnotationsDict:
+        """query annotations from their JSON dict"""
+        create = {
+            "property": self.create_property_annotation,
+            "location": self.create_location_annotation,
+            "tempex": self.create_temporal_annotation,
+            "target": self.create_target_annotation,
+        }
+        return QueryAnnotationsDict(query=result["query"],
+                                    annotations=[create[annotation["type"]](annotation)
+                                                 for annotation in result["annotations"]],
+                                    trace=result.get("trace"))
+
+    def create_property_annotation(self, annotation: dict) -> PropertyAnnotation:
+        return PropertyAnnotation.from_dict(annotation)
+
+    def create_location_annotation(self, annotation: dict) -> LocationAnnotation:
+        return LocationAnnotation.from_dict(annotation)
+
+    def create_temporal_annotation(self, annotation: dict) -> TemporalAnnotation:
+        return TemporalAnnotation.from_dict(annotation)
+
+    def create_target_annotation(self, annotation: dict) -> TargetAnnotation:
+        return TargetAnnotation.from_dict(annotation)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--versions", nargs="+", choices=["V1", "V2", "V3"], default=["V3"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8085)
+    parser.add_argument("--unix-socket", default=None, help="listen on this Unix socket instead of the port")
+    parser.add_argument("--max-batch", type=int, default=16, help="maximum queries per micro-batch")
+    parser.add_argument("--max-wait-ms", type=float, default=10.0,
+                        help="time to wait for more queries after the first one of a micro-batch")
+    parser.add_argument("--verbose", action="store_true", help="log the requests")
+    args = parser.parse_args()
+
+    # the hosted pipelines use the [cache] section of their config, unlike the benchmarks
+    os.environ.setdefault("NL2QUERY_CACHE", "1")
+    from nl2query.benchmarks import create_pipeline
+    batchers = {version: MicroBatcher(create_pipeline(version), args.max_batch, args.max_wait_ms)
+                for version in args.versions}
+    server = create_server(batchers, args.host, args.port, args.unix_socket, args.verbose)
+    print(f"Serving {args.versions} on {args.unix_socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for batcher in batchers.values():
+            batcher.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""
+Memory-mapped snapshots of the PyTorch models.
+
+A snapshot is written once from a loaded model in the artifact store:
+- weights.safetensors: the parameters and buffers, each stored once (tied weights are aliases)
+- skeleton.pt: the pickled module with all its tensors on the meta device (no data)
+- snapshot.json: the source of the model and its revision, the library versions and the tensor aliases
+
+The revision identifies the files the model is loaded from (see source_revision):
+a snapshot is only used while they are the same, the models whose files cannot
+be identified are not snapshotted.
+
+Loading a snapshot unpickles the small skeleton and maps the weights file
+copy-on-write: no weight is read or copied until used, and the pages are
+shared through the page cache between all the kernels of a node.
+
+    python -m nl2query.snapshots build   # write the snapshots of the configured models
+    python -m nl2query.snapshots list
+"""
+import argparse
+import copy
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+from importlib.metadata import PackageNotFoundError, version as get_package_version
+from typing import Dict, Optional, Tuple
+
+import torch
+
+from nl2query.artifacts import store_dir
+from nl2query.registry import resident_memory
+
+SNAPSHOT_WEIGHTS = "weights.safetensors"
+SNAPSHOT_SKELETON = "skeleton.pt"
+SNAPSHOT_META = "snapshot.json"
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def snapshot_path(name: str) -> str:
+    return os.path.join(store_dir(), "snapshots", name.replace("/", "--"))
+
+
+def snapshot_versions() -> Dict[str, str]:
+    """versions of the libraries that must match between saving and loading a skeleton"""
+    versions = {}
+    for package in ["torch", "flair", "transformers", "sentence-transformers", "spacy-transformers"]:
+        try:
+            versions[package] = get_package_version(package)
+        except PackageNotFoundError:
+            pass
+    return versions
+
+
+def source_revision(source: str) -> Optional[str]:
+    """Revision of the files of a model source: hash of the names, sizes and modification times
+    of a local file or directory, or commit of a Hugging Face model in the local cache.
+    None if the source cannot be found locally."""
+    if os.path.isfile(source):
+        paths = [source]
+    elif os.path.isdir(source):
+        paths = sorted(os.path.join(root, file) for root, _, files in os.walk(source) for file in files)
+    else:
+        try:
+            from huggingface_hub import snapshot_download
+            return os.path.basename(snapshot_download(source, local_files_only=True))
+        except Exception:
+            return None
+    sha = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        sha.update(f"{os.path.relpath(path, source)}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    return sha.hexdigest()
+
+
+def module_tensors(module: torch.nn.Module) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    """Parameters and buffers of a module by name, each tensor once.
+    Return the tensors and the aliases of the tied ones to their first name."""
+    tensors = {}
+    aliases = {}
+    seen = {}
+    named = list(module.named_parameters(remove_duplicate=False)) + list(module.named_buffers(remove_duplicate=False))
+    storages = set()
+    for name, tensor in named:
+        if id(tensor) in seen:
+            aliases[name] = seen[id(tensor)]
+            continue
+        seen[id(tensor)] = name
+        tensor = tensor.detach().cpu().contiguous()
+        # safetensors does not store several tensors sharing the same memory
+        if tensor.numel() and tensor.untyped_storage().data_ptr() in storages:
+            tensor = tensor.clone()
+        storages.add(tensor.untyped_storage().data_ptr())
+        tensors[name] = tensor
+    return tensors, aliases
+
+
+def meta_skeleton(module: torch.nn.Module) -> torch.nn.Module:
+    """copy of a module with every parameter and buffer replaced by a meta tensor, keeping the tied ones"""
+    memo = {}
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        if id(tensor) in memo:
+            continue
+        meta = torch.empty_like(tensor, device="meta")
+        if isinstance(tensor, torch.nn.Parameter):
+            meta = torch.nn.Parameter(meta, requires_grad=tensor.requires_grad)
+        memo[id(tensor)] = meta
+    return copy.deepcopy(module, memo)
+
+
+def save_snapshot(module: torch.nn.Module, path: str, source: str, skeleton: bool = True) -> None:
+    """Write the snapshot of a module loaded from source. Without skeleton, only the weights are written
+    (to be attached to a module built by its library, see attach_snapshot)."""
+    from safetensors.torch import save_file
+
+    revision = source_revision(source)
+    if revision is None:
+        raise ValueError(f"The files of {source} cannot be identified")
+
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    tensors, aliases = module_tensors(module)
+    save_file(tensors, os.path.join(tmp_path, SNAPSHOT_WEIGHTS))
+    if skeleton:
+        torch.save(meta_skeleton(module), os.path.join(tmp_path, SNAPSHOT_SKELETON))
+    meta = {
+        "source": source,
+        "revision": revision,
+        "versions": snapshot_versions(),
+        "tensors": len(tensors),
+        "bytes": sum(t.numel() * t.element_size() for t in tensors.values()),
+        "aliases": aliases,
+    }
+    with open(os.path.join(tmp_path, SNAPSHOT_META), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot_meta(path: str, source: str) -> Optional[dict]:
+    """snapshot metadata if the snapshot was written from the same source, revision and library versions"""
+    try:
+        with open(os.path.join(path, SNAPSHOT_META), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("source") != source or meta.get("versions") != snapshot_versions():
+        return None
+    if meta.get("revision") is None or meta["revision"] != source_revision(source):
+        return None
+    return meta
+
+
+def map_safetensors(file_path: str) -> Dict[str, torch.Tensor]:
+    """tensors of a safetensors file backed by a private (copy-on-write) memory map of the file"""
+    with open(file_path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        count = (end - start) // dtype.itemsize
+        if count:
+            tensor = torch.frombuffer(mapped, dtype=dtype, count=count, offset=data_start + start)
+        else:
+            tensor = torch.empty(0, dtype=dtype)
+        tensors[name] = tensor.reshape(info["shape"])
+    return tensors
+
+
+def assign_tensors(module: torch.nn.Module, tensors: Dict[str, torch.Tensor], aliases: Dict[str, str]) -> None:
+    """replace the parameters and buffers of a module by the given tensors (without copy)"""
+    assigned = {}
+    for name in list(tensors) + list(aliases):
+        owner_name, _, attr = name.rpartition(".")
+        owner = module.get_submodule(owner_name)
+        if name in aliases:
+            value = assigned[aliases[name]]
+        elif attr in owner._parameters:
+            value = torch.nn.Parameter(tensors[name], requires_grad=False)
+        else:
+            value = tensors[name]
+        if attr in owner._parameters:
+            owner._parameters[attr] = value
+        else:
+            owner._buffers[attr] = value
+        assigned[name] = value
+
+
+def load_snapshot(path: str, source: str) -> Optional[torch.nn.Module]:
+    """Load the module of a snapshot with its weights memory-mapped.
+    Return None if there is no valid snapshot for this source."""
+    meta = read_snapshot_meta(path, source)
+    if meta is None or not os.path.exists(os.path.join(path, SNAPSHOT_SKELETON)):
+        return None
+    module = torch.load(os.path.join(path, SNAPSHOT_SKELETON), weights_only=False)
+    assign_tensors(module, map_safetensors(os.path.join(path, SNAPSHOT_WEIGHTS)), meta["aliases"])
+    missing = [name for name, t in list(module.named_parameters()) + list(module.named_buffers()) if t.is_meta]
+    if missing:
+        raise ValueError(f"Snapshot {path} misses the tensors: {missing[:5]}")
+    return module.eval()
+
+
+def attach_snapshot(module: torch.nn.Module, path: str, source: str) -> bool:
+    """Replace the weights of a module built by its library by the memory-mapped ones of its snapshot,
+    writing the snapshot first if missing. Return True if attached, False if the source files
+    cannot be identified."""
+    if source_revision(source) is None:
+        return False
+    if read_snapshot_meta(path, source) is None:
+        save_snapshot(module, path, source, skeleton=False)
+    meta = read_snapshot_meta(path, source)
+    assign_tensors(module, map_safetensors(os.path.join(path, SNAPSHOT_WEIGHTS)), meta["aliases"])
+    return True
+
+
+def load_or_snapshot(name: str, source: str, load_fn, get_module=lambda model: model, set_module=None):
+    """Load a model from its snapshot if any, otherwise with load_fn and write its snapshot.
+    get_module returns the torch module of the loaded model, set_module(module) builds
+    the model from a snapshot module. Print the load time and the resident memory added."""
+    path = snapshot_path(name)
+    rss_before = resident_memory()
+    start = time.perf_counter()
+    model = None
+    try:
+        module = load_snapshot(path, source)
+        if module is not None:
+            model = set_module(module) if set_module else module
+    except Exception as exc:
+        print(f"Snapshot of {name} could not be loaded ({exc}), loading the model")
+    origin = "snapshot"
+    if model is None:
+        origin = "model"
+        model = load_fn()
+        try:
+            save_snapshot(get_module(model), path, source)
+        except Exception as exc:
+            print(f"Snapshot of {name} could not be written: {exc}")
+    load_time = time.perf_counter() - start
+    rss_after = resident_memory()
+    rss_delta = None if rss_before is None or rss_after is None else (rss_after - rss_before) / 2 ** 20
+    print(f"Loaded {name} from {origin} in {load_time:.2f}s, RSS "
+          f"{'?' if rss_before is None else round(rss_before / 2 ** 20)} MB -> "
+          f"{'?' if rss_after is None else round(rss_after / 2 ** 20)} MB "
+          f"(+{'?' if rss_delta is None else round(rss_delta)} MB)")
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["build", "list"])
+    args = parser.parse_args()
+
+    root = os.path.join(store_dir(), "snapshots")
+    if args.command == "list":
+        for name in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+            with open(os.path.join(root, name, SNAPSHOT_META), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            print(f"{name:<40}{meta['tensors']:>8} tensors{meta['bytes'] / 2 ** 20:>10.0f} MB  {meta['source']}")
+        return
+    # loading the components with snapshots enabled writes their missing snapshots
+    os.environ["NL2QUERY_SNAPSHOTS"] = "1"
+    from nl2query.benchmarks import V2_CONFIG
+    from nl2query.V1.NER_flair import NER_flair
+    from nl2query.V1.NER_spacy import NER_spacy
+    from nl2query.V2.V2_pipeline import V2_pipeline
+
+    NER_spacy("nl2query/V1/spacy_config.cfg")
+    NER_flair("nl2query/V1/flair_config.cfg")
+    V2_pipeline(V2_CONFIG)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Small executor of pipeline stages declared with their inputs and outputs.
+
+Stages whose inputs are all available run concurrently on a thread pool,
+which benefits the stages waiting on the network (Duckling, geocoding)
+or running PyTorch models (which release the GIL).
+The results are the same as running the stages sequentially since
+each stage only sees the values of the stages it depends on.
+"""
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from nl2query.metrics import stage_timer
+from nl2query.tracing import in_context, span
+
+
+class Stage:
+    """ class definition of one stage:
+    func is called with the values of its inputs (positional, in order)
+    and returns a value per output (a tuple if more than one output) """
+    def __init__(self, name: str, func: Callable, inputs: Sequence[str] = (), outputs: Sequence[str] = ()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+    def run(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        with span(self.name), stage_timer(self.name):
+            result = self.func(*[values[name] for name in self.inputs])
+        if len(self.outputs) == 0:
+            return {}
+        if len(self.outputs) == 1:
+            return {self.outputs[0]: result}
+        return dict(zip(self.outputs, result))
+
+
+class StageGraph:
+    """ class to run a graph of stages, concurrently or sequentially,
+    inputs are the names of the values given at run time """
+    def __init__(self, stages: List[Stage], inputs: Sequence[str] = (), concurrent: bool = True,
+                 max_workers: Optional[int] = None):
+        self.stages = stages
+        self.inputs = list(inputs)
+        self.concurrent = concurrent
+        self.max_workers = max_workers
+        self.executor = None
+        # process of the executor, its threads do not exist in a forked process
+        self.executor_pid = None
+        # per stage wall times (seconds) of the last run, see run for those of a given run
+        self.timings = {}
+        self.check()
+
+    def check(self) -> None:
+        """make sure that every input is produced by a previous stage or given at run time,
+        which also guarantees that the declaration order is a valid sequential order"""
+        produced = dict.fromkeys(self.inputs, "run inputs")
+        for stage in self.stages:
+            if stage.name in produced.values():
+                raise ValueError(f"Duplicate stage name [{stage.name}]!")
+            missing = [name for name in stage.inputs if name not in produced]
+            if missing:
+                raise ValueError(f"Inputs {missing} of stage [{stage.name}] are not produced by a previous stage!")
+            for name in stage.outputs:
+                if name in produced:
+                    raise ValueError(f"Output [{name}] of stage [{stage.name}] already produced "
+                                     f"by stage [{produced[name]}]!")
+                produced[name] = stage.name
+
+    def run(self, values: Dict[str, Any], timings: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+        """Run all stages given the initial values, the per stage wall times are added to timings if given
+        (the graph can run concurrently for several queries).
+        Return the initial values updated with all the stage outputs."""
+        missing = [name for name in self.inputs if name not in values]
+        if missing:
+            raise ValueError(f"Missing stage graph inputs: {missing}")
+        values = dict(values)
+        timings = {} if timings is None else timings
+        start = time.perf_counter()
+        if self.concurrent and self.max_workers != 1:
+            self.run_concurrent(values, timings)
+        else:
+            for stage in self.stages:
+                stage_start = time.perf_counter()
+                values.update(stage.run(values))
+                timings[stage.name] = time.perf_counter() - stage_start
+        timings["total"] = time.perf_counter() - start
+        self.timings = timings
+        return values
+
+    def run_concurrent(self, values: Dict[str, Any], timings: Dict[str, float]) -> None:
+        if self.executor is None or self.executor_pid != os.getpid():
+            # a forked process (ex: a WorkerPool worker) starts its own threads
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="stage")
+            self.executor_pid = os.getpid()
+        pending = list(self.stages)
+        # future of each running stage
+        running = {}
+        started = {}
+        while pending or running:
+            # submit every stage whose inputs are available
+            for stage in [s for s in pending if all(name in values for name in s.inputs)]:
+                pending.remove(stage)
+                started[stage.name] = time.perf_counter()
+                # the stage runs in the context (and trace) of the graph
+                running[self.executor.submit(in_context(stage.run), dict(values))] = stage
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                timings[stage.name] = time.perf_counter() - started[stage.name]
+                try:
+                    values.update(future.result())
+                except Exception:
+                    # let the running stages finish before raising
+                    wait(running)
+                    raise
+
+    def shutdown(self) -> None:
+        if self.executor is not None and self.executor_pid == os.getpid():
+            self.executor.shutdown(wait=True)
+        self.executor = None
@@ -0,0 +1,138 @@
+"""
+CPU thread budget of the PyTorch, BLAS/OpenMP and tokenizers pools.
+
+By default each of these pools starts one thread per core, so that several
+pipelines, kernels or worker processes on the same node oversubscribe the
+CPUs. The budget of a pipeline is read from the ``[threads]`` section of its
+config and applied to the whole process when the pipeline is created:
+
+    [threads]
+    intra_op = auto     # torch and BLAS threads, auto: available cores / workers
+    inter_op = 1        # torch inter-op threads
+    tokenizers_parallelism = false
+
+``NL2QUERY_THREADS`` overrides intra_op (ex: per worker process), and
+``NL2QUERY_WORKERS`` is the number of worker processes sharing the node for auto.
+"""
+import os
+import sys
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+# environment variables read by the OpenMP, MKL and OpenBLAS pools when they start
+BLAS_THREAD_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "VECLIB_MAXIMUM_THREADS",
+                    "NUMEXPR_NUM_THREADS"]
+# environment of the thread budget, overrides included
+BUDGET_VARS = BLAS_THREAD_VARS + ["TOKENIZERS_PARALLELISM", "NL2QUERY_THREADS"]
+
+
+def available_cpus() -> int:
+    """number of CPUs this process may run on (its affinity, ex: a container cpuset)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class ThreadBudget:
+    """ class definition of the thread budget of a process:
+    - intra_op: threads of the torch and BLAS pools (None: all the available cores divided by the workers)
+    - inter_op: threads of the torch inter-op pool (None: torch default)
+    - tokenizers_parallelism: Rust thread pool of the Hugging Face tokenizers
+    - workers: processes sharing the available cores
+    """
+
+    def __init__(self, intra_op: Optional[int] = None, inter_op: Optional[int] = 1,
+                 tokenizers_parallelism: bool = False, workers: int = 1):
+        self.workers = max(workers, 1)
+        self.intra_op = intra_op or max(available_cpus() // self.workers, 1)
+        self.inter_op = inter_op
+        self.tokenizers_parallelism = tokenizers_parallelism
+
+    @classmethod
+    def from_config(cls, config, section: str = "threads", workers: Optional[int] = None) -> Optional["ThreadBudget"]:
+        """budget of a component config with the environment overrides, None if the config has no budget"""
+        if workers is None:
+            workers = int(os.getenv("NL2QUERY_WORKERS", "1"))
+        if os.getenv("NL2QUERY_THREADS"):
+            intra_op = os.getenv("NL2QUERY_THREADS")
+        elif config and config.has_section(section):
+            intra_op = config.get(section, "intra_op", fallback="auto")
+        else:
+            return None
+        inter_op = config.get(section, "inter_op", fallback="1") if config and config.has_section(section) else "1"
+        parallelism = config.getboolean(section, "tokenizers_parallelism", fallback=False) if config else False
+        return cls(intra_op=None if intra_op == "auto" else int(intra_op),
+                   inter_op=None if inter_op == "auto" else int(inter_op),
+                   tokenizers_parallelism=parallelism, workers=workers)
+
+    def apply(self) -> "ThreadBudget":
+        """Limit the thread pools of the process. The environment variables are read by the pools
+        started afterwards (ex: in forked workers), the already started ones are resized."""
+        for name in BLAS_THREAD_VARS:
+            os.environ[name] = str(self.intra_op)
+        os.environ["TOKENIZERS_PARALLELISM"] = str(self.tokenizers_parallelism).lower()
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(limits=self.intra_op)
+        except ImportError:
+            pass
+        # torch is configured if used by the process, importing it here would slow down the light pipelines
+        if "torch" in sys.modules:
+            self.apply_torch()
+        return self
+
+    def apply_torch(self) -> None:
+        import torch
+
+        torch.set_num_threads(self.intra_op)
+        if self.inter_op and torch.get_num_interop_threads() != self.inter_op:
+            try:
+                torch.set_num_interop_threads(self.inter_op)
+            except RuntimeError:
+                # the inter-op pool cannot be resized once started
+                print(f"torch inter-op threads already started, kept at {torch.get_num_interop_threads()}")
+
+    def to_dict(self) -> dict:
+        return {"intra_op": self.intra_op, "inter_op": self.inter_op,
+                "tokenizers_parallelism": self.tokenizers_parallelism, "workers": self.workers}
+
+    def __repr__(self) -> str:
+        return f"ThreadBudget({self.to_dict()})"
+
+
+def apply_thread_budget(config, section: str = "threads") -> Optional[ThreadBudget]:
+    """apply the thread budget of a component config if any, return it"""
+    budget = ThreadBudget.from_config(config, section)
+    if budget is not None:
+        budget.apply()
+    return budget
+
+
+@contextmanager
+def temporary_thread_budget(budget: ThreadBudget) -> Iterator[ThreadBudget]:
+    """Apply a budget (also as NL2QUERY_THREADS for the pipelines created) in the context,
+    then restore the environment and the thread pools of the process as they were."""
+    environ = {name: os.environ.get(name) for name in BUDGET_VARS}
+    torch_threads = sys.modules["torch"].get_num_threads() if "torch" in sys.modules else None
+    try:
+        from threadpoolctl import threadpool_limits
+        limiter = threadpool_limits(limits=budget.intra_op)
+    except ImportError:
+        limiter = None
+    os.environ["NL2QUERY_THREADS"] = str(budget.intra_op)
+    budget.apply()
+    try:
+        yield budget
+    finally:
+        for name, value in environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        if limiter is not None:
+            limiter.restore_original_limits()
+        if "torch" in sys.modules:
+            # torch loaded in the context gets the threads its pools would have started with
+            sys.modules["torch"].set_num_threads(
+                torch_threads or int(environ["OMP_NUM_THREADS"] or available_cpus()))
@@ -0,0 +1,270 @@
+"""
+Lightweight tracing of the pipeline stages and external calls.
+
+A trace is a tree of spans recording their wall time, the CPU time of their
+thread and counts (ex: vector searches, cache hits). The current span is kept
+in a context variable, so that the spans of the stages running on other
+threads (copied context) or in asyncio tasks are attached to their parent.
+
+    with span("duckling", url=url):
+        ...
+    add_count("vector_searches")
+
+Both are no-ops outside of a trace, which is started by the traced_transform
+methods of the pipelines when tracing is enabled (``[tracing]`` section of
+the configs, or the NL2QUERY_TRACE environment variable). The trace is then
+attached to the QueryAnnotationsDict of the query and given to the exporters:
+
+    [tracing]
+    enabled = true
+    exporter = jsonl          # jsonl, otel (OpenTelemetry API) or none
+    path = traces.jsonl       # file of the jsonl exporter
+"""
+import asyncio
+import contextvars
+import json
+import os
+import threading
+import time
+from functools import partial, wraps
+from typing import Any, Dict, List, Optional
+
+# innermost span of the running code, None outside of a trace
+_CURRENT = contextvars.ContextVar("nl2query_span", default=None)
+
+
+class Span:
+    """ class definition of one span: its name, attributes, times, counts and child spans """
+    __slots__ = ("name", "attributes", "counts", "children", "start_ns", "wall_ns", "cpu_ns", "error",
+                 "_start", "_cpu_start", "_token")
+
+    def __init__(self, name: str, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.attributes = attributes or {}
+        self.counts = {}  # type: Dict[str, int]
+        self.children = []  # type: List[Span]
+        self.start_ns = 0
+        self.wall_ns = 0
+        self.cpu_ns = 0
+        self.error = None  # type: Optional[str]
+
+    def __enter__(self) -> "Span":
+        parent = _CURRENT.get()
+        if parent is not None:
+            parent.children.append(self)
+        self._token = _CURRENT.set(self)
+        self.start_ns = time.time_ns()
+        self._start = time.perf_counter_ns()
+        self._cpu_start = time.thread_time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.wall_ns = time.perf_counter_ns() - self._start
+        self.cpu_ns = time.thread_time_ns() - self._cpu_start
+        if exc_type is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        _CURRENT.reset(self._token)
+
+    def add_count(self, name: str, n: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def to_dict(self) -> dict:
+        data = {"name": self.name, "start_ns": self.start_ns, "wall_ms": self.wall_ns / 1e6,
+                "cpu_ms": self.cpu_ns / 1e6}
+        if self.attributes:
+            data["attributes"] = self.attributes
+        if self.counts:
+            data["counts"] = self.counts
+        if self.error:
+            data["error"] = self.error
+        if self.children:
+            data["children"] = [child.to_dict() for child in sorted(self.children, key=lambda s: s.start_ns)]
+        return data
+
+
+class _NoSpan:
+    """ span outside of a trace, doing nothing """
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+    def add_count(self, name: str, n: int = 1) -> None:
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+def current_span() -> Optional[Span]:
+    return _CURRENT.get()
+
+
+def span(name: str, **attributes):
+    """child span of the current span, or a no-op outside of a trace"""
+    if _CURRENT.get() is None:
+        return NO_SPAN
+    return Span(name, attributes)
+
+
+def add_count(name: str, n: int = 1) -> None:
+    """add to a count of the current span, if any"""
+    current = _CURRENT.get()
+    if current is not None:
+        current.add_count(name, n)
+
+
+def traced(name: str):
+    """decorator running a function or coroutine function in a span of the current trace, if any"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def awrapper(*args, **kwargs):
+                if _CURRENT.get() is None:
+                    return await func(*args, **kwargs)
+                with Span(name):
+                    return await func(*args, **kwargs)
+            return awrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _CURRENT.get() is None:
+                return func(*args, **kwargs)
+            with Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def in_context(func):
+    """func running in a copy of the current context (and trace), for another thread (ex: run_in_executor)"""
+    return partial(contextvars.copy_context().run, func)
+
+
+class JsonLinesExporter:
+    """ exporter appending each trace as a line of a JSON lines file """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, trace: dict) -> None:
+        line = json.dumps(trace) + "\n"
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+class OpenTelemetryExporter:
+    """ exporter replaying the spans of each trace with the OpenTelemetry API,
+    to the tracer provider configured by the application (ex: an OTLP exporter) """
+
+    def __init__(self, tracer_name: str = "nl2query"):
+        from opentelemetry import trace
+        self.otel_trace = trace
+        self.tracer = trace.get_tracer(tracer_name)
+
+    def export(self, trace: dict, parent=None) -> None:
+        start = trace["start_ns"]
+        attributes = dict(trace.get("attributes", {}), cpu_ms=trace["cpu_ms"],
+                          **{"count." + name: n for name, n in trace.get("counts", {}).items()})
+        attributes = {key: value if isinstance(value, (str, bool, int, float)) else str(value)
+                      for key, value in attributes.items()}
+        context = self.otel_trace.set_span_in_context(parent) if parent is not None else None
+        otel_span = self.tracer.start_span(trace["name"], context=context, start_time=start, attributes=attributes)
+        if "error" in trace:
+            otel_span.set_status(self.otel_trace.Status(self.otel_trace.StatusCode.ERROR, trace["error"]))
+        for child in trace.get("children", []):
+            self.export(child, otel_span)
+        otel_span.end(end_time=start + int(trace["wall_ms"] * 1e6))
+
+
+class Tracer:
+    """ class to trace the queries of a pipeline and export their traces """
+
+    def __init__(self, exporters: Optional[list] = None):
+        self.exporters = exporters or []
+
+    def export(self, root: Span) -> dict:
+        trace = root.to_dict()
+        for exporter in self.exporters:
+            try:
+                exporter.export(trace)
+            except Exception as exc:
+                print("Trace export failed:", exc)
+        return trace
+
+
+def pipeline_tracer(config, section: str = "tracing") -> Optional[Tracer]:
+    """Tracer of the [tracing] section of a pipeline config, None if disabled.
+    NL2QUERY_TRACE=1 or 0 enables or disables the tracing of every pipeline."""
+    enabled = os.environ.get("NL2QUERY_TRACE")
+    if enabled is not None:
+        if enabled.lower() in ["0", "false", "no", "off"]:
+            return None
+    elif config is None or not config.getboolean(section, "enabled", fallback=False):
+        return None
+    exporter = config.get(section, "exporter", fallback="none") if config is not None else "none"
+    exporters = []
+    if exporter == "jsonl":
+        exporters.append(JsonLinesExporter(config.get(section, "path", fallback="") or "traces.jsonl"))
+    elif exporter == "otel":
+        exporters.append(OpenTelemetryExporter())
+    elif exporter != "none":
+        raise ValueError(f"Unknown trace exporter [{exporter}]! Must be one of: jsonl, otel, none")
+    return Tracer(exporters)
+
+
+def traced_transform(method):
+    """Trace a transform_nl2query method with the tracer of the pipeline (if any):
+    the trace of the query is attached to its annotations and exported.
+    Inside another trace, the method is only a span of it."""
+    @wraps(method)
+    def transform(self, nlq: str, verbose: bool = False):
+        tracer = getattr(self, "tracer", None)
+        if tracer is None:
+            return method(self, nlq, verbose)
+        if _CURRENT.get() is not None:
+            with Span(f"{type(self).__name__}.transform_nl2query"):
+                return method(self, nlq, verbose)
+        with Span(f"{type(self).__name__}.transform_nl2query", {"query": nlq}) as root:
+            result = method(self, nlq, verbose)
+        result.trace = tracer.export(root)
+        return result
+    return transform
+
+
+def atraced_transform(method):
+    """traced_transform of an atransform_nl2query coroutine method"""
+    @wraps(method)
+    async def atransform(self, nlq: str, verbose: bool = False):
+        tracer = getattr(self, "tracer", None)
+        if tracer is None:
+            return await method(self, nlq, verbose)
+        if _CURRENT.get() is not None:
+            with Span(f"{type(self).__name__}.atransform_nl2query"):
+                return await method(self, nlq, verbose)
+        with Span(f"{type(self).__name__}.atransform_nl2query", {"query": nlq}) as root:
+            result = await method(self, nlq, verbose)
+        result.trace = tracer.export(root)
+        return result
+    return atransform
+
+
+def traced_transform_batch(method):
+    """traced_transform of a transform_nl2query_batch method, the trace of the batch is attached to every result"""
+    @wraps(method)
+    def transform_batch(self, nlqs: List[str], verbose: bool = False):
+        tracer = getattr(self, "tracer", None)
+        if tracer is None or _CURRENT.get() is not None:
+            with span(f"{type(self).__name__}.transform_nl2query_batch", queries=len(nlqs)):
+                return method(self, nlqs, verbose)
+        with Span(f"{type(self).__name__}.transform_nl2query_batch", {"queries": len(nlqs)}) as root:
+            results = method(self, nlqs, verbose)
+        trace = tracer.export(root)
+        for result in results:
+            result.trace = trace
+        return results
+    return transform_batch
@@ -0,0 +1,130 @@
+"""
+Pre-fork pool of pipeline worker processes.
+
+The pipeline is loaded and warmed up once in the parent process, then the
+workers are forked from it: the model weights, vocabularies and indexes are
+shared copy-on-write instead of being loaded by each worker. Before forking:
+- the in-memory vector matrices of the vector databases are moved to shared memory
+  (the memory-mapped ones are already shared through the page cache),
+- the loaded objects are frozen out of the garbage collector, whose bookkeeping
+  would otherwise write to (and copy) every page holding a Python object,
+- the stage executor threads of the pipeline are stopped (the workers start their own),
+- the SQLite connections of the result caches are closed (each worker opens its own),
+- the parent runs with a single thread until the workers are forked, then gets its thread budget back.
+
+    pipeline = load_pipeline(lambda: V3_pipeline(v1_config, v2_config))
+    with WorkerPool(pipeline, workers=4) as pool:
+        results = pool.map(queries)   # QueryAnnotationsDict per query, in input order
+"""
+import gc
+import multiprocessing
+from typing import Callable, Iterator, List, Optional
+
+from nl2query.NL2QueryInterface import NL2QueryInterface, QueryAnnotationsDict
+from nl2query.threads import ThreadBudget, temporary_thread_budget
+
+# query run once by the parent after loading to allocate the models buffers before forking
+WARMUP_QUERY = "daily precipitation in 2020"
+
+# pipeline of the parent process, inherited by the forked workers
+_PIPELINE = None  # type: Optional[NL2QueryInterface]
+
+
+def load_pipeline(factory: Callable[[], NL2QueryInterface], warmup_query: str = WARMUP_QUERY) -> NL2QueryInterface:
+    """Create and warm up a pipeline to fork workers from, with a single thread:
+    OpenMP thread pools started before a fork hang the forked workers.
+    The thread budget of the process is restored afterwards."""
+    with temporary_thread_budget(ThreadBudget(intra_op=1)):
+        pipeline = factory()
+        if warmup_query:
+            pipeline.transform_nl2query(warmup_query)
+    return pipeline
+
+
+def vector_databases(pipeline: NL2QueryInterface) -> list:
+    """vector databases of a V2 or V3 pipeline"""
+    v2_instance = getattr(pipeline, "v2_instance", pipeline)
+    vdbs = getattr(v2_instance, "vdbs", None)
+    return [vdbs] if vdbs is not None else []
+
+
+def result_caches(pipeline: NL2QueryInterface) -> list:
+    """result caches of a V1, V2 or V3 pipeline and of its vector databases"""
+    holders = [pipeline, getattr(pipeline, "v2_instance", None)] + vector_databases(pipeline)
+    caches = [getattr(holder, "result_cache", None) for holder in holders]
+    # the pipelines of a process share their caches
+    return list({id(cache): cache for cache in caches if cache is not None}.values())
+
+
+def _init_worker(threads: Optional[int], workers: int) -> None:
+    ThreadBudget(intra_op=threads, workers=workers).apply()
+    for cache in result_caches(_PIPELINE):
+        cache.after_fork()
+
+
+def _annotate(query: str) -> QueryAnnotationsDict:
+    return _PIPELINE.transform_nl2query(query)
+
+
+class WorkerPool:
+    """ class to annotate queries with a pipeline in forked worker processes:
+    - pipeline: loaded pipeline (see load_pipeline)
+    - workers: number of processes (default: available cores / threads)
+    - threads: torch and BLAS threads per worker (default: available cores / workers)
+    - chunksize: queries sent to a worker at once
+    """
+
+    def __init__(self, pipeline: NL2QueryInterface, workers: Optional[int] = None, threads: Optional[int] = None,
+                 chunksize: int = 1):
+        global _PIPELINE
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise RuntimeError("The worker pool needs the fork start method (Linux, macOS)!")
+        self.workers = workers or max(ThreadBudget(workers=1).intra_op // (threads or 1), 1)
+        self.threads = threads
+        self.chunksize = chunksize
+        self.shared_bytes = sum(vdbs.share_memory() for vdbs in vector_databases(pipeline))
+        _PIPELINE = pipeline
+        # threads of the stage executors (V3) would not exist in the workers
+        close = getattr(pipeline, "close", None)
+        if close is not None:
+            close()
+        # the connections of the parent must not be used by the workers, it opens them again on next use
+        for cache in result_caches(pipeline):
+            cache.close()
+        # collect now and keep the loaded objects out of the next collections (in the workers)
+        gc.collect()
+        gc.freeze()
+        with temporary_thread_budget(ThreadBudget(intra_op=1)):
+            self.pool = multiprocessing.get_context("fork").Pool(self.workers, initializer=_init_worker,
+                                                                 initargs=(threads, self.workers))
+
+    def map(self, queries: List[str]) -> List[QueryAnnotationsDict]:
+        """annotations of the queries, in input order"""
+        return self.pool.map(_annotate, queries, chunksize=self.chunksize)
+
+    def imap(self, queries: List[str]) -> Iterator[QueryAnnotationsDict]:
+        """annotations of the queries, in input order, as soon as available"""
+        return self.pool.imap(_annotate, queries, chunksize=self.chunksize)
+
+    def worker_pids(self) -> List[int]:
+        """pids of the worker processes of the pool"""
+        # the processes of this pool only, not every child of the process
+        return [process.pid for process in self.pool._pool if process.is_alive()]
+
+    def close(self, terminate: bool = False) -> None:
+        """wait for the workers to finish, or stop them at once if terminate"""
+        global _PIPELINE
+        if terminate:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+        _PIPELINE = None
+        gc.unfreeze()
+
+    def __enter__(self) -> "WorkerPool":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # the workers of a failed map (ex: a timeout) may never finish
+        self.close(terminate=exc_type is not None)
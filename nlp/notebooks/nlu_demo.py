@@ -1,22 +1,44 @@
 import json
 import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from pprint import pprint
-from typing import Optional
+from typing import List, Optional
 
 import ipywidgets as widgets
 
-from nl2query.V1.V1_pipeline import V1_pipeline
-from nl2query.V2.V2_pipeline import V2_pipeline
-from nl2query.V3.V3_pipeline import V3_pipeline
+from nl2query.governor import MemoryGovernor, rss_mb
+from nl2query.registry import MODELS
 from stac_wrapper.query_handler import STAC_query_handler
 
+# the pipelines (and their spaCy, Flair, torch, langchain, osmnx dependencies)
+# are imported when the selected version is first instantiated
+
+# query that can be run once by each pipeline after loading to allocate the models buffers,
+# only if given (warmup_query or NLU_WARMUP_QUERY) as it requests Duckling and Nominatim
+WARMUP_QUERY = "daily precipitation in 2020"
+PIPELINE_ATTRS = {"V1": "v1_instance", "V2": "v2_instance", "V3": "v3_instance"}
+
 
 class NLU_demo:
     """class to handle all necessary widgets and
     functions of the NLU demo notebook"""
     
-    def __init__(self, verbose: bool = False) -> None:
+    def __init__(self, verbose: bool = False, warmup: bool = True, memory_budget_mb: Optional[float] = None,
+                 idle_timeout: Optional[float] = None, warmup_query: Optional[str] = None) -> None:
         self.verbose = verbose
+        # the warm-up only loads the models, unless a query is given to run
+        self.warmup_query = warmup_query or os.getenv("NLU_WARMUP_QUERY") or None
+        # release the least recently used pipelines when idle or over the memory budget
+        if memory_budget_mb is None and os.getenv("NLU_MEMORY_BUDGET_MB"):
+            memory_budget_mb = float(os.getenv("NLU_MEMORY_BUDGET_MB"))
+        if idle_timeout is None and os.getenv("NLU_IDLE_TIMEOUT"):
+            idle_timeout = float(os.getenv("NLU_IDLE_TIMEOUT"))
+        self.governor = MemoryGovernor(self.unload_pipeline, budget_mb=memory_budget_mb, idle_timeout=idle_timeout)
+        self.governor.start()
+        # URL of the annotation service (nl2query.service) running the pipelines, if any
+        self.service_url = os.getenv("NL2QUERY_SERVICE")
         # initialize pipelines
         self.path = os.path.dirname(os.path.realpath(__file__))
         self.v1_config = os.path.join(self.path, "nl2query/V1/v1_config.cfg")
@@ -55,7 +77,18 @@ class NLU_demo:
             style={'description_width': 'initial'},
             disabled=False
             )
-            
+        # load the pipelines in a background thread, one at a time
+        # version -> future of its pipeline
+        self.warmups = {}
+        self.warmup_states = {}
+        self.warmup_lock = threading.RLock()
+        self.warmup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="warmup")
+        self.warmup_bar = widgets.IntProgress(value=0, min=0, max=3, description="", bar_style="info")
+        self.warmup_label = widgets.Label(value="")
+        self.select_version.observe(self.on_version_change, names="value")
+        if warmup:
+            self.warmup(self.select_version.value)
+
     def select_gold_query(self):
         """return select gold query dropdown"""
         return self.select_query
@@ -89,32 +122,135 @@ class NLU_demo:
                 "Natural Language Query is empty. Cannot run the query pipeline. "
                 "Either set the value with 'write_query' or 'select_query' widgets."
             )
-        if self.select_version.value == "V1":
-            if not self.v1_instance:
-                #initialize V1
+        version = self.select_version.value
+        # the pipeline cannot be released while it is running
+        with self.governor.using(version):
+            # wait for the warm-up of the selected pipeline only
+            pipeline = self.get_pipeline(version)
+            # run the selected pipeline on this query
+            structq = pipeline.transform_nl2query(self.nlq, verbose=self.verbose)
+        print(f"\n{version} structured query: ")
+        self.struct_query = structq.to_dict()
+        return pprint(self.struct_query, sort_dicts=False)
+        
+    def load_pipeline(self, version: str, warmup_query: Optional[str] = None):
+        """import and instantiate a pipeline version,
+        then run the warmup_query if given to trigger the lazy model allocations"""
+        self.set_warmup_state(version, "loading", 0)
+        # the models loaded by the pipeline are owned by its version in the registry
+        with MODELS.owner(version):
+            if self.service_url:
+                # the pipeline runs in the annotation service shared by the kernels
+                from nl2query.service import NL2QueryClient
+                self.set_warmup_state(version, "loading", 1)
+                pipeline = NL2QueryClient(self.service_url, version)
+                setattr(self, PIPELINE_ATTRS[version], pipeline)
+            elif version == "V1":
+                from nl2query.V1.V1_pipeline import V1_pipeline
+                self.set_warmup_state(version, "loading", 1)
                 self.v1_instance = V1_pipeline(self.v1_config)
-            # run V1 pipeline on this query
-            v1_structq = self.v1_instance.transform_nl2query(self.nlq, verbose=self.verbose)
-            print("\nV1 structured query: ")
-            self.struct_query = v1_structq.to_dict()
-        elif self.select_version.value == "V2":
-            # initialize V2
-            if not self.v2_instance:
+                pipeline = self.v1_instance
+            elif version == "V2":
+                from nl2query.V2.V2_pipeline import V2_pipeline
+                self.set_warmup_state(version, "loading", 1)
                 self.v2_instance = V2_pipeline(self.v2_config)
-            # run V2 pipeline on this query
-            v2_structq = self.v2_instance.transform_nl2query(self.nlq, verbose=self.verbose)
-            print("\nV2 structured query: ")
-            self.struct_query = v2_structq.to_dict()
-        else:
-            if not self.v3_instance:
-                # initialize V3
+                pipeline = self.v2_instance
+            else:
+                from nl2query.V3.V3_pipeline import V3_pipeline
+                self.set_warmup_state(version, "loading", 1)
                 self.v3_instance = V3_pipeline(self.v1_config, self.v2_config)
-            # run V3 pipeline on query
-            v3_structq = self.v3_instance.transform_nl2query(self.nlq, verbose=self.verbose)
-            print("\nV3 structured query: ")
-            self.struct_query = v3_structq.to_dict()
-        return pprint(self.struct_query, sort_dicts=False)
-        
+                pipeline = self.v3_instance
+        if warmup_query:
+            self.set_warmup_state(version, "warming up", 2)
+            pipeline.transform_nl2query(warmup_query)
+        self.set_warmup_state(version, "ready", 3)
+        # release other pipelines if over the memory budget
+        self.governor.loaded(version)
+        return pipeline
+
+    def unload_pipeline(self, version: str) -> None:
+        """release a pipeline and the models no other pipeline uses,
+        it is loaded again on next use"""
+        attr = PIPELINE_ATTRS[version]
+        with self.warmup_lock:
+            self.warmups.pop(version, None)
+            pipeline = getattr(self, attr)
+            setattr(self, attr, None)
+        if hasattr(pipeline, "close"):
+            pipeline.close()
+        MODELS.release_owner(version)
+        self.set_warmup_state(version, "released", 0)
+
+    def residency(self) -> dict:
+        """loaded pipelines (least recently used first) and the models they own"""
+        return {
+            "rss_mb": rss_mb(),
+            "budget_mb": self.governor.budget_mb,
+            "pipelines": self.governor.residency(),
+            "models": MODELS.residency(),
+        }
+
+    def eviction_events(self) -> List[dict]:
+        """pipelines released by the memory governor"""
+        return list(self.governor.events)
+
+    def warmup(self, version: str) -> Future:
+        """queue the loading of a pipeline version in the background,
+        return the future of the pipeline instance"""
+        with self.warmup_lock:
+            future = self.warmups.get(version)
+            if future is None:
+                self.set_warmup_state(version, "queued", 0)
+                future = self.warmup_executor.submit(self.load_pipeline, version, self.warmup_query)
+                future.add_done_callback(partial(self.warmup_done, version))
+                self.warmups[version] = future
+            return future
+
+    def warmup_done(self, version: str, future: Future) -> None:
+        if not future.cancelled() and future.exception():
+            self.set_warmup_state(version, "failed", 0)
+
+    def on_version_change(self, change):
+        """warm up the newly selected version"""
+        self.warmup(change["new"])
+
+    def get_pipeline(self, version: str):
+        """Return the pipeline instance of a version, waiting for its warm-up.
+        A warm-up still queued behind the one of another version is run right away instead."""
+        future = self.warmup(version)
+        if future.cancel():
+            future = Future()
+            with self.warmup_lock:
+                self.warmups[version] = future
+            try:
+                future.set_result(self.load_pipeline(version, warmup_query=None))
+            except Exception as exc:
+                self.set_warmup_state(version, "failed", 0)
+                future.set_exception(exc)
+        try:
+            return future.result()
+        except Exception:
+            # retry the loading on next query
+            with self.warmup_lock:
+                self.warmups.pop(version, None)
+            raise
+
+    def set_warmup_state(self, version: str, state: str, step: int) -> None:
+        """update the warm-up progress widget"""
+        self.warmup_states[version] = state
+        self.warmup_bar.value = step
+        self.warmup_bar.description = f"{version}:"
+        self.warmup_bar.bar_style = {"ready": "success", "failed": "danger"}.get(state, "info")
+        self.warmup_label.value = " | ".join(f"{v} {s}" for v, s in sorted(self.warmup_states.items()))
+
+    def warmup_progress(self):
+        """return the warm-up progress widget of the pipelines"""
+        return widgets.HBox([self.warmup_bar, self.warmup_label])
+
+    def models_memory(self):
+        """print the models shared by the loaded pipelines with their resident memory"""
+        MODELS.print_memory_report()
+
     def select_stac_catalog(self, catalog: Optional[str] = None):
         return self.stac_handler.select_catalog(catalog=catalog)
     
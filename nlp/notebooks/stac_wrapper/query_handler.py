@@ -1,3 +1,4 @@
+import contextlib
 import datetime
 import json
 import os
@@ -6,10 +7,16 @@ from pprint import pprint
 from typing import List, Optional
 
 import ipywidgets as widgets
-from pystac_client import Client
 
 from typedefs import JSON, Number
 
+try:
+    from nl2query.metrics import request_timer
+except ImportError:
+    # the STAC requests are not measured without nl2query
+    def request_timer(service: str):
+        return contextlib.nullcontext()
+
 
 class VisualList(list):
     """class to visualize STAC API response as a visual list using
@@ -153,9 +160,12 @@ class STAC_query_handler:
         Search a specific catalog with the given search parameters
         return a visual results list or None.
         """
+        # imported on first search to keep the notebook startup fast
+        from pystac_client import Client
         try:
             catalog_url = self.catalogs[self.datasource.value]
-            client = Client.open(catalog_url)
+            with request_timer("stac"):
+                client = Client.open(catalog_url)
             print("Opening catalog: ", client.title)
             if not client.conforms_to("ITEM_SEARCH"):
                 print("Catalog does not conform to item search functionality. Quitting.")
@@ -164,18 +174,20 @@ class STAC_query_handler:
                 max_items = params['max_items']
             else:
                 max_items = 10
-            response = client.search(bbox=params['bbox'],
-                                     datetime=params['datetime'],
-                                     query=params['query'],
-                                     collections=params['collections'],
-                                     max_items=max_items,
-                                     method="GET")
-            items = response.items()
-            if verbose:
-                print("Searching catalog: ", catalog_url)
-                # print('Found %s items' % response.matched())
-                print(f"QUERY: {vars(response)}")
-            results = [item for item in items]
+            # the items are requested while iterating
+            with request_timer("stac"):
+                response = client.search(bbox=params['bbox'],
+                                         datetime=params['datetime'],
+                                         query=params['query'],
+                                         collections=params['collections'],
+                                         max_items=max_items,
+                                         method="GET")
+                items = response.items()
+                if verbose:
+                    print("Searching catalog: ", catalog_url)
+                    # print('Found %s items' % response.matched())
+                    print(f"QUERY: {vars(response)}")
+                results = [item for item in items]
             # return visual repr of results list
             return VisualList(results)
         except Exception as e:
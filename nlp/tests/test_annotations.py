@@ -0,0 +1,72 @@
+import json
+import pickle
+import unittest
+from unittest import mock
+
+from nl2query.NL2QueryInterface import (
+    Annotation,
+    LocationAnnotation,
+    PropertyAnnotation,
+    QueryAnnotationsDict,
+    TargetAnnotation,
+    TemporalAnnotation
+)
+
+
+def query_annotations() -> QueryAnnotationsDict:
+    return QueryAnnotationsDict(query="daily snow depth in Montréal since 2020 above 10 cm", annotations=[
+        TargetAnnotation(text="snow depth", position=[6, 16], name=["snd"]),
+        LocationAnnotation(text="Montréal", position=[20, 28], name="Montréal", matching_type="overlap",
+                           value={"type": "Polygon", "coordinates": [[[-73.9, 45.4], [-73.5, 45.4], [-73.9, 45.7]]]}),
+        TemporalAnnotation(text="since 2020", position=[29, 39], tempex_type="range", target="dataDate",
+                           value=("2020-01-01", "2024-01-01")),
+        PropertyAnnotation(text="above 10 cm", position=[[40, 45], [46, 51]], name="snow depth", value=10,
+                           value_type="integer", operation="gt"),
+    ])
+
+
+class AnnotationsTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        """
+        The annotations are rebuilt from their dicts and JSON texts, with or without orjson
+        """
+        result = query_annotations()
+        data = result.to_dict()
+        self.assertEqual(data["annotations"][2]["value"], {"start": "2020-01-01", "end": "2024-01-01"})
+        self.assertEqual(QueryAnnotationsDict.from_dict(data).to_dict(), data)
+        self.assertEqual(QueryAnnotationsDict.from_json(result.to_json()).to_dict(), data)
+        self.assertIsInstance(Annotation.from_dict(data["annotations"][1]), LocationAnnotation)
+        with self.assertRaises(Exception):
+            Annotation.from_dict(dict(data["annotations"][1], type="place"))
+        with mock.patch("nl2query.NL2QueryInterface.orjson", None):
+            self.assertEqual(json.loads(result.to_json()), data)
+            # non-ASCII characters are not escaped, as by orjson
+            self.assertIn("Montréal", result.to_json())
+            self.assertEqual(QueryAnnotationsDict.from_json(result.to_json()).to_dict(), data)
+
+    def test_repr(self):
+        """
+        The representation is the indented JSON of the annotation
+        """
+        result = query_annotations()
+        self.assertEqual(json.loads(repr(result)), result.to_dict())
+        self.assertEqual(json.loads(repr(result.annotations[0])), result.annotations[0].to_dict())
+        self.assertIn("\n  ", repr(result.annotations[0]))
+
+    def test_slots(self):
+        """
+        The annotations have no instance dict, are validated and can be pickled
+        """
+        target = TargetAnnotation(text="snow", position=[0, 4], name=["snw"])
+        self.assertFalse(hasattr(target, "__dict__"))
+        with self.assertRaises(AttributeError):
+            target.score = 1.0
+        with self.assertRaises(Exception):
+            LocationAnnotation(text="Montréal", position=[0, 8], name="", value={}, matching_type="inside")
+        copy = pickle.loads(pickle.dumps(query_annotations()))
+        self.assertEqual(copy.to_dict(), query_annotations().to_dict())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from nl2query.artifacts import (
+    COMPLETE_MARKER,
+    file_checksums,
+    get_artifact,
+    prefetch,
+    read_store_lock,
+    resolve,
+    store_locked,
+    unlocked,
+    verify
+)
+
+
+class ArtifactStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store = tempfile.mkdtemp()
+        self.artifact = dict(get_artifact("stopwords"))
+        self.path = os.path.join(self.store, self.artifact["path"])
+        os.makedirs(os.path.join(self.path, "corpora", "stopwords"))
+        with open(os.path.join(self.path, "corpora", "stopwords", "english"), "w", encoding="utf-8") as f:
+            f.write("the\nof\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.store)
+
+    def test_resolve(self):
+        """
+        Artifacts resolve to the store once complete, missing ones are an error only when offline
+        """
+        with mock.patch.dict(os.environ, {"NL2QUERY_ARTIFACTS": self.store, "NL2QUERY_OFFLINE": "0"}):
+            self.assertIsNone(resolve("stopwords"))
+            self.assertIsNone(resolve("unknown"))
+            with open(os.path.join(self.path, COMPLETE_MARKER), "w", encoding="utf-8") as f:
+                f.write("")
+            self.assertEqual(resolve("stopwords"), self.path)
+        with mock.patch.dict(os.environ, {"NL2QUERY_ARTIFACTS": self.store, "NL2QUERY_OFFLINE": "1"}):
+            with self.assertRaises(FileNotFoundError):
+                resolve("intfloat/e5-base-v2")
+            # spaCy model of another version than the prefetched one
+            with self.assertRaises(FileNotFoundError):
+                resolve("en_core_web_trf", "3.7.0")
+
+    def test_verify_checksums(self):
+        """
+        The store files are verified against the checksums of the manifest
+        """
+        self.artifact["sha256"] = file_checksums(self.path)
+        self.assertListEqual(list(self.artifact["sha256"]), ["corpora/stopwords/english"])
+        self.assertListEqual(verify(self.artifact, self.store), [])
+        with open(os.path.join(self.path, "corpora", "stopwords", "english"), "a", encoding="utf-8") as f:
+            f.write("in\n")
+        self.assertListEqual(verify(self.artifact, self.store), ["corpora/stopwords/english"])
+
+    def test_lock(self):
+        """
+        The artifacts without checksums or Hugging Face commit are not verified until locked, by the manifest
+        or by the store on their first prefetch
+        """
+        artifact = dict(get_artifact("intfloat/e5-base-v2"), sha256={}, version="main")
+        self.assertIsNotNone(unlocked(artifact))
+        self.assertEqual(len(verify(artifact, self.store)), 1)
+
+        commit = "0123456789abcdef0123456789abcdef01234567"
+        content = ["{}"]
+
+        def snapshot_download(repo_id, revision, local_dir, allow_patterns):
+            self.assertEqual(revision, commit)
+            with open(os.path.join(local_dir, "config.json"), "w", encoding="utf-8") as f:
+                f.write(content[0])
+
+        with mock.patch("huggingface_hub.HfApi") as api, \
+                mock.patch("huggingface_hub.snapshot_download", side_effect=snapshot_download):
+            api.return_value.model_info.return_value.sha = commit
+            # pinned in the store lock, the manifest artifact is unchanged
+            self.assertTrue(prefetch(artifact, self.store))
+            self.assertEqual(artifact["version"], "main")
+            self.assertEqual(read_store_lock(self.store)[artifact["name"]]["version"], commit)
+            self.assertIsNone(unlocked(store_locked(artifact, self.store)))
+            self.assertListEqual(verify(artifact, self.store), [])
+            self.assertTrue(prefetch(artifact, self.store))
+            # fetched again against the store pins
+            content[0] = '{"changed": true}'
+            self.assertFalse(prefetch(artifact, self.store, force=True))
+            self.assertListEqual(verify(artifact, self.store), ["config.json"])
+            self.assertIsNotNone(unlocked(store_locked(dict(artifact, version="v2.0"), self.store)))
+
+            content[0] = "{}"
+            self.assertTrue(prefetch(artifact, self.store, lock=True))
+        self.assertEqual(artifact["version"], commit)
+        self.assertListEqual(list(artifact["sha256"]), ["config.json"])
+        self.assertIsNone(unlocked(artifact))
+        self.assertListEqual(verify(artifact, self.store), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
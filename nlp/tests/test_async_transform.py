@@ -0,0 +1,168 @@
+import asyncio
+import json
+import threading
+import time
+import unittest
+
+import httpx
+
+from nl2query.cache import ResultCache, acached_call
+from nl2query.NL2QueryInterface import NL2QueryInterface, QueryAnnotationsDict, TargetAnnotation
+from nl2query.V2.V2_pipeline import RequestLimiter, V2_pipeline, aosmnx_geocode
+
+
+class ThreadPipeline(NL2QueryInterface):
+    """ pipeline annotating a query with the name of the thread running it """
+
+    def __init__(self, config_file: str = None):
+        super().__init__(config_file)
+
+    def transform_nl2query(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        name = threading.current_thread().name
+        return QueryAnnotationsDict(query=nlq, annotations=[self.create_target_annotation(name)])
+
+    def create_target_annotation(self, annotation) -> TargetAnnotation:
+        return TargetAnnotation(text=annotation, position=[0, 0], name=[annotation])
+
+    def create_property_annotation(self, annotation):
+        pass
+
+    def create_location_annotation(self, annotation):
+        pass
+
+    def create_temporal_annotation(self, annotation):
+        pass
+
+
+def nominatim_result(name: str, place_class: str, importance: float) -> dict:
+    return {"class": place_class, "importance": importance, "display_name": name, "lat": "45.4", "lon": "-75.7",
+            "boundingbox": ["45.0", "45.5", "-76.0", "-75.0"],
+            "geojson": {"type": "Polygon", "coordinates": [[[-76, 45], [-75, 45], [-75, 45.5], [-76, 45]]]}}
+
+
+def nominatim_handler(requests: list):
+    """Nominatim search answering the Ottawa tokens"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        query = request.url.params["q"]
+        requests.append(query)
+        if query == "ottawa":
+            return httpx.Response(200, json=[nominatim_result("Ottawa, Ontario, Canada", "boundary", 0.8)])
+        if query == "ottawa river":
+            return httpx.Response(200, json=[nominatim_result("Ottawa River", "waterway", 0.9)])
+        return httpx.Response(200, json=[])
+    return handler
+
+
+class AsyncTransformTests(unittest.TestCase):
+
+    def test_default_executor(self):
+        """
+        The default atransform_nl2query runs transform_nl2query outside of the event loop thread
+        """
+        async def transform():
+            pipeline = ThreadPipeline()
+            return await asyncio.gather(*[pipeline.atransform_nl2query(f"query {i}") for i in range(3)])
+
+        results = asyncio.run(transform())
+        self.assertEqual([result.query for result in results], ["query 0", "query 1", "query 2"])
+        for result in results:
+            self.assertNotEqual(result.annotations[0].text, threading.main_thread().name)
+
+    def test_single_flight(self):
+        """
+        Concurrent coroutines of the same key await a single computation
+        """
+        cache = ResultCache()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {"value": 1}
+
+        async def run():
+            return await asyncio.gather(*[acached_call(cache, "stage", "f", compute, ["q"]) for _ in range(5)])
+
+        self.assertEqual(asyncio.run(run()), [{"value": 1}] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats["shared"], 4)
+
+    def test_geocoding(self):
+        """
+        The tokens are geocoded concurrently, the longest place above the threshold is kept and the geocodings cached
+        """
+        requests = []
+        cache = ResultCache()
+
+        async def geocode():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(nominatim_handler(requests))) as client:
+                semaphore = asyncio.Semaphore(2)
+                first = await aosmnx_geocode(client, semaphore, "ottawa river flow", cache=cache)
+                second = await aosmnx_geocode(client, semaphore, "ottawa river flow", cache=cache)
+                return first, second
+
+        (token, gdf), (cached_token, _) = asyncio.run(geocode())
+        self.assertEqual(token, "ottawa")
+        self.assertEqual(cached_token, "ottawa")
+        self.assertEqual(gdf["display_name"].iloc[0], "Ottawa, Ontario, Canada")
+        self.assertEqual(gdf["bbox_north"].iloc[0], 45.5)
+        self.assertEqual(sorted(requests), sorted(["ottawa", "river", "flow", "ottawa river", "river flow"]))
+
+    def test_request_limiter(self):
+        """
+        The geocoding requests of a limiter start at least its interval apart, up to its concurrency at once
+        """
+        starts = []
+
+        async def request(limiter):
+            async with limiter:
+                starts.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def run():
+            limiter = RequestLimiter(concurrency=2, interval=0.05)
+            await asyncio.gather(*[request(limiter) for _ in range(4)])
+            self.assertEqual(limiter.semaphore._value, 2)
+
+        asyncio.run(run())
+        for previous, start in zip(starts, starts[1:]):
+            self.assertGreaterEqual(start - previous, 0.045)
+
+    def test_duckling_retries(self):
+        """
+        Duckling is requested again after a connection error or an error response, its answers are cached for the day
+        """
+        attempts = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            attempts.append(dict(httpx.QueryParams(request.content.decode("utf-8"))))
+            if len(attempts) == 1:
+                raise httpx.ConnectError("not ready")
+            if len(attempts) == 2:
+                return httpx.Response(503)
+            return httpx.Response(200, json=[{"body": "in 2020", "dim": "time"}])
+
+        # only the attributes used by the Duckling requests, without loading the vector databases
+        pipeline = V2_pipeline.__new__(V2_pipeline)
+        pipeline.duckling_url = "http://duckling/parse"
+        pipeline.duckling_locale = "en_GB"
+        pipeline.duckling_dims = ["time"]
+        pipeline.duckling_run = False
+        pipeline.result_cache, pipeline.cache_fingerprint = ResultCache(), "test"
+
+        async def parse():
+            client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            pipeline.async_clients = {asyncio.get_running_loop(): (client, RequestLimiter())}
+            try:
+                return [await pipeline.aduckling_parse("in 2020") for _ in range(2)]
+            finally:
+                await pipeline.aclose()
+
+        self.assertEqual(asyncio.run(parse()), [{"body": "in 2020", "dim": "time"}] * 2)
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(attempts[-1], {"text": "in 2020", "locale": "en_GB", "dims": json.dumps(["time"])})
+        self.assertEqual(pipeline.result_cache.stats["memory_hits"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
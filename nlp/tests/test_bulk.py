@@ -0,0 +1,165 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from configparser import ConfigParser
+from unittest import mock
+
+from nl2query.bulk import merge_shards, run_shard, shard_path
+from nl2query.cache import cached_transform, pipeline_cache
+from nl2query.NL2QueryInterface import QueryAnnotationsDict, TargetAnnotation
+from nl2query.runner import read_results, run_dataset
+from nl2query.stage_graph import Stage, StageGraph
+
+
+def annotate(queries):
+    return [QueryAnnotationsDict(query=query, annotations=[]) for query in queries]
+
+
+def first_word(nlq: str) -> str:
+    # both stages run at once, so that the executor of the warm-up starts all its threads
+    time.sleep(0.02)
+    return nlq.split()[0]
+
+
+def last_word(nlq: str) -> str:
+    time.sleep(0.02)
+    return nlq.split()[-1]
+
+
+class StagePipeline:
+    """ pipeline annotating the first and last words of a query with a concurrent stage graph, as V3 """
+
+    def __init__(self):
+        self.stage_graph = StageGraph([
+            Stage("first", first_word, inputs=["nlq"], outputs=["first"]),
+            Stage("last", last_word, inputs=["nlq"], outputs=["last"]),
+        ], inputs=["nlq"], concurrent=True, max_workers=2)
+
+    def transform_nl2query(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        values = self.stage_graph.run({"nlq": nlq})
+        return QueryAnnotationsDict(query=nlq, annotations=[
+            TargetAnnotation(text=values["first"], position=[0, len(values["first"])], name=[values["last"]])])
+
+    def transform_nl2query_batch(self, nlqs, verbose: bool = False):
+        return [self.transform_nl2query(nlq, verbose) for nlq in nlqs]
+
+    def close(self) -> None:
+        self.stage_graph.shutdown()
+
+
+class CachedStagePipeline(StagePipeline):
+    """ stage graph pipeline whose results are cached in an SQLite file, by the [cache] section of its config """
+
+    def __init__(self, path: str):
+        super().__init__()
+        config = ConfigParser()
+        config.read_dict({"cache": {"enabled": "true", "sqlite": "true", "path": path, "journal_mode": "DELETE"}})
+        self.result_cache, self.cache_fingerprint = pipeline_cache(config)
+
+    @cached_transform
+    def transform_nl2query(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        return super().transform_nl2query(nlq, verbose)
+
+
+class BulkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.tmp_dir.name, "logs.jsonl")
+        self.output_dir = os.path.join(self.tmp_dir.name, "out")
+        os.makedirs(self.output_dir)
+        with open(self.input_path, "w", encoding="utf-8") as f:
+            for i in range(11):
+                f.write(json.dumps({"query": f"query {i}"}) + "\n")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_shard(self, shard_index: int, shard_count: int) -> dict:
+        return run_dataset(annotate, self.input_path, shard_path(self.output_dir, shard_index, shard_count),
+                           batch_size=2, shard_index=shard_index, shard_count=shard_count)
+
+    def test_shards_and_merge(self):
+        """
+        The shards partition the input, the merge restores its order and sums their statistics
+        """
+        for shard_index in [2, 0, 1]:
+            self.run_shard(shard_index, 3)
+        shard = [result["query"] for result in read_results(shard_path(self.output_dir, 1, 3))]
+        self.assertEqual(shard, ["query 1", "query 4", "query 7", "query 10"])
+
+        merged_path = os.path.join(self.tmp_dir.name, "merged.jsonl")
+        stats = merge_shards(self.output_dir, merged_path)
+        self.assertEqual([result["query"] for result in read_results(merged_path)],
+                         [f"query {i}" for i in range(11)])
+        self.assertEqual(stats["queries"], 11)
+        self.assertEqual(stats["shards"], 3)
+        with open(merged_path + ".stats.json", "r", encoding="utf-8") as f:
+            self.assertEqual(json.load(f)["queries"], 11)
+
+    def test_run_shard_workers(self):
+        """
+        The shards of a stage graph pipeline are annotated by the forked workers
+        """
+        with mock.patch("nl2query.benchmarks.create_pipeline", side_effect=lambda *args: StagePipeline()), \
+                mock.patch.dict(os.environ, {"NL2QUERY_CACHE": "0"}):
+            stats = run_shard(self.input_path, self.output_dir, "V3", shard_index=0, shard_count=2, workers=2,
+                              threads=1, batch_size=4)
+            self.assertTrue(stats["done"])
+            run_shard(self.input_path, self.output_dir, "V3", shard_index=1, shard_count=2, batch_size=4)
+        merged_path = os.path.join(self.tmp_dir.name, "merged.jsonl")
+        self.assertEqual(merge_shards(self.output_dir, merged_path)["queries"], 11)
+        results = list(read_results(merged_path))
+        self.assertEqual([result["annotations"][0]["name"] for result in results], [[str(i)] for i in range(11)])
+
+    def test_run_shard_workers_cache(self):
+        """
+        The forked workers of a pipeline with an SQLite cache store their results with their own connection
+        """
+        cache_path = os.path.join(self.tmp_dir.name, "results.sqlite")
+        pipelines = []
+
+        def create_pipeline(*args):
+            pipelines.append(CachedStagePipeline(cache_path))
+            return pipelines[-1]
+        with mock.patch("nl2query.benchmarks.create_pipeline", side_effect=create_pipeline), \
+                mock.patch.dict(os.environ, {"NL2QUERY_CACHE": "1"}):
+            stats = run_shard(self.input_path, self.output_dir, "V3", shard_index=0, shard_count=2, workers=2,
+                              threads=1, batch_size=4)
+        self.assertTrue(stats["done"])
+        results = list(read_results(shard_path(self.output_dir, 0, 2)))
+        self.assertEqual([result["annotations"][0]["name"] for result in results],
+                         [[str(i)] for i in range(0, 11, 2)])
+        cache = pipelines[0].result_cache
+        self.assertEqual(cache.journal_mode, "DELETE")
+        # the warm-up query of the parent and the shard queries of the workers
+        self.assertEqual(cache.connection().execute("SELECT COUNT(*) FROM results").fetchone()[0], 7)
+        cache.close()
+
+    def test_different_inputs(self):
+        """
+        The shards of different inputs are not merged
+        """
+        other_path = os.path.join(self.tmp_dir.name, "other.jsonl")
+        with open(other_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"query": "other query"}) + "\n")
+        self.run_shard(0, 2)
+        run_dataset(annotate, other_path, shard_path(self.output_dir, 1, 2), shard_index=1, shard_count=2)
+        with self.assertRaises(ValueError):
+            merge_shards(self.output_dir, os.path.join(self.tmp_dir.name, "merged.jsonl"))
+
+    def test_missing_shard(self):
+        """
+        The merge needs every shard, and a resumed shard must be the same shard
+        """
+        self.run_shard(0, 2)
+        with self.assertRaises(ValueError):
+            merge_shards(self.output_dir, os.path.join(self.tmp_dir.name, "merged.jsonl"))
+        with self.assertRaises(ValueError):
+            run_dataset(annotate, self.input_path, shard_path(self.output_dir, 0, 2), shard_index=1, shard_count=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
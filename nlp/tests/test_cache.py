@@ -0,0 +1,257 @@
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from configparser import ConfigParser
+from unittest import mock
+
+from nl2query.cache import (
+    ResultCache,
+    cached_transform,
+    cached_transform_batch,
+    config_fingerprint,
+    deserialize,
+    normalize_query,
+    pipeline_cache,
+    serialize
+)
+from nl2query.NL2QueryInterface import QueryAnnotationsDict, TargetAnnotation, TemporalAnnotation
+
+
+class CountingPipeline:
+    """ pipeline annotating the first word of a query as target, temporal if it is a year """
+
+    def __init__(self, cache: ResultCache):
+        self.result_cache = cache
+        self.cache_fingerprint = "test"
+        self.calls = []
+
+    @staticmethod
+    def annotate(nlq: str) -> QueryAnnotationsDict:
+        word = nlq.split()[0]
+        if word.isdigit():
+            annotation = TemporalAnnotation(text=word, position=[0, len(word)], tempex_type="point",
+                                            target="dataDate", value=word)
+        else:
+            annotation = TargetAnnotation(text=word, position=[0, len(word)], name=[word])
+        return QueryAnnotationsDict(query=nlq, annotations=[annotation])
+
+    @cached_transform
+    def transform_nl2query(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        self.calls.append(nlq)
+        return self.annotate(nlq)
+
+    @cached_transform_batch
+    def transform_nl2query_batch(self, nlqs, verbose: bool = False):
+        self.calls.append(list(nlqs))
+        return [self.annotate(nlq) for nlq in nlqs]
+
+
+def store_in_child(cache: ResultCache) -> None:
+    """read the result of the parent and store another one, with the connection of the forked process"""
+    found, value = cache.get("stage", "f", ["parent"])
+    db = cache.connection()
+    cache.put("stage", "f", ["child"], 2)
+    sys.exit(0 if found and value == 1 and cache.inherited and db is not cache.inherited[0] else 1)
+
+
+class ResultCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "results.sqlite")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_normalize_query(self):
+        """
+        Whitespace runs are collapsed and the unicode form is NFC
+        """
+        self.assertEqual(normalize_query("  rainfall\tin \n Montréal "), "rainfall in Montréal")
+
+    def test_memory_and_sqlite_tiers(self):
+        """
+        The results are computed once, found in memory, then in SQLite by another process cache.
+        The queries not normalized are transformed as given, their positions refer to them
+        """
+        pipeline = CountingPipeline(ResultCache(self.path))
+        first = pipeline.transform_nl2query("snow depth")
+        second = pipeline.transform_nl2query("snow depth")
+        self.assertEqual(pipeline.calls, ["snow depth"])
+        self.assertEqual(first.to_dict(), second.to_dict())
+        self.assertIsNot(first, second)
+        self.assertEqual(pipeline.result_cache.stats["memory_hits"], 1)
+        self.assertEqual(pipeline.transform_nl2query(" snow depth").query, " snow depth")
+        self.assertEqual(pipeline.calls, ["snow depth", " snow depth"])
+
+        other = CountingPipeline(ResultCache(self.path))
+        self.assertEqual(other.transform_nl2query("snow depth").to_dict(), first.to_dict())
+        self.assertEqual(other.calls, [])
+        self.assertEqual(other.result_cache.stats["sqlite_hits"], 1)
+
+    def test_verbose_and_batch(self):
+        """
+        The verbose calls are not cached, the batches only transform the missing queries once
+        """
+        pipeline = CountingPipeline(ResultCache(max_items=2))
+        pipeline.transform_nl2query("snow depth", verbose=True)
+        pipeline.transform_nl2query("snow depth")
+        self.assertEqual(pipeline.calls, ["snow depth", "snow depth"])
+        results = pipeline.transform_nl2query_batch(["snow depth", "wind speed", "wind  speed", "wind speed"])
+        self.assertEqual(pipeline.calls[-1], ["wind speed", "wind  speed"])
+        self.assertEqual([result.query for result in results], ["snow depth", "wind speed", "wind  speed",
+                                                                 "wind speed"])
+        self.assertIsNot(results[1], results[3])
+        pipeline.transform_nl2query_batch(["wind speed", "wind  speed"])
+        self.assertEqual(pipeline.calls[-1], ["wind  speed"])
+
+    def test_dated_results_expire(self):
+        """
+        The results with temporal annotations are only valid on the day they were computed
+        """
+        pipeline = CountingPipeline(ResultCache(self.path))
+        with mock.patch("nl2query.cache.today", return_value="2024-01-01"):
+            pipeline.transform_nl2query("2020 rainfall")
+            pipeline.transform_nl2query("rainfall 2020")
+            pipeline.transform_nl2query("2020 rainfall")
+        self.assertEqual(len(pipeline.calls), 2)
+        with mock.patch("nl2query.cache.today", return_value="2024-01-02"):
+            pipeline.transform_nl2query("2020 rainfall")
+            pipeline.transform_nl2query("rainfall 2020")
+        self.assertEqual(pipeline.calls, ["2020 rainfall", "rainfall 2020", "2020 rainfall"])
+        self.assertEqual(pipeline.result_cache.stats["expired"], 1)
+
+    def test_sqlite_pruning(self):
+        """
+        The SQLite results older than max_age_days or of a previous day are removed, then the oldest above max_rows
+        """
+        cache = ResultCache(self.path, max_age_days=30, max_rows=3)
+        for i in range(5):
+            cache.put("stage", "old", [i], i)
+        cache.db.execute("UPDATE results SET created = created - 40")
+        with mock.patch("nl2query.cache.today", return_value="2024-01-01"):
+            cache.put("stage", "f", ["dated"], 0, dated=True)
+        for i in range(4):
+            cache.put("stage", "f", [i], i)
+        cache.prune()
+        keys = {row[0] for row in cache.db.execute("SELECT key FROM results")}
+        self.assertEqual(keys, {cache.key("stage", "f", [i]) for i in range(1, 4)})
+
+    def test_serialization(self):
+        """
+        The results are stored as JSON and rebuilt with their annotations and tuples
+        """
+        result = CountingPipeline.annotate("2020 rainfall")
+        value = ("rainfall", [("precipitation", 0.9)], {"annotations": result, "none": None})
+        copy = deserialize(serialize(value))
+        self.assertEqual(copy[:2], value[:2])
+        self.assertEqual(copy[2]["annotations"].to_dict(), result.to_dict())
+        self.assertIsNone(copy[2]["none"])
+
+        cache = ResultCache(self.path)
+        cache.put("stage", "f", ["q"], result)
+        stored = cache.connection().execute("SELECT value FROM results").fetchone()[0]
+        self.assertEqual(json.loads(stored)["data"], result.to_dict())
+
+    @unittest.skipUnless(importlib.util.find_spec("geopandas"), "geopandas is not installed")
+    def test_geodataframe_serialization(self):
+        """
+        The geocodings are rebuilt with their columns and CRS
+        """
+        import geopandas as gpd
+        feature = {"type": "Feature", "geometry": {"type": "Point", "coordinates": [-75.7, 45.4]},
+                   "properties": {"class": "boundary", "importance": 0.8, "display_name": "Ottawa"}}
+        gdf = gpd.GeoDataFrame.from_features([feature], crs="EPSG:4326")
+        copy = deserialize(serialize(gdf))
+        self.assertEqual(copy.crs, gdf.crs)
+        self.assertEqual(copy["class"].iloc[0], "boundary")
+        self.assertEqual(copy["importance"].iloc[0], 0.8)
+        self.assertTrue(copy.geometry.iloc[0].equals(gdf.geometry.iloc[0]))
+
+    @unittest.skipUnless("fork" in multiprocessing.get_all_start_methods(), "fork is not available")
+    def test_fork(self):
+        """
+        A forked process opens its own SQLite connection, the one of the parent is still used by the parent
+        """
+        cache = ResultCache(self.path)
+        cache.put("stage", "f", ["parent"], 1)
+        parent_db = cache.connection()
+        process = multiprocessing.get_context("fork").Process(target=store_in_child, args=(cache,))
+        process.start()
+        process.join(30)
+        self.assertEqual(process.exitcode, 0)
+        self.assertIs(cache.connection(), parent_db)
+        cache.memory.clear()
+        self.assertEqual(cache.get("stage", "f", ["child"]), (True, 2))
+        cache.close()
+        self.assertIsNone(cache.db)
+        self.assertEqual(cache.get("stage", "f", ["parent"]), (True, 1))
+
+    def test_single_flight(self):
+        """
+        Concurrent requests of the same key wait for a single computation
+        """
+        cache = ResultCache()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return {"value": 1}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute("stage", "f", ["q"], compute)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"value": 1}] * 4)
+        self.assertEqual(cache.stats["shared"], 3)
+
+    def test_config_fingerprint(self):
+        """
+        The fingerprint changes with the files referenced by the config
+        """
+        vocab = os.path.join(self.tmp_dir.name, "vocab.csv")
+        with open(vocab, "w", encoding="utf-8") as f:
+            f.write("varname,aliases\nrainfall,precipitation\n")
+        config_file = os.path.join(self.tmp_dir.name, "config.cfg")
+        with open(config_file, "w", encoding="utf-8") as f:
+            f.write(f"[targ_vdb]\ntarg_vocab_path = {vocab}\n")
+        fingerprint = config_fingerprint(config_file)
+        self.assertEqual(config_fingerprint(config_file), fingerprint)
+        with open(vocab, "a", encoding="utf-8") as f:
+            f.write("snowfall,snow\n")
+        self.assertNotEqual(config_fingerprint(config_file), fingerprint)
+
+    def test_pipeline_cache(self):
+        """
+        The cache is disabled by the config or the environment
+        """
+        config = ConfigParser()
+        config.read_dict({"cache": {"enabled": "true", "sqlite": "false", "max_items": "8"}})
+        with mock.patch.dict(os.environ, {"NL2QUERY_CACHE": "1"}):
+            cache, fingerprint = pipeline_cache(config)
+            self.assertIsNone(cache.path)
+            self.assertEqual(cache.max_items, 8)
+            self.assertTrue(fingerprint)
+            self.assertEqual(pipeline_cache(ConfigParser()), (None, ""))
+            # the SQLite tier is opt-in
+            config.remove_option("cache", "sqlite")
+            self.assertIsNone(pipeline_cache(config)[0].path)
+            with self.assertRaises(ValueError):
+                ResultCache(self.path, journal_mode="MMAP")
+        with mock.patch.dict(os.environ, {"NL2QUERY_CACHE": "0"}):
+            self.assertEqual(pipeline_cache(config), (None, ""))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+from configparser import ConfigParser
+
+from nl2query.fusion import AnnotationFusion, intervals
+from nl2query.NL2QueryInterface import LocationAnnotation, TargetAnnotation, TemporalAnnotation
+
+
+def target(text: str, position: list) -> TargetAnnotation:
+    return TargetAnnotation(text=text, position=position, name=[text])
+
+
+def location(text: str, position: list) -> LocationAnnotation:
+    return LocationAnnotation(text=text, position=position, matching_type="overlap", name=text, value={})
+
+
+def texts(annotations) -> list:
+    return [annotation.text for annotation in annotations]
+
+
+class AnnotationFusionTests(unittest.TestCase):
+
+    def test_priority(self):
+        """
+        The annotations of the first source win the overlaps, the other ones are added and all sorted by start
+        """
+        fusion = AnnotationFusion(sources=["spacy", "flair"])
+        spacy = [target("snow depth", [10, 20]), location("Ottawa", [24, 30])]
+        flair = [target("depth in", [15, 23]), target("daily", [0, 5]), location("Ottawa", [24, 30]),
+                 target("in", [21, 23])]
+        self.assertEqual(texts(fusion.fuse({"spacy": spacy, "flair": flair})),
+                         ["daily", "snow depth", "in", "Ottawa"])
+
+    def test_longest(self):
+        """
+        The longest spans win the overlaps, the source order breaks the ties
+        """
+        fusion = AnnotationFusion(policy="longest", sources=["spacy", "flair"])
+        spacy = [target("depth", [15, 20]), location("Ottawa", [24, 30])]
+        flair = [target("snow depth", [10, 20]), location("Ottawa", [24, 30])]
+        fused = fusion.fuse({"spacy": spacy, "flair": flair})
+        self.assertEqual(texts(fused), ["snow depth", "Ottawa"])
+        self.assertIs(fused[1], spacy[1])
+
+    def test_type_rules(self):
+        """
+        A type specific source order overrides the default one for that type only
+        """
+        config = ConfigParser()
+        config.read_dict({"fusion": {"policy": "priority", "sources": "spacy, flair", "location": "flair, spacy"}})
+        fusion = AnnotationFusion.from_config(config)
+        spacy = [location("Ottawa", [24, 30]), target("snow", [10, 14])]
+        flair = [location("Ottawa River", [24, 36]), target("snow depth", [10, 20])]
+        self.assertEqual(texts(fusion.fuse({"spacy": spacy, "flair": flair})), ["snow", "Ottawa River"])
+
+    def test_split_positions(self):
+        """
+        A split span conflicts through any of its parts, and does not block the gap between them
+        """
+        fusion = AnnotationFusion(sources=["spacy", "flair"])
+        self.assertEqual(intervals([[0, 4], [10, 15]]), [(0, 4), (10, 15)])
+        spacy = [target("snow depth", [[0, 4], [10, 15]])]
+        flair = [TemporalAnnotation(text="2020", position=[5, 9], tempex_type="point", target="dataDate",
+                                    value="2020"),
+                 target("depth daily", [12, 21])]
+        self.assertEqual(texts(fusion.fuse({"spacy": spacy, "flair": flair})), ["snow depth", "2020"])
+
+    def test_keep_source(self):
+        """
+        All the annotations of a kept source are accepted, even overlapping each other, the other ones around them
+        """
+        fusion = AnnotationFusion(policy="longest", sources=["spacy", "flair"])
+        spacy = [target("snow depth", [10, 20]), target("depth", [15, 20]), location("Ottawa", [24, 30])]
+        flair = [target("daily snow depth", [4, 20]), target("daily", [0, 5]), target("in", [21, 23]),
+                 location("Ottawa River", [24, 36]), target("river", [31, 36])]
+        self.assertEqual(texts(fusion.fuse({"spacy": spacy, "flair": flair}, keep=["spacy"])),
+                         ["daily", "snow depth", "depth", "in", "Ottawa", "river"])
+
+    def test_disabled_source(self):
+        """
+        A disabled source (None) is ignored
+        """
+        fusion = AnnotationFusion(sources=["spacy", "flair"])
+        flair = [target("snow", [0, 4])]
+        self.assertEqual(texts(fusion.fuse({"spacy": None, "flair": flair})), ["snow"])
+        with self.assertRaises(ValueError):
+            AnnotationFusion(policy="first")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import time
+import unittest
+
+from nl2query.governor import MemoryGovernor
+from nl2query.registry import ModelRegistry
+
+
+class Component:
+
+    def __init__(self, name):
+        self.name = name
+
+
+class MemoryGovernorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.released = []
+        self.registry = ModelRegistry()
+
+    def release(self, name):
+        self.released.append(name)
+        self.registry.release_owner(name)
+
+    def test_idle_timeout(self):
+        """
+        Pipelines idle past the timeout are released, unless in use
+        """
+        governor = MemoryGovernor(self.release, idle_timeout=0.01)
+        governor.loaded("V1")
+        governor.loaded("V2")
+        with governor.using("V2"):
+            time.sleep(0.02)
+            events = governor.enforce()
+        self.assertListEqual(self.released, ["V1"])
+        self.assertEqual(events[0]["reason"], "idle")
+        self.assertListEqual([p["pipeline"] for p in governor.residency()], ["V2"])
+
+    def test_budget_lru_order(self):
+        """
+        Over budget, the least recently used pipelines are released first, never the one just loaded
+        """
+        governor = MemoryGovernor(self.release, budget_mb=0)
+        governor.last_used.update({"V1": 0, "V2": 0})
+        with governor.using("V1"):
+            pass
+        governor.loaded("V3")
+        self.assertListEqual(self.released, ["V2", "V1"])
+        self.assertListEqual([e["reason"] for e in governor.events], ["budget", "budget"])
+
+    def test_release_shared_models(self):
+        """
+        A model shared by two pipelines is only released with the last one
+        """
+        with self.registry.owner("V1"):
+            spacy = self.registry.get(Component, "spacy")
+        with self.registry.owner("V3"):
+            self.assertIs(self.registry.get(Component, "spacy"), spacy)
+            self.registry.get(Component, "flair")
+        self.assertListEqual(self.registry.release_owner("V1"), [])
+        released = self.registry.release_owner("V3")
+        self.assertEqual(len(released), 2)
+        self.assertDictEqual(self.registry.residency(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+import asyncio
+import io
+import threading
+import unittest
+from contextlib import redirect_stdout
+
+import requests
+
+from nl2query.cache import ResultCache
+from nl2query.metrics import (
+    CACHE_LOOKUPS,
+    METRICS,
+    REQUEST_ERRORS,
+    REQUEST_TIMEOUTS,
+    REQUESTS,
+    STAGE_SECONDS,
+    Histogram,
+    MetricsRegistry,
+    cache_hit_ratios,
+    is_timeout,
+    print_summary,
+    request_timer,
+    timed_request
+)
+from nl2query.NL2QueryInterface import QueryAnnotationsDict
+from nl2query.service import MicroBatcher, NL2QueryClient, create_server
+from nl2query.stage_graph import Stage, StageGraph
+
+
+@timed_request("test_service")
+def call_service(fail: Exception = None) -> str:
+    if fail is not None:
+        raise fail
+    return "ok"
+
+
+@timed_request("test_service")
+async def acall_service() -> str:
+    await asyncio.sleep(0)
+    return "ok"
+
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        METRICS.reset()
+
+    def test_requests(self):
+        """
+        The requests are counted with their errors, timeouts and latencies
+        """
+        call_service()
+        self.assertEqual(asyncio.run(acall_service()), "ok")
+        with self.assertRaises(ValueError):
+            call_service(ValueError("bad response"))
+        try:
+            try:
+                raise requests.exceptions.ReadTimeout("read timed out")
+            except requests.exceptions.RequestException as exc:
+                raise Exception("Please make sure the service is running!") from exc
+        except Exception as exc:
+            self.assertTrue(is_timeout(exc))
+            with self.assertRaises(Exception):
+                call_service(exc)
+        with request_timer("test_service") as timer:
+            timer.error()
+        self.assertEqual(REQUESTS.get("test_service"), 5)
+        self.assertEqual(REQUEST_ERRORS.get("test_service"), 3)
+        self.assertEqual(REQUEST_TIMEOUTS.get("test_service"), 1)
+        self.assertFalse(is_timeout(ValueError()))
+        with redirect_stdout(io.StringIO()) as out:
+            print_summary()
+        self.assertIn("test_service", out.getvalue())
+
+    def test_histogram_and_prometheus(self):
+        """
+        The histogram buckets are cumulative in the Prometheus text format
+        """
+        registry = MetricsRegistry()
+        latency = registry.histogram("test_seconds", "Test latency.", ["stage"], buckets=[0.1, 1])
+        for value in [0.05, 0.5, 0.7, 3]:
+            latency.observe(value, "search")
+        self.assertIs(registry.histogram("test_seconds", "Test latency.", ["stage"]), latency)
+        with self.assertRaises(ValueError):
+            registry.counter("test_seconds", "Test count.")
+        self.assertEqual(latency.quantile(0.5, "search"), 1)
+        self.assertIsInstance(latency, Histogram)
+        registry.counter("test_total", "Test count.", ["service"]).inc('a "b"')
+        text = registry.to_prometheus()
+        self.assertIn("# TYPE test_seconds histogram\n", text)
+        self.assertIn('test_seconds_bucket{stage="search",le="0.1"} 1\n', text)
+        self.assertIn('test_seconds_bucket{stage="search",le="1"} 3\n', text)
+        self.assertIn('test_seconds_bucket{stage="search",le="+Inf"} 4\n', text)
+        self.assertIn('test_seconds_count{stage="search"} 4\n', text)
+        self.assertIn('test_total{service="a \\"b\\""} 1\n', text)
+        self.assertEqual(registry.snapshot()["test_seconds"]["search"]["count"], 4)
+
+    def test_cache_and_stages(self):
+        """
+        The cache lookups give the hit ratios, the stages of a stage graph are timed
+        """
+        cache = ResultCache()
+        for query in ["snow", "snow", "wind", "snow"]:
+            cache.get_or_compute("test_stage", "test", [query], lambda: query.upper())
+        self.assertEqual(CACHE_LOOKUPS.get("test_stage", "hit"), 2)
+        self.assertEqual(cache_hit_ratios()["test_stage"], 0.5)
+
+        graph = StageGraph([Stage("upper", str.upper, inputs=["text"], outputs=["upper"])], inputs=["text"],
+                           concurrent=False)
+        graph.run({"text": "snow"})
+        graph.run({"text": "wind"})
+        self.assertEqual(STAGE_SECONDS.get("upper"), 2)
+
+    def test_service_metrics(self):
+        """
+        The annotation service exports the metrics of its process
+        """
+        class EchoPipeline:
+            def transform_nl2query_batch(self, nlqs, verbose=False):
+                call_service()
+                return [QueryAnnotationsDict(query=nlq, annotations=[]) for nlq in nlqs]
+
+        batcher = MicroBatcher(EchoPipeline(), max_wait_ms=1)
+        server = create_server({"V3": batcher}, port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            client = NL2QueryClient(f"http://127.0.0.1:{server.server_address[1]}")
+            client.transform_nl2query("snow depth")
+            text = client.metrics()
+        finally:
+            server.shutdown()
+            server.server_close()
+            batcher.close()
+        self.assertIn('nl2query_requests_total{service="test_service"} 1\n', text)
+        self.assertIn("# TYPE nl2query_request_seconds histogram\n", text)
+
+
+if __name__ == "__main__":
+    unittest.main()
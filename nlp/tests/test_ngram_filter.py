@@ -0,0 +1,44 @@
+import unittest
+
+from nl2query.V2.ngram_filter import PRUNE_STAGES, NgramFilter
+
+
+class NgramFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.ngram_filter = NgramFilter(stopwords=["of", "the", "in"], min_chars=2)
+
+    def test_prune_stages(self):
+        """
+        Each n-gram is pruned by the first matching stage and counted once
+        """
+        ngrams = ["of the", "2100", "- 10", "x", "uk", "sea ice", "Sea  Ice", "wind", "wind"]
+        kept, duplicates, pruned, stats = self.ngram_filter.filter(ngrams, covered=["in the uk"])
+        self.assertListEqual(kept, ["sea ice", "wind"])
+        self.assertDictEqual(duplicates, {"Sea  Ice": "sea ice"})
+        self.assertSetEqual(pruned, {"of the", "2100", "- 10", "x", "uk"})
+        self.assertDictEqual(stats, {"stopwords": 1, "numeric": 2, "min_chars": 1, "covered": 1, "duplicate": 2})
+
+    def test_covered_whole_words(self):
+        """
+        Coverage is checked on whole words of the annotation texts
+        """
+        kept, _, pruned, _ = self.ngram_filter.filter(["ice", "sea ice", "ice age"], covered=["sea ice"])
+        self.assertListEqual(kept, ["ice age"])
+        self.assertSetEqual(pruned, {"ice", "sea ice"})
+
+    def test_disabled_stages(self):
+        """
+        Stages can be disabled individually
+        """
+        ngram_filter = NgramFilter(stopwords=None, numeric=False, min_chars=0, covered=False, dedup=False)
+        ngrams = ["of the", "2100", "x", "wind", "Wind"]
+        kept, duplicates, pruned, stats = ngram_filter.filter(ngrams, covered=["wind"])
+        self.assertListEqual(kept, ngrams)
+        self.assertDictEqual(duplicates, {})
+        self.assertSetEqual(pruned, set())
+        self.assertDictEqual(stats, dict.fromkeys(PRUNE_STAGES, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
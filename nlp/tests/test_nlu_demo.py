@@ -1,6 +1,86 @@
+import pytest
 
 
 def test_nlu_demo_importable():
     # this is the test itself!
     # ensure that definitions and pipelines are all properly resolved in the demo
     from nlu_demo import NLU_demo  # noqa
+    # the pipelines are imported lazily by the demo, check them here
+    from nl2query.V1.V1_pipeline import V1_pipeline  # noqa
+    from nl2query.V2.V2_pipeline import V2_pipeline  # noqa
+    from nl2query.V3.V3_pipeline import V3_pipeline  # noqa
+
+
+def test_nlu_demo_lazy_imports():
+    # the pipelines dependencies must only be imported when a pipeline is instantiated
+    from nl2query.benchmarks.import_time import import_profile
+    _, _, heavy = import_profile("nlu_demo")
+    assert heavy == []
+
+
+class StubPipeline:
+    """ pipeline of the annotation service recording its queries, loaded after release() if blocking """
+    loaded = []
+    release = None
+
+    def __init__(self, url, version):
+        if self.release is not None and version == "V1":
+            self.release.wait(10)
+        self.version = version
+        self.queries = []
+        self.loaded.append(version)
+
+    def transform_nl2query(self, nlq, verbose=False):
+        self.queries.append(nlq)
+
+
+def stub_demo(monkeypatch, **kwargs):
+    from nlu_demo import NLU_demo
+    monkeypatch.setattr("nl2query.service.NL2QueryClient", StubPipeline)
+    monkeypatch.delenv("NLU_WARMUP_QUERY", raising=False)
+    StubPipeline.loaded, StubPipeline.release = [], None
+    demo = NLU_demo(warmup=False, **kwargs)
+    demo.service_url = "http://stub"
+    return demo
+
+
+def test_nlu_demo_warmup(monkeypatch):
+    # the warm-up only loads the pipeline, the query requesting Duckling and Nominatim is opt-in
+    from nlu_demo import WARMUP_QUERY
+    demo = stub_demo(monkeypatch)
+    pipeline = demo.warmup("V2").result(timeout=10)
+    assert pipeline.queries == []
+    assert demo.v2_instance is pipeline
+    assert demo.warmup_states["V2"] == "ready"
+    demo.governor.stop()
+
+    demo = stub_demo(monkeypatch, warmup_query=WARMUP_QUERY)
+    assert demo.warmup("V2").result(timeout=10).queries == [WARMUP_QUERY]
+    demo.governor.stop()
+
+
+def test_nlu_demo_get_pipeline(monkeypatch):
+    # a warm-up queued behind another one is cancelled and the pipeline loaded right away
+    import threading
+    demo = stub_demo(monkeypatch, warmup_query="snow depth")
+    StubPipeline.release = threading.Event()
+    v1_future = demo.warmup("V1")
+    v3_future = demo.warmup("V3")
+    v3 = demo.get_pipeline("V3")
+    assert v3_future.cancelled()
+    assert v3.version == "V3" and v3.queries == []
+    assert demo.get_pipeline("V3") is v3
+    StubPipeline.release.set()
+    assert v1_future.result(timeout=10).queries == ["snow depth"]
+    assert StubPipeline.loaded == ["V3", "V1"]
+
+    # a failed loading is retried on next use
+    def fail(url, version):
+        raise ConnectionError("service not running")
+    monkeypatch.setattr("nl2query.service.NL2QueryClient", fail)
+    with pytest.raises(ConnectionError):
+        demo.get_pipeline("V2")
+    assert "V2" not in demo.warmups
+    monkeypatch.setattr("nl2query.service.NL2QueryClient", StubPipeline)
+    assert demo.get_pipeline("V2").version == "V2"
+    demo.governor.stop()
@@ -0,0 +1,41 @@
+import unittest
+from configparser import ConfigParser
+
+import torch
+
+from nl2query.quantization import quantization_layers, quantize_dynamic
+
+
+def make_config(enabled, layers="Linear"):
+    config = ConfigParser()
+    config.read_dict({"quantization": {"enabled": enabled, "layers": layers}})
+    return config
+
+
+class QuantizationTests(unittest.TestCase):
+
+    def test_quantization_layers(self):
+        """
+        The layers are only returned when the quantization is enabled, unknown layers are rejected
+        """
+        self.assertListEqual(quantization_layers(make_config("false")), [])
+        self.assertListEqual(quantization_layers(ConfigParser()), [])
+        self.assertListEqual(quantization_layers(make_config("true", "Linear, LSTM")), ["Linear", "LSTM"])
+        with self.assertRaises(ValueError):
+            quantization_layers(make_config("true", "Conv2d"))
+
+    def test_quantize_dynamic(self):
+        """
+        The linear layers are replaced by int8 ones giving close outputs
+        """
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(torch.nn.Linear(32, 64), torch.nn.ReLU(), torch.nn.Linear(64, 8)).eval()
+        inputs = torch.randn(4, 32)
+        expected = model(inputs)
+        quantize_dynamic(model, ["Linear"])
+        self.assertIsInstance(model[0], torch.ao.nn.quantized.dynamic.Linear)
+        self.assertTrue(torch.allclose(model(inputs), expected, atol=0.05))
+
+
+if __name__ == "__main__":
+    unittest.main()
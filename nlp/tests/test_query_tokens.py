@@ -0,0 +1,94 @@
+import unittest
+
+from nl2query.V2.query_tokens import QueryTokens
+from nl2query.V2.V2_pipeline import find_spans
+
+
+class QueryTokensTests(unittest.TestCase):
+
+    def test_offsets(self):
+        """
+        The tokens keep their positions in the original query, without the removed characters
+        """
+        nlq = "rainfall  (mm) in Ottawa, Canada"
+        tokens = QueryTokens(nlq, remove="(),")
+        self.assertEqual(tokens.tokens, ["rainfall", "mm", "in", "Ottawa", "Canada"])
+        self.assertEqual([nlq[s:e] for s, e in zip(tokens.starts, tokens.ends)], tokens.tokens)
+        self.assertEqual(tokens.text(), "rainfall mm in Ottawa Canada")
+
+    def test_consume(self):
+        """
+        The consumed spans and the stopwords are left out of the text, copies have their own mask
+        """
+        tokens = QueryTokens("snow depth in the north of Quebec", frozenset(["in", "the", "of"]))
+        self.assertEqual(tokens.text(skip_stopwords=True), "snow depth north Quebec")
+        copy = tokens.copy()
+        self.assertTrue(copy.consume_span("snow depth"))
+        self.assertFalse(copy.consume_span("snow depth"))
+        copy.consume_stopwords()
+        self.assertEqual(copy.text(), "north Quebec")
+        self.assertEqual(tokens.text(), "snow depth in the north of Quebec")
+
+    def test_positions(self):
+        """
+        A span of tokens split by consumed ones has the positions of its parts in the query
+        """
+        nlq = "wind speed in  summer at 10m height"
+        tokens = QueryTokens(nlq, frozenset(["in", "at"]))
+        tokens.consume_stopwords()
+        tokens.consume_span("summer")
+        indices = tokens.match("speed 10m")
+        self.assertEqual(indices, [1, 5])
+        spans, pos = tokens.positions(indices)
+        self.assertEqual(spans, ["speed", "10m"])
+        self.assertEqual([nlq[s:e] for s, e in pos], spans)
+        self.assertEqual(find_spans("wind speed", tokens), ("wind speed", [0, 10]))
+
+    def test_map_range(self):
+        """
+        The ranges of the text left to annotate are mapped to the query
+        """
+        nlq = "precipitation (daily) from  March 2020"
+        tokens = QueryTokens(nlq, remove="(),")
+        tokens.consume_span("precipitation")
+        text = tokens.text()
+        start = text.index("March 2020")
+        indices, pos = tokens.map_range(start, start + len("March 2020"))
+        self.assertEqual(indices, [3, 4])
+        self.assertEqual(nlq[pos[0]:pos[1]], "March 2020")
+
+    def test_text_range(self):
+        """
+        The tokens overlapping a range of the text are those of a scan of the remaining tokens, after each consume
+        """
+        tokens = QueryTokens("daily mean snow depth in the north of Quebec since 2000", frozenset(["in", "the", "of"]))
+
+        def scanned(start, end):
+            indices, offset = [], 0
+            for i in tokens.remaining():
+                if offset < end and start < offset + len(tokens.tokens[i]):
+                    indices.append(i)
+                offset += len(tokens.tokens[i]) + 1
+            return indices
+
+        for consume in [None, tokens.consume_stopwords, lambda: tokens.consume_span("snow depth"),
+                        lambda: tokens.consume([0, 10])]:
+            if consume:
+                consume()
+            length = len(tokens.text())
+            for start in range(-1, length + 2):
+                for end in range(start, length + 2):
+                    self.assertEqual(tokens.text_range(start, end), scanned(start, end), (tokens.text(), start, end))
+        self.assertEqual(tokens.text(), "mean north Quebec since")
+
+    def test_locate(self):
+        """
+        A span which is not a run of whole tokens is located by the tokens it overlaps
+        """
+        tokens = QueryTokens("temperatures of 2019")
+        self.assertEqual(tokens.locate("temperature"), [0])
+        self.assertIsNone(tokens.locate("humidity"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from nl2query.registry import ModelRegistry, config_key, synchronized
+
+
+class Component:
+    created = 0
+
+    def __init__(self, config=None, size=0):
+        Component.created += 1
+        self.config = config
+        self.payload = bytearray(size)
+        self.calls = 0
+
+    @synchronized
+    def call(self):
+        calls = self.calls
+        time.sleep(0.001)
+        self.calls = calls + 1
+        return self.calls
+
+    def read(self, barrier: threading.Barrier):
+        # waits for the other readers, only returns if they run concurrently
+        barrier.wait(timeout=5)
+        return len(self.payload)
+
+
+class Options:
+
+    def __init__(self, stopwords, min_chars=2):
+        self.stopwords = set(stopwords)
+        self.min_chars = min_chars
+
+
+class ModelRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = ModelRegistry()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = os.path.join(self.tmp_dir, "config.cfg")
+        with open(self.config, "w", encoding="utf-8") as f:
+            f.write("[model_file]\nner-large = flair/ner-english-large\n")
+        Component.created = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_same_resolved_config(self):
+        """
+        The same config file given with another path shares the instance, another content does not
+        """
+        relative = os.path.relpath(self.config)
+        first = self.registry.get(Component, self.config)
+        self.assertIs(self.registry.get(Component, relative), first)
+        other = os.path.join(self.tmp_dir, "other.cfg")
+        with open(other, "w", encoding="utf-8") as f:
+            f.write("[model_file]\nner-large = ner-fast\n")
+        self.assertIsNot(self.registry.get(Component, other), first)
+        self.assertEqual(Component.created, 2)
+        report = self.registry.memory_report()
+        self.assertListEqual([entry["refs"] for entry in report], [2, 1])
+
+    def test_concurrent_get_and_calls(self):
+        """
+        Concurrent users create a single instance, the calls of its synchronized methods are serialized
+        """
+        instances = []
+
+        def use():
+            instance = self.registry.get(Component, self.config, size=2 ** 20)
+            instances.append(instance)
+            for _ in range(10):
+                instance.call()
+
+        threads = [threading.Thread(target=use) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(Component.created, 1)
+        self.assertTrue(all(instance is instances[0] for instance in instances))
+        self.assertEqual(instances[0].calls, 80)
+
+    def test_plain_instance(self):
+        """
+        The shared instance is the instance itself, its other methods run concurrently
+        """
+        instance = self.registry.get(Component, self.config, size=16)
+        self.assertIsInstance(instance, Component)
+        self.assertIsInstance(instance.payload, bytearray)
+        barrier = threading.Barrier(4)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(instance.read(barrier))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [16] * 4)
+
+    def test_option_objects_key(self):
+        """
+        Option objects are compared by their attributes
+        """
+        self.assertEqual(config_key({"filter": Options(["of", "the"])}), config_key({"filter": Options(["the", "of"])}))
+        self.assertNotEqual(config_key({"filter": Options(["of"])}), config_key({"filter": Options(["of"], 3)}))
+
+
+if __name__ == "__main__":
+    unittest.main()
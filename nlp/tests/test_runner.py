@@ -0,0 +1,111 @@
+import json
+import os
+import tempfile
+import unittest
+
+from nl2query.NL2QueryInterface import QueryAnnotationsDict, TargetAnnotation
+from nl2query.runner import iter_queries, read_results, run_ceda_queries, run_dataset
+
+
+class Crash(BaseException):
+    """ interruption of the process (not caught as a failing query) """
+
+
+class FirstWordAnnotator:
+    """ batch annotation of the first word of the queries as target, failing on the empty ones """
+
+    def __init__(self, crash_after: int = None):
+        self.crash_after = crash_after
+        self.batches = []
+
+    def __call__(self, queries):
+        if self.crash_after is not None and sum(len(batch) for batch in self.batches) >= self.crash_after:
+            raise Crash()
+        self.batches.append(list(queries))
+        results = []
+        for query in queries:
+            word = query.split()[0]
+            results.append(QueryAnnotationsDict(query=query, annotations=[
+                TargetAnnotation(text=word, position=[0, len(word)], name=[word])]))
+        return results
+
+
+class RunnerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.tmp_dir.name, "queries.jsonl")
+        self.output_path = os.path.join(self.tmp_dir.name, "results.jsonl")
+        with open(self.input_path, "w", encoding="utf-8") as f:
+            for i in range(10):
+                if i == 8:
+                    f.write('{"query": " ", "user": "a"}\n\n')
+                elif i % 2:
+                    f.write(json.dumps(f"query {i}") + "\n")
+                else:
+                    f.write(f"query {i}\n")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_batches_and_errors(self):
+        """
+        The queries are annotated by batches in input order, a failing query gets an error
+        """
+        annotate = FirstWordAnnotator()
+        stats = run_dataset(annotate, self.input_path, self.output_path, batch_size=4)
+        results = list(read_results(self.output_path))
+        self.assertEqual([result["index"] for result in results], list(range(10)))
+        self.assertEqual(results[1]["annotations"][0]["text"], "query")
+        self.assertIn("error", results[8])
+        self.assertEqual(stats["errors"], 1)
+        self.assertTrue(stats["done"])
+        self.assertEqual(len(annotate.batches[0]), 4)
+
+    def test_resume(self):
+        """
+        A crashed run resumes after its last completed batch, without duplicated or missing results
+        """
+        with self.assertRaises(Crash):
+            run_dataset(FirstWordAnnotator(crash_after=6), self.input_path, self.output_path, batch_size=3)
+        # partial line of an unfinished batch
+        with open(self.output_path, "ab") as f:
+            f.write(b'{"index": 6, "que')
+        annotate = FirstWordAnnotator()
+        run_dataset(annotate, self.input_path, self.output_path, batch_size=3)
+        self.assertEqual(annotate.batches[0], ["query 6", "query 7", " "])
+        self.assertEqual([result["index"] for result in read_results(self.output_path)], list(range(10)))
+
+        # a finished run is not run again, except without resume
+        annotate = FirstWordAnnotator()
+        run_dataset(annotate, self.input_path, self.output_path)
+        self.assertEqual(annotate.batches, [])
+        run_dataset(annotate, self.input_path, self.output_path, resume=False)
+        self.assertEqual(len(list(read_results(self.output_path))), 10)
+
+    def test_json_input(self):
+        """
+        The JSON files of the gold format are read from the start index
+        """
+        json_path = os.path.join(self.tmp_dir.name, "gold.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump({"queries": [{"query": "snow depth", "annotations": []}, {"query": "wind speed"}]}, f)
+        self.assertEqual([query for _, query, _ in iter_queries(json_path, start=1)], ["wind speed"])
+        run_dataset(FirstWordAnnotator(), self.input_path, self.output_path)
+        with self.assertRaises(ValueError):
+            run_dataset(FirstWordAnnotator(), json_path, self.output_path)
+
+    def test_ceda_queries(self):
+        """
+        The CEDA gold queries are written in the gold format, without leaving their JSON lines next to it
+        """
+        ofile = os.path.join(self.tmp_dir.name, "ceda_results.json")
+        results = run_ceda_queries(FirstWordAnnotator(), ofile, verbose=False)
+        with open(ofile, "r", encoding="utf-8") as f:
+            self.assertEqual(json.load(f)["queries"], results)
+        self.assertTrue(results and "index" not in results[0])
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), ["ceda_results.json", "queries.jsonl"])
+
+
+if __name__ == "__main__":
+    unittest.main()
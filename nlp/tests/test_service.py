@@ -0,0 +1,78 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from nl2query.NL2QueryInterface import LocationAnnotation, PropertyAnnotation, QueryAnnotationsDict
+from nl2query.service import MicroBatcher, NL2QueryClient, create_server
+
+
+class BatchPipeline:
+    """ annotates each query with its length and records the batch sizes """
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def transform_nl2query_batch(self, nlqs, verbose=False):
+        self.batch_sizes.append(len(nlqs))
+        time.sleep(0.05)
+        if "fail" in nlqs:
+            raise RuntimeError("failed query")
+        return [QueryAnnotationsDict(query=nlq, annotations=[
+            PropertyAnnotation(text=nlq, position=[0, len(nlq)], name="length", value=len(nlq),
+                               value_type="integer", operation="eq"),
+            LocationAnnotation(text=nlq, position=[0, len(nlq)], name="", value={}, matching_type="overlap"),
+        ]) for nlq in nlqs]
+
+
+class ServiceTests(unittest.TestCase):
+
+    def start(self, **kwargs):
+        self.pipeline = BatchPipeline()
+        batcher = MicroBatcher(self.pipeline, max_batch=8, max_wait_ms=50)
+        server = create_server({"V3": batcher}, port=0, **kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+            batcher.close()
+        self.addCleanup(stop)
+        return server
+
+    def test_micro_batches(self):
+        """
+        Concurrent single requests are coalesced in batches, the annotations are returned to each client
+        """
+        server = self.start()
+        client = NL2QueryClient(f"http://127.0.0.1:{server.server_address[1]}", "V3")
+        queries = [f"query {'x' * i}" for i in range(8)]
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(client.transform_nl2query, queries))
+        self.assertListEqual([result.query for result in results], queries)
+        self.assertListEqual([result.annotations[0].value for result in results], [len(q) for q in queries])
+        self.assertIsInstance(results[0].annotations[1], LocationAnnotation)
+        self.assertLess(len(self.pipeline.batch_sizes), len(queries))
+        self.assertEqual(client.health()["stats"]["V3"]["queries"], len(queries))
+
+    def test_unix_socket_batch(self):
+        """
+        A batch request over a Unix socket keeps the query order, a failing query only fails itself
+        """
+        socket_path = os.path.join(tempfile.mkdtemp(), "nl2query.sock")
+        self.start(unix_socket=socket_path)
+        client = NL2QueryClient(f"unix://{socket_path}")
+        queries = ["sea ice", "precipitation in 2020", "ocean"]
+        self.assertListEqual([result.query for result in client.transform_nl2query_batch(queries)], queries)
+        with self.assertRaises(RuntimeError):
+            client.transform_nl2query_batch(["ocean", "fail"])
+        self.assertEqual(client.transform_nl2query("ocean").query, "ocean")
+        with self.assertRaises(RuntimeError):
+            NL2QueryClient(f"unix://{socket_path}", "V1").transform_nl2query("ocean")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+from nl2query.snapshots import attach_snapshot, load_snapshot, save_snapshot, source_revision
+
+
+class TiedModel(torch.nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.embeddings = torch.nn.Embedding(50, 8)
+        self.decoder = torch.nn.Linear(8, 50)
+        self.decoder.weight = self.embeddings.weight
+        self.register_buffer("scale", torch.full((50,), 0.5), persistent=False)
+
+    def forward(self, ids):
+        return self.decoder(self.embeddings(ids)) * self.scale
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "model")
+        self.model = TiedModel().eval()
+        self.ids = torch.tensor([1, 2, 3])
+        # weights file the model is loaded from
+        self.source = os.path.join(self.tmp_dir, "tied.bin")
+        torch.save(self.model.state_dict(), self.source)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_load_snapshot(self):
+        """
+        A snapshot loads the same module, with tied weights and non-persistent buffers, from mapped weights
+        """
+        save_snapshot(self.model, self.path, self.source)
+        loaded = load_snapshot(self.path, self.source)
+        self.assertTrue(torch.equal(loaded(self.ids), self.model(self.ids)))
+        self.assertIs(loaded.decoder.weight, loaded.embeddings.weight)
+        self.assertIsNone(load_snapshot(self.path, self.source + ".v2"))
+
+    def test_source_revision(self):
+        """
+        A snapshot is not used once the files of its source change, nor written for unknown sources
+        """
+        save_snapshot(self.model, self.path, self.source)
+        revision = source_revision(self.source)
+        self.assertEqual(source_revision(self.tmp_dir), source_revision(self.tmp_dir))
+        torch.save(TiedModel().state_dict(), self.source)
+        os.utime(self.source, ns=(0, 0))
+        self.assertNotEqual(source_revision(self.source), revision)
+        self.assertIsNone(load_snapshot(self.path, self.source))
+
+        self.assertIsNone(source_revision("nl2query-test/unknown-model"))
+        with self.assertRaises(ValueError):
+            save_snapshot(self.model, self.path, "nl2query-test/unknown-model")
+        self.assertFalse(attach_snapshot(self.model, self.path, "nl2query-test/unknown-model"))
+
+    def test_attach_snapshot(self):
+        """
+        The weights of a module built by its library are replaced by the snapshot ones
+        """
+        self.assertTrue(attach_snapshot(self.model, self.path, self.source))
+        other = TiedModel().eval()
+        expected = self.model(self.ids)
+        self.assertTrue(attach_snapshot(other, self.path, self.source))
+        self.assertTrue(torch.equal(other(self.ids), expected))
+        self.assertFalse(os.path.exists(os.path.join(self.path, "skeleton.pt")))
+
+
+if __name__ == "__main__":
+    unittest.main()
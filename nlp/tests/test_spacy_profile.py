@@ -0,0 +1,145 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from thinc.api import Config
+
+from nl2query.V1.NER_spacy import NER_spacy, excluded_components, model_config_path
+
+# pipelines of en_core_web_trf and en_core_web_sm (only the settings used to find the dependencies)
+TRF_CONFIG = """
+[nlp]
+pipeline = ["transformer","tagger","parser","attribute_ruler","lemmatizer","ner"]
+
+[components]
+
+[components.transformer]
+factory = "transformer"
+
+[components.tagger]
+factory = "tagger"
+
+[components.tagger.model]
+
+[components.tagger.model.tok2vec]
+@architectures = "spacy-transformers.TransformerListener.v1"
+upstream = "transformer"
+
+[components.parser]
+factory = "parser"
+
+[components.parser.model]
+
+[components.parser.model.tok2vec]
+@architectures = "spacy-transformers.TransformerListener.v1"
+upstream = "transformer"
+
+[components.attribute_ruler]
+factory = "attribute_ruler"
+
+[components.lemmatizer]
+factory = "lemmatizer"
+
+[components.ner]
+factory = "ner"
+
+[components.ner.model]
+
+[components.ner.model.tok2vec]
+@architectures = "spacy-transformers.TransformerListener.v1"
+upstream = "*"
+"""
+
+SM_CONFIG = """
+[nlp]
+pipeline = ["tok2vec","tagger","parser","senter","attribute_ruler","lemmatizer","ner"]
+
+[components]
+
+[components.tok2vec]
+factory = "tok2vec"
+
+[components.tagger]
+factory = "tagger"
+
+[components.tagger.model]
+
+[components.tagger.model.tok2vec]
+@architectures = "spacy.Tok2VecListener.v1"
+upstream = "tok2vec"
+
+[components.parser]
+factory = "parser"
+
+[components.senter]
+factory = "senter"
+
+[components.attribute_ruler]
+factory = "attribute_ruler"
+
+[components.lemmatizer]
+factory = "lemmatizer"
+
+[components.ner]
+factory = "ner"
+
+[components.ner.model]
+
+[components.ner.model.tok2vec]
+@architectures = "spacy.Tok2Vec.v2"
+"""
+
+
+class SpacyProfileTests(unittest.TestCase):
+
+    def test_excluded_components(self):
+        """
+        Only ner and the components it listens to are kept
+        """
+        self.assertListEqual(excluded_components(Config().from_str(TRF_CONFIG)),
+                             ["tagger", "parser", "attribute_ruler", "lemmatizer"])
+        # the ner of the small model has its own embedding layer
+        self.assertListEqual(excluded_components(Config().from_str(SM_CONFIG)),
+                             ["tok2vec", "tagger", "parser", "senter", "attribute_ruler", "lemmatizer"])
+
+    def test_model_config_path(self):
+        """
+        The config of a model directory is found, a missing model has none
+        """
+        with tempfile.TemporaryDirectory() as model_dir:
+            self.assertIsNone(model_config_path(model_dir))
+            with open(os.path.join(model_dir, "config.cfg"), "w", encoding="utf-8") as f:
+                f.write(TRF_CONFIG)
+            self.assertEqual(str(model_config_path(model_dir)), os.path.join(model_dir, "config.cfg"))
+        self.assertIsNone(model_config_path("en_core_web_missing"))
+
+    def test_fallback(self):
+        """
+        The fallback model is only loaded if configured, with a warning, and recorded as the model loaded
+        """
+        def load_model(ner, model, version):
+            if model == "en_core_web_trf":
+                raise OSError(f"[E050] Can't find model '{model}'")
+            return model
+
+        with tempfile.TemporaryDirectory() as config_dir, \
+                mock.patch.object(NER_spacy, "load_model", load_model), \
+                mock.patch.dict(os.environ, {"NL2QUERY_SPACY_MODEL": ""}):
+            config_file = os.path.join(config_dir, "spacy_config.cfg")
+            for fallback in ["", "en_core_web_sm"]:
+                with open(config_file, "w", encoding="utf-8") as f:
+                    f.write(f"[components.ner]\nsource = en_core_web_trf\nversion = 3.5.0\nfallback = {fallback}\n")
+                if not fallback:
+                    with self.assertRaises(OSError):
+                        NER_spacy(config_file)
+                    continue
+                with self.assertWarns(UserWarning):
+                    ner = NER_spacy(config_file)
+                self.assertEqual((ner.model, ner.requested_model), ("en_core_web_sm", "en_core_web_trf"))
+                self.assertTrue(ner.fallback_used)
+                self.assertEqual(ner.spacy_engine, "en_core_web_sm")
+
+
+if __name__ == "__main__":
+    unittest.main()
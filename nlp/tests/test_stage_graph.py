@@ -0,0 +1,76 @@
+import threading
+import time
+import unittest
+
+from nl2query.stage_graph import Stage, StageGraph
+
+
+def make_stages(barrier=None):
+    def slow_upper(text):
+        if barrier:
+            # both independent stages must be running at the same time
+            barrier.wait(timeout=5)
+        return text.upper()
+
+    def slow_split(text):
+        if barrier:
+            barrier.wait(timeout=5)
+        return text.split(), len(text)
+
+    return [
+        Stage("upper", slow_upper, inputs=["text"], outputs=["upper"]),
+        Stage("split", slow_split, inputs=["text"], outputs=["words", "length"]),
+        Stage("join", lambda upper, words: f"{upper}:{len(words)}", inputs=["upper", "words"], outputs=["joined"]),
+    ]
+
+
+class StageGraphTests(unittest.TestCase):
+
+    def test_concurrent_same_as_sequential(self):
+        """
+        Independent stages run at the same time and give the same values as the sequential order
+        """
+        graph = StageGraph(make_stages(threading.Barrier(2)), inputs=["text"], max_workers=2)
+        concurrent = graph.run({"text": "sea ice in 2100"})
+        graph.shutdown()
+        sequential = StageGraph(make_stages(), inputs=["text"], concurrent=False).run({"text": "sea ice in 2100"})
+        self.assertDictEqual(concurrent, sequential)
+        self.assertEqual(concurrent["joined"], "SEA ICE IN 2100:4")
+        self.assertEqual(concurrent["length"], 15)
+        self.assertSetEqual(set(graph.timings), {"upper", "split", "join", "total"})
+
+    def test_stage_error(self):
+        """
+        An exception of a stage is raised by the run once the running stages are done
+        """
+        finished = []
+
+        def fail(text):
+            raise RuntimeError(text)
+
+        def slow(text):
+            time.sleep(0.05)
+            finished.append(text)
+
+        graph = StageGraph([Stage("fail", fail, inputs=["text"]), Stage("slow", slow, inputs=["text"])],
+                           inputs=["text"])
+        with self.assertRaises(RuntimeError):
+            graph.run({"text": "query"})
+        graph.shutdown()
+        self.assertListEqual(finished, ["query"])
+
+    def test_invalid_graph(self):
+        """
+        Missing inputs and outputs produced twice are rejected
+        """
+        with self.assertRaises(ValueError):
+            StageGraph(make_stages(), inputs=[])
+        with self.assertRaises(ValueError):
+            StageGraph(make_stages() + [Stage("again", str.lower, inputs=["text"], outputs=["upper"])],
+                       inputs=["text"])
+        with self.assertRaises(ValueError):
+            StageGraph(make_stages(), inputs=["text"]).run({})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import unittest
+from configparser import ConfigParser
+from unittest import mock
+
+import torch
+
+from nl2query.threads import ThreadBudget, available_cpus
+
+
+def make_config(**options):
+    config = ConfigParser()
+    config.read_dict({"threads": options})
+    return config
+
+
+class ThreadBudgetTests(unittest.TestCase):
+
+    def test_from_config(self):
+        """
+        auto divides the available cores between the workers, the environment overrides the config
+        """
+        with mock.patch.dict(os.environ, {"NL2QUERY_WORKERS": "2"}):
+            os.environ.pop("NL2QUERY_THREADS", None)
+            self.assertIsNone(ThreadBudget.from_config(ConfigParser()))
+            budget = ThreadBudget.from_config(make_config(intra_op="auto", inter_op="2"))
+            self.assertEqual(budget.intra_op, max(available_cpus() // 2, 1))
+            self.assertEqual(budget.inter_op, 2)
+            self.assertFalse(budget.tokenizers_parallelism)
+            os.environ["NL2QUERY_THREADS"] = "3"
+            self.assertEqual(ThreadBudget.from_config(make_config(intra_op="1")).intra_op, 3)
+            self.assertEqual(ThreadBudget.from_config(None).intra_op, 3)
+
+    def test_apply(self):
+        """
+        The budget sets the pools environment variables and the torch threads
+        """
+        threads = torch.get_num_threads()
+        try:
+            with mock.patch.dict(os.environ):
+                ThreadBudget(intra_op=1, inter_op=None).apply()
+                self.assertEqual(os.environ["OMP_NUM_THREADS"], "1")
+                self.assertEqual(os.environ["TOKENIZERS_PARALLELISM"], "false")
+                self.assertEqual(torch.get_num_threads(), 1)
+        finally:
+            torch.set_num_threads(threads)
+
+
+if __name__ == "__main__":
+    unittest.main()
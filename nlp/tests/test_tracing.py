@@ -0,0 +1,143 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from configparser import ConfigParser
+from unittest import mock
+
+from nl2query.NL2QueryInterface import QueryAnnotationsDict
+from nl2query.stage_graph import Stage, StageGraph
+from nl2query.tracing import (
+    NO_SPAN,
+    JsonLinesExporter,
+    Span,
+    Tracer,
+    add_count,
+    atraced_transform,
+    current_span,
+    pipeline_tracer,
+    span,
+    traced,
+    traced_transform
+)
+
+
+@traced("lookup")
+def lookup(word: str) -> str:
+    add_count("lookups")
+    return word.upper()
+
+
+class TracedPipeline:
+    """ pipeline looking up each word of a query in a span """
+
+    def __init__(self, tracer=None):
+        self.tracer = tracer
+
+    @traced_transform
+    def transform_nl2query(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        for word in nlq.split():
+            lookup(word)
+        return QueryAnnotationsDict(query=nlq, annotations=[])
+
+    @atraced_transform
+    async def atransform_nl2query(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        with span("gather"):
+            await asyncio.gather(*[self.alookup(word) for word in nlq.split()])
+        return QueryAnnotationsDict(query=nlq, annotations=[])
+
+    @staticmethod
+    @traced("alookup")
+    async def alookup(word: str) -> str:
+        await asyncio.sleep(0)
+        return word.upper()
+
+
+class TracingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "traces.jsonl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_no_trace(self):
+        """
+        Outside of a trace, the spans and counts do nothing and the results have no trace
+        """
+        self.assertIs(span("stage"), NO_SPAN)
+        with span("stage"):
+            add_count("calls")
+        self.assertIsNone(current_span())
+        result = TracedPipeline().transform_nl2query("snow depth")
+        self.assertIsNone(result.trace)
+        self.assertNotIn("trace", result.to_dict())
+
+    def test_traced_transform(self):
+        """
+        The trace of a query has the nested spans and counts, it is attached to the result and exported
+        """
+        pipeline = TracedPipeline(Tracer([JsonLinesExporter(self.path)]))
+        result = pipeline.transform_nl2query("snow depth")
+        trace = result.trace
+        self.assertEqual(trace["name"], "TracedPipeline.transform_nl2query")
+        self.assertEqual(trace["attributes"], {"query": "snow depth"})
+        self.assertEqual([child["name"] for child in trace["children"]], ["lookup", "lookup"])
+        self.assertEqual(trace["children"][0]["counts"], {"lookups": 1})
+        self.assertGreaterEqual(trace["wall_ms"], trace["children"][0]["wall_ms"])
+        self.assertEqual(QueryAnnotationsDict.from_dict(result.to_dict()).trace, trace)
+
+        result = asyncio.run(pipeline.atransform_nl2query("wind speed"))
+        gather = result.trace["children"][0]
+        self.assertEqual([child["name"] for child in gather["children"]], ["alookup", "alookup"])
+
+        with open(self.path, "r", encoding="utf-8") as f:
+            traces = [json.loads(line) for line in f]
+        self.assertEqual([trace["attributes"]["query"] for trace in traces], ["snow depth", "wind speed"])
+
+    def test_stage_graph_spans(self):
+        """
+        The spans of the stages run concurrently on other threads are children of the trace
+        """
+        graph = StageGraph([
+            Stage("upper", lookup, inputs=["text"], outputs=["upper"]),
+            Stage("length", len, inputs=["text"], outputs=["length"]),
+            Stage("join", lambda upper, length: f"{upper}:{length}", inputs=["upper", "length"], outputs=["joined"]),
+        ], inputs=["text"], concurrent=True, max_workers=2)
+        with span("stages"):
+            # no-op outside of a trace
+            graph.run({"text": "snow"})
+        tracer = Tracer()
+        with Span("query") as root:
+            self.assertEqual(graph.run({"text": "snow"})["joined"], "SNOW:4")
+        trace = tracer.export(root)
+        self.assertEqual(sorted(child["name"] for child in trace["children"]), ["join", "length", "upper"])
+        upper = [child for child in trace["children"] if child["name"] == "upper"][0]
+        self.assertEqual(upper["children"][0]["name"], "lookup")
+        graph.shutdown()
+
+    def test_pipeline_tracer(self):
+        """
+        The tracer of the [tracing] section, enabled or disabled by NL2QUERY_TRACE
+        """
+        config = ConfigParser()
+        config.read_dict({"tracing": {"enabled": "false", "exporter": "jsonl", "path": self.path}})
+        with mock.patch.dict(os.environ, {}, clear=False):
+            os.environ.pop("NL2QUERY_TRACE", None)
+            self.assertIsNone(pipeline_tracer(config))
+            os.environ["NL2QUERY_TRACE"] = "1"
+            tracer = pipeline_tracer(config)
+            self.assertEqual(tracer.exporters[0].path, self.path)
+            os.environ["NL2QUERY_TRACE"] = "0"
+            config["tracing"]["enabled"] = "true"
+            self.assertIsNone(pipeline_tracer(config))
+            os.environ.pop("NL2QUERY_TRACE")
+            config["tracing"]["exporter"] = "xml"
+            with self.assertRaises(ValueError):
+                pipeline_tracer(config)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,277 @@
+import os
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from nl2query.cache import ResultCache, cached_transform
+from nl2query.NL2QueryInterface import QueryAnnotationsDict
+from nl2query.stage_graph import Stage, StageGraph
+from nl2query.V2.V2_pipeline import LAST_QUERY_STATS, reset_query_stats
+from nl2query.V2.Vdb_simsearch import QueryState, Vdb_simsearch, build_prop_index, build_target_index, generate_ngrams
+
+
+class VectorSearchVdbs(Vdb_simsearch):
+    """ vdbs answering the vector searches from a dict, without the vector databases """
+
+    def __init__(self, targ_exact_index: dict, vector_results: dict):
+        self.targ_exact_index = targ_exact_index
+        self.vector_results = vector_results
+        self.ngram_filter = None
+        self.encoding = "ngram"
+        self.default_state = QueryState()
+
+    def query_one_target(self, query, k=15, score_t=0.72, verbose=False, embedding=None):
+        results = self.vector_results.get(query, [])
+        return [result for result, _ in results], [score for _, score in results]
+
+
+class StatsPipeline:
+    """ cached pipeline reporting the number of words of the last query as its search stats """
+
+    def __init__(self):
+        self.result_cache = ResultCache()
+        self.cache_fingerprint = "test"
+
+    @reset_query_stats
+    @cached_transform
+    def transform_nl2query(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        LAST_QUERY_STATS.set({"search_stats": {"words": len(nlq.split())}})
+        return QueryAnnotationsDict(query=nlq, annotations=[])
+
+
+class WordTokenizer:
+    """ one token per word between [CLS] (0) and [SEP] (1) """
+
+    def __init__(self):
+        self.vocab = {}
+
+    def __call__(self, words, is_split_into_words=True, truncation=True, max_length=512, return_tensors="pt"):
+        ids = [self.vocab.setdefault(word, len(self.vocab) + 2) for word in words]
+        encoded = Encoding(input_ids=torch.tensor([[0] + ids + [1]]), attention_mask=torch.ones(1, len(ids) + 2))
+        encoded.word_ids = lambda: [None] + list(range(len(ids))) + [None]
+        return encoded
+
+
+class Encoding(dict):
+    pass
+
+
+class WordModel(torch.nn.Module):
+    """ transformer model without context: the hidden state of a token is its embedding, zero for [CLS] and [SEP] """
+
+    def __init__(self, dim: int):
+        super().__init__()
+        self.embedding = torch.nn.Embedding(100, dim)
+        with torch.no_grad():
+            self.embedding.weight[:2] = 0
+
+    def forward(self, input_ids, attention_mask):
+        return SimpleNamespace(last_hidden_state=self.embedding(input_ids))
+
+
+class Transformer(torch.nn.Module):
+    """ sentence-transformers modules of an encoder, features dict to features dict """
+
+    def __init__(self, dim: int):
+        super().__init__()
+        self.tokenizer = WordTokenizer()
+        self.auto_model = WordModel(dim)
+        self.max_seq_length = 512
+
+    def forward(self, features):
+        output = self.auto_model(features["input_ids"], features["attention_mask"])
+        return dict(features, token_embeddings=output.last_hidden_state)
+
+
+class TokenScale(torch.nn.Module):
+    def forward(self, features):
+        return dict(features, token_embeddings=features["token_embeddings"] * 2)
+
+
+class Pooling(torch.nn.Module):
+    pooling_mode_mean_tokens = True
+
+    def forward(self, features):
+        mask = features["attention_mask"].unsqueeze(-1)
+        pooled = (features["token_embeddings"] * mask).sum(dim=1) / mask.sum(dim=1)
+        return dict(features, sentence_embedding=pooled)
+
+
+class Dense(torch.nn.Module):
+    def __init__(self, dim: int):
+        super().__init__()
+        self.linear = torch.nn.Linear(dim, dim, bias=False)
+
+    def forward(self, features):
+        return dict(features, sentence_embedding=self.linear(features["sentence_embedding"]))
+
+
+class Normalize(torch.nn.Module):
+    def forward(self, features):
+        return dict(features, sentence_embedding=torch.nn.functional.normalize(features["sentence_embedding"]))
+
+
+class SentenceEncoder:
+    """ langchain embeddings of a sentence-transformers encoder (client) """
+
+    def __init__(self, modules: list):
+        self.client = torch.nn.Sequential(*modules)
+
+    def embed_query(self, text: str) -> list:
+        with torch.no_grad():
+            features = dict(self.client[0].tokenizer(text.split()))
+            return self.client(features)["sentence_embedding"][0].tolist()
+
+
+class VdbSimsearchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_vocab(self, name: str, lines: list) -> str:
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+    def test_target_index(self):
+        """
+        The normalized varnames and aliases map to the target search result
+        """
+        path = self.write_vocab("target.csv", [
+            "varname#aliases#description",
+            "precipitation_amount#rain amount, precip#amount of precipitation",
+            "snow depth##depth of snow",
+            "#orphan alias#no varname",
+        ])
+        index = build_target_index(path)
+        self.assertEqual(index["precipitation amount"], ["precipitation_amount, rain amount, precip"])
+        self.assertEqual(index["rain amount"], index["precip"])
+        self.assertEqual(index["snow depth"], ["snow depth"])
+        self.assertNotIn("orphan alias", index)
+
+    def test_prop_index(self):
+        """
+        Only the full propvals are indexed, not their values alone
+        """
+        path = self.write_vocab("prop.csv", [
+            "propval#description",
+            "frequency::day#frequency day",
+            "table_id::day#table id day",
+            "experiment_id::ssp585#experiment id ssp585",
+        ])
+        index = build_prop_index(path)
+        self.assertEqual(sorted(index), ["experiment id::ssp585", "frequency::day", "table id::day"])
+        self.assertEqual(index["frequency::day"], ["frequency::day"])
+        self.assertNotIn("day", index)
+
+    def test_exact_span_selection(self):
+        """
+        A span answered by the exact index is selected over spans with more vector search results
+        """
+        vdbs = VectorSearchVdbs({"rain amount": ["precipitation_amount, rain amount"]}, {
+            "daily": [("day length", 0.8), ("daily maximum", 0.75)],
+            "daily rain": [("rainfall rate", 0.8), ("rain flux", 0.78), ("daily precipitation", 0.76)],
+            "daily rain amount": [("rainfall rate", 0.73)],
+        })
+        span, results = vdbs.search_ngram_target("daily rain amount")
+        self.assertEqual(span, "rain amount")
+        self.assertEqual(results[0], "precipitation_amount, rain amount")
+        self.assertEqual(vdbs.search_stats["exact_hits"], 1)
+
+        # without exact match, the span with the most results is kept
+        vdbs = VectorSearchVdbs({}, vdbs.vector_results)
+        span, _ = vdbs.search_ngram_target("daily rain amount")
+        self.assertEqual(span, "daily rain")
+
+    def test_longest_exact_span(self):
+        """
+        Of several exact spans, the longest one is selected
+        """
+        vdbs = VectorSearchVdbs({"rain": ["rainfall"], "rain amount": ["precipitation_amount, rain amount"]},
+                                {"daily": [("day length", 0.8), ("daily maximum", 0.75)]})
+        span, _ = vdbs.search_ngram_target("daily rain amount")
+        self.assertEqual(span, "rain amount")
+        self.assertEqual(vdbs.search_stats["exact_hits"], 2)
+
+    def test_query_state(self):
+        """
+        The search counters and prefetched embeddings of concurrent queries are kept apart,
+        also in the stages of a stage graph
+        """
+        vdbs = VectorSearchVdbs({"rain amount": ["precipitation_amount, rain amount"]}, {})
+        graph = StageGraph([
+            Stage("prefetch", lambda query: vdbs.prefetched.update({query: [0.0]}), inputs=["query"]),
+            Stage("search", vdbs.search_ngram_target, inputs=["query"], outputs=["target"]),
+        ], inputs=["query"], concurrent=True, max_workers=2)
+        barrier = threading.Barrier(2)
+        states = {}
+
+        def annotate(query):
+            timings = {}
+            with vdbs.query_state() as state:
+                barrier.wait(timeout=5)
+                graph.run({"query": query}, timings)
+                barrier.wait(timeout=5)
+            states[query] = state, timings
+
+        threads = [threading.Thread(target=annotate, args=(query,)) for query in ["rain amount", "daily rain amount"]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        graph.shutdown()
+        for query, (state, timings) in states.items():
+            # same counters as the query alone
+            with vdbs.query_state() as alone:
+                vdbs.search_ngram_target(query)
+            self.assertEqual(state.search_stats, alone.search_stats)
+            self.assertEqual(list(state.prefetched), [query])
+            self.assertEqual(sorted(timings), ["prefetch", "search", "total"])
+        self.assertNotEqual(states["rain amount"][0].search_stats, states["daily rain amount"][0].search_stats)
+        # outside of a query
+        self.assertEqual(vdbs.search_stats["vector_searches"], 0)
+        self.assertEqual(vdbs.prefetched, {})
+
+    def test_cached_query_stats(self):
+        """
+        The stats of the last query are empty when its result is found in the cache
+        """
+        pipeline = StatsPipeline()
+        pipeline.transform_nl2query("snow depth")
+        self.assertEqual(LAST_QUERY_STATS.get(), {"search_stats": {"words": 2}})
+        pipeline.transform_nl2query("daily snow depth")
+        pipeline.transform_nl2query("snow depth")
+        self.assertEqual(LAST_QUERY_STATS.get(), {})
+
+    def test_span_pooled_embeddings(self):
+        """
+        The n-gram embeddings pooled from one pass of the query are close to their own query embeddings,
+        the modules before and after the pooling being applied
+        """
+        torch.manual_seed(0)
+        vdbs = Vdb_simsearch.__new__(Vdb_simsearch)
+        vdbs.embeddings = SentenceEncoder([Transformer(8), TokenScale(), Pooling(), Dense(8), Normalize()])
+        query = "daily rain amount over ottawa"
+        vectors = vdbs.span_pooled_embeddings(query, 3)
+        ngrams, _ = generate_ngrams(query, 3)
+        self.assertEqual(set(vectors), set(ngrams + [query]))
+        for ngram, vector in vectors.items():
+            expected = np.asarray(vdbs.embeddings.embed_query(ngram))
+            cosine = np.dot(vector, expected) / np.linalg.norm(vector) / np.linalg.norm(expected)
+            self.assertGreater(cosine, 0.999, ngram)
+
+        vdbs.embeddings = SentenceEncoder([Transformer(8), Dense(8)])
+        with self.assertRaises(ValueError):
+            vdbs.span_pooled_embeddings(query, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
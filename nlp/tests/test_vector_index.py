@@ -0,0 +1,117 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from nl2query.V2.vector_index import ExactIndex, get_vector_index, write_matrix_files
+
+WORDS = ["snow", "rain", "wind", "depth", "speed", "amount", "daily", "surface"]
+TEXTS = ["snow depth", "rain amount", "wind speed", "daily rain", "surface wind", "snow amount"]
+
+
+class WordEmbeddings:
+    """ normalized bag of words embeddings of the test vocabulary """
+
+    def embed_query(self, text: str) -> list:
+        vector = np.array([text.split().count(word) for word in WORDS], dtype=np.float32) + 0.01
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: list) -> list:
+        return [self.embed_query(text) for text in texts]
+
+
+class DocumentLoader:
+    """ csv loader and text splitter of the test documents """
+
+    def __init__(self, texts: list):
+        self.texts = texts
+        self.loads = 0
+
+    def load(self) -> list:
+        self.loads += 1
+        return [Document(page_content=text) for text in self.texts]
+
+    def split_documents(self, documents: list) -> list:
+        return documents
+
+
+def backend_available(backend: str) -> bool:
+    module = {"chroma": "chromadb", "hnswlib": "hnswlib", "faiss": "faiss"}.get(backend)
+    return module is None or importlib.util.find_spec(module) is not None
+
+
+class VectorIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_dir = os.path.join(self.tmp_dir.name, "target_vdb")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def round_trip(self, backend: str, params: dict = None):
+        """build an index, load it again without the documents and search it"""
+        loader = DocumentLoader(TEXTS)
+        built = get_vector_index(backend, self.db_dir, loader, loader, WordEmbeddings(), params=params)
+        loaded = get_vector_index(backend, self.db_dir, loader, loader, WordEmbeddings(), params=params)
+        self.assertEqual(loader.loads, 1)
+        for index in [built, loaded]:
+            results = index.search("snow depth", k=3, score_t=None)
+            self.assertEqual(len(results), 3)
+            self.assertEqual(results[0][0], "snow depth")
+            self.assertAlmostEqual(results[0][1], 1.0, places=4)
+            self.assertEqual(index.search("snow depth", k=3, score_t=0.9), results[:1])
+            self.assertEqual([text for text, _ in index.search("wind speed", k=1, score_t=None)], ["wind speed"])
+        return loaded
+
+    def test_exact(self):
+        """
+        The exact index is built, loaded and searched, also with k = 0 or above the number of vectors
+        """
+        index = self.round_trip("exact")
+        self.assertEqual(index.search("snow", k=0, score_t=None), [])
+        self.assertEqual(len(index.search("snow", k=100, score_t=None)), len(TEXTS))
+        ids, distances = index.knn(np.asarray(WordEmbeddings().embed_query("snow"), dtype=np.float32), 0)
+        self.assertEqual((len(ids), len(distances)), (0, 0))
+
+    @unittest.skipUnless(backend_available("hnswlib"), "hnswlib is not installed")
+    def test_hnswlib(self):
+        """
+        The hnswlib index is built, loaded and searched
+        """
+        self.round_trip("hnswlib", {"hnsw_m": "8", "ef_search": "16"})
+
+    @unittest.skipUnless(backend_available("faiss"), "faiss is not installed")
+    def test_faiss(self):
+        """
+        The faiss HNSW and IVF indexes are built, loaded and searched, IVF trained on a sample of train_size vectors
+        """
+        self.round_trip("faiss", {"factory": "HNSW8"})
+        self.db_dir += "_ivf"
+        self.round_trip("faiss", {"factory": "IVF2,Flat", "nprobe": "2", "train_size": "4"})
+
+    @unittest.skipUnless(backend_available("chroma"), "chromadb is not installed")
+    def test_chroma(self):
+        """
+        The Chroma database is built, loaded and searched
+        """
+        self.round_trip("chroma")
+
+    def test_empty_vocabulary(self):
+        """
+        An index of an empty vocabulary is written with the dimension of the embeddings and finds nothing
+        """
+        loader = DocumentLoader([])
+        index = ExactIndex(self.db_dir, loader, loader, WordEmbeddings())
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.vectors.shape, (0, len(WORDS)))
+        self.assertEqual(index.search("snow", k=5, score_t=None), [])
+        with self.assertRaises(ValueError):
+            write_matrix_files(self.db_dir + "_bad", ["snow", "rain"], [[[1.0, 0.0]]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import torch
+
+from nl2query.cache import ResultCache, cached_transform
+from nl2query.NL2QueryInterface import PropertyAnnotation, QueryAnnotationsDict
+from nl2query.stage_graph import Stage, StageGraph
+from nl2query.V2.vector_index import shared_array
+from nl2query.worker_pool import WorkerPool, _annotate, load_pipeline
+
+
+class PidPipeline:
+    """ annotates each query with the pid of the process and the sum of a shared matrix """
+
+    def __init__(self):
+        self.matrix = shared_array(np.arange(12, dtype=np.float32).reshape(3, 4))
+
+    def transform_nl2query(self, nlq: str) -> QueryAnnotationsDict:
+        annotation = PropertyAnnotation(text=nlq, position=[0, len(nlq)], name=str(os.getpid()),
+                                        value=int(self.matrix.sum()), value_type="integer", operation="eq")
+        return QueryAnnotationsDict(query=nlq, annotations=[annotation])
+
+
+def slow_length(nlq: str) -> int:
+    # both stages run at once, so that the executor starts all its threads
+    time.sleep(0.05)
+    return len(nlq)
+
+
+def slow_pid(nlq: str) -> str:
+    time.sleep(0.05)
+    return str(os.getpid())
+
+
+class StagePipeline:
+    """ annotates each query with its length computed by a concurrent stage graph, as the V3 pipeline """
+
+    def __init__(self):
+        self.stage_graph = StageGraph([
+            Stage("length", slow_length, inputs=["nlq"], outputs=["length"]),
+            Stage("pid", slow_pid, inputs=["nlq"], outputs=["pid"]),
+        ], inputs=["nlq"], concurrent=True, max_workers=2)
+
+    def transform_nl2query(self, nlq: str) -> QueryAnnotationsDict:
+        values = self.stage_graph.run({"nlq": nlq})
+        annotation = PropertyAnnotation(text=nlq, position=[0, len(nlq)], name=values["pid"],
+                                        value=values["length"], value_type="integer", operation="eq")
+        return QueryAnnotationsDict(query=nlq, annotations=[annotation])
+
+    def close(self) -> None:
+        self.stage_graph.shutdown()
+
+
+class CachedPipeline:
+    """ annotates each query with the pid of the process, the results being cached in an SQLite file """
+
+    def __init__(self, path: str):
+        self.result_cache = ResultCache(path)
+        self.cache_fingerprint = "test"
+
+    @cached_transform
+    def transform_nl2query(self, nlq: str, verbose: bool = False) -> QueryAnnotationsDict:
+        annotation = PropertyAnnotation(text=nlq, position=[0, len(nlq)], name=str(os.getpid()), value=0,
+                                        value_type="integer", operation="eq")
+        return QueryAnnotationsDict(query=nlq, annotations=[annotation])
+
+
+class WorkerPoolTests(unittest.TestCase):
+
+    def test_map_in_order(self):
+        """
+        The queries are annotated by the forked workers and returned in input order
+        """
+        pipeline = load_pipeline(PidPipeline, warmup_query="warm up")
+        queries = [f"query {i}" for i in range(20)]
+        with WorkerPool(pipeline, workers=2, threads=1) as pool:
+            results = pool.map(queries)
+            self.assertEqual(len(pool.worker_pids()), 2)
+        self.assertListEqual([result.query for result in results], queries)
+        self.assertTrue(all(result.annotations[0].value == 66 for result in results))
+        self.assertNotIn(str(os.getpid()), {result.annotations[0].name for result in results})
+
+    def test_stage_graph_pipeline(self):
+        """
+        The workers forked from a pipeline warmed up with a concurrent stage graph run its stages,
+        the parent gets its threads back
+        """
+        threads = torch.get_num_threads()
+        pipeline = load_pipeline(StagePipeline, warmup_query="warm up")
+        self.assertEqual(torch.get_num_threads(), threads)
+        queries = [f"query {i}" for i in range(12)]
+        with WorkerPool(pipeline, workers=2, threads=1) as pool:
+            # with a timeout, as the stages of a forked executor hang forever
+            results = pool.pool.map_async(_annotate, queries).get(timeout=30)
+            pids = pool.worker_pids()
+        self.assertEqual(torch.get_num_threads(), threads)
+        self.assertEqual([result.annotations[0].value for result in results], [len(query) for query in queries])
+        self.assertTrue({result.annotations[0].name for result in results} <= {str(pid) for pid in pids})
+        # the parent still runs its own stages
+        self.assertEqual(pipeline.transform_nl2query("snow").annotations[0].value, 4)
+        pipeline.close()
+
+    def test_cached_pipeline(self):
+        """
+        The workers open their own connection to the SQLite cache of the pipeline, closed before forking
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pipeline = load_pipeline(lambda: CachedPipeline(os.path.join(tmp_dir, "results.sqlite")),
+                                     warmup_query="warm up")
+            queries = ["warm up"] + [f"query {i}" for i in range(12)]
+            with WorkerPool(pipeline, workers=2, threads=1) as pool:
+                self.assertIsNone(pipeline.result_cache.db)
+                # with a timeout, as the workers would hang on a lock held by the parent
+                results = pool.pool.map_async(_annotate, queries).get(timeout=30)
+            self.assertEqual(results[0].annotations[0].name, str(os.getpid()))
+            self.assertNotIn(str(os.getpid()), {result.annotations[0].name for result in results[1:]})
+            # the results of the workers are found in the SQLite file by the parent
+            pipeline.result_cache.memory.clear()
+            for query, result in zip(queries, results):
+                self.assertEqual(pipeline.transform_nl2query(query).to_dict(), result.to_dict())
+            self.assertEqual(pipeline.result_cache.stats["sqlite_hits"], 13)
+            pipeline.result_cache.close()
+
+    def test_shared_array(self):
+        """
+        A shared array is a read-only copy
+        """
+        array = np.random.rand(5, 3).astype(np.float32)
+        shared = shared_array(array)
+        np.testing.assert_array_equal(shared, array)
+        with self.assertRaises(ValueError):
+            shared[0, 0] = 1
+        self.assertEqual(shared_array(np.zeros((0, 3))).shape, (0, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()